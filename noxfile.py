@@ -55,6 +55,18 @@ def utest(session: nox.Session) -> None:
     session.run(*pytest, ".")
 
 
+@nox.session(name="benchmark", python=False)
+def benchmark(session: Session) -> None:
+    """Run benchmarks with synthetic data, pass arguments after --, e.g. -- --devices 10"""
+    session.run("python", "src/benchmark/main.py", "run", *session.posargs)
+
+
+@nox.session(name="simulator", python=False)
+def simulator(session: Session) -> None:
+    """Simulate Shelly devices, pass arguments after --, e.g. -- --devices 200 --latency 0.1"""
+    session.run("python", "src/simulator/main.py", *session.posargs)
+
+
 @nox.session(name="jupyter", python=False)
 def jupyter(session: Session) -> None:
     """Run Jupyter Notebook"""
@@ -0,0 +1,135 @@
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Optional
+
+import polars as pl
+
+from analyze.data import DeviceDataSource, SingleDeviceData, SingleFileData
+from analyze.logger import POLAR_ANALYZER_LOGGER
+
+_logger = POLAR_ANALYZER_LOGGER.getChild("cache")
+
+CACHE_VERSION = 3
+
+SourceFingerprint = list[tuple[str, int, int]]
+"""Name, size and modification time of each CSV file of a device"""
+
+
+def source_fingerprint(data: DeviceDataSource) -> SourceFingerprint:
+    files = sorted(Path(file) for file in glob.glob(glob.escape(str(data.data_dir)) + "/*.csv"))
+    return [(file.name, file.stat().st_size, file.stat().st_mtime_ns) for file in files]
+
+
+class DeviceFrameCache:
+    """Stores the merged, de-duplicated frame of each device as uncompressed Arrow IPC file in the cache directory.
+    Loading memory-maps the file, so reloading is fast and several processes share the page cache.
+
+    A cache entry is only used if the device's CSV files (names, sizes and modification times) did not change.
+    The fingerprint of the files is part of the file name, so an entry is never modified while it is mapped."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+
+    def load(self, data: DeviceDataSource) -> Optional[SingleDeviceData]:
+        """Cached data of the device or None if there is no current entry. The frames of the files are zero-copy
+        slices of the memory-mapped merged frame, with the rows of all timestamps of the file like the uncached
+        frames. Rows of timestamps that were also in an earlier file have the values of that file, which
+        are the same for all files of a device."""
+        ipc_file, metadata_file = self._files(data, source_fingerprint(data))
+        if not ipc_file.exists():
+            _logger.debug(f"No cached data for device '{data.device}' in {self.cache_dir}")
+            return None
+        try:
+            metadata = json.loads(metadata_file.read_text(encoding="UTF-8"))
+            # Uncompressed IPC files are memory-mapped
+            df = pl.read_ipc(ipc_file)
+        except (OSError, ValueError, pl.exceptions.PolarsError) as e:
+            _logger.warning(f"Ignoring unreadable cache file {ipc_file}: {e}")
+            return None
+        _logger.info(f"Loaded {len(df)} rows for device '{data.device}' from cache {ipc_file}")
+        return SingleDeviceData(
+            device=data.device, df=df, file_data=[_file_data(df, data.device, file) for file in metadata["files"]]
+        )
+
+    def store(self, data: DeviceDataSource, device_data: SingleDeviceData) -> None:
+        """Store the device's data and remove outdated entries. Errors are logged, not raised."""
+        ipc_file, metadata_file = self._files(data, source_fingerprint(data))
+        ranges = _row_ranges(device_data.df, device_data.file_data)
+        metadata = {
+            "version": CACHE_VERSION,
+            "device": data.device,
+            "data_dir": str(data.data_dir.absolute()),
+            "files": [
+                {
+                    "file": str(file.file),
+                    "first_timestamp": file.first_timestamp.isoformat(),
+                    "last_timestamp": file.last_timestamp.isoformat(),
+                    "ranges": ranges.get(str(file.file), []),
+                }
+                for file in device_data.file_data
+            ],
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            metadata_file.write_text(json.dumps(metadata), encoding="UTF-8")
+            temp_file = ipc_file.with_suffix(".tmp")
+            device_data.df.write_ipc(temp_file, compression="uncompressed")
+            os.replace(temp_file, ipc_file)
+        except (OSError, pl.exceptions.PolarsError) as e:
+            _logger.warning(f"Cannot cache data for device '{data.device}' in {ipc_file}: {e}")
+            return
+        _logger.info(f"Cached {len(device_data.df)} rows for device '{data.device}' in {ipc_file}")
+        self._remove_outdated(data, keep=ipc_file.stem)
+
+    def _files(self, data: DeviceDataSource, fingerprint: SourceFingerprint) -> tuple[Path, Path]:
+        stem = f"{self._prefix(data)}{_hash([CACHE_VERSION, fingerprint])}"
+        return self.cache_dir / f"{stem}.arrow", self.cache_dir / f"{stem}.json"
+
+    def _prefix(self, data: DeviceDataSource) -> str:
+        safe_name = re.sub(r"[^\w.-]", "_", data.device)
+        return f"{safe_name}-{_hash([data.device, str(data.data_dir.absolute())])}-"
+
+    def _remove_outdated(self, data: DeviceDataSource, keep: str) -> None:
+        # Processes that still map a removed file keep reading it until they unmap it
+        for file in self.cache_dir.glob(glob.escape(self._prefix(data)) + "*"):
+            if file.stem != keep:
+                _logger.debug(f"Removing outdated cache file {file}")
+                file.unlink(missing_ok=True)
+
+
+def _hash(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value).encode()).hexdigest()[:16]
+
+
+def _row_ranges(df: pl.DataFrame, file_data: list[SingleFileData]) -> dict[str, list[tuple[int, int]]]:
+    """Offset and length of the runs of rows in the merged frame with the timestamps of each file.
+    The merged frame is sorted by timestamp and has one row per timestamp of any file."""
+    ranges: dict[str, list[tuple[int, int]]] = {}
+    for file in file_data:
+        positions = df["timestamp"].search_sorted(file.df["timestamp"].unique().sort())
+        runs = (
+            pl.DataFrame({"position": positions})
+            .with_columns(run=(pl.col("position").diff() != 1).fill_null(True).cum_sum())
+            .group_by("run", maintain_order=True)
+            .agg(offset=pl.col("position").first(), length=pl.len())
+        )
+        ranges[str(file.file)] = list(runs.select("offset", "length").iter_rows())
+    return ranges
+
+
+def _file_data(df: pl.DataFrame, device: str, metadata: dict[str, Any]) -> SingleFileData:
+    # Slices share the memory of the merged frame, unlike filtering it by timestamp, only the file column is new
+    slices = [df.slice(offset, length) for offset, length in metadata["ranges"]]
+    file_df = pl.concat(slices, rechunk=False) if slices else df.clear()
+    return SingleFileData(
+        device=device,
+        file=Path(metadata["file"]),
+        df=file_df.with_columns(pl.lit(metadata["file"]).alias("file")),
+        first_timestamp=datetime.datetime.fromisoformat(metadata["first_timestamp"]),
+        last_timestamp=datetime.datetime.fromisoformat(metadata["last_timestamp"]),
+    )
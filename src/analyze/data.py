@@ -5,6 +5,7 @@ from typing import Any, Generator, NamedTuple, Optional
 import polars as pl
 
 from analyze.logger import POLAR_ANALYZER_LOGGER
+from importer.csv_index import RECORD_PERIOD, FileInterval, find_covered_files
 from util import format_local_timestamp
 
 _logger = POLAR_ANALYZER_LOGGER.getChild("data")
@@ -61,33 +62,27 @@ class SingleDeviceData(NamedTuple):
     def statistics(self) -> "SingleDeviceStatistics":
         return SingleDeviceStatistics.create(self)
 
-    def find_duplicate_files(self) -> list[SingleFileData]:
+    def find_duplicate_files(
+        self, max_gap: datetime.timedelta = datetime.timedelta(seconds=RECORD_PERIOD)
+    ) -> list[SingleFileData]:
+        """Files covered by the union of the other required files, see find_covered_files().
+        Uses only the files' time ranges and row counts. Only useful for data of all files, e.g. from
+        read_csv_files(), as read_csv_dir() already skips covered files. See analyze.loader.find_duplicate_files()
+        to find them from the CSV index without loading the data."""
         if len(self.file_data) == 0:
             raise ValueError("No files")
-
-        def by_timestamps(f: SingleFileData):
-            return (
-                f.first_timestamp,
-                -len(f.df),
-                f.file,
+        _logger.debug(f"Find duplicates in {len(self.file_data)} files")
+        files = {str(file.file): file for file in self.file_data}
+        intervals = [
+            FileInterval(
+                file=name,
+                first_timestamp=int(file.first_timestamp.timestamp()),
+                last_timestamp=int(file.last_timestamp.timestamp()),
+                rows=len(file.df),
             )
-
-        sorted_files = sorted(
-            self.file_data,
-            key=by_timestamps,
-        )
-        _logger.debug(f"Find duplicates in {len(sorted_files)} files")
-        for idx, file in enumerate(sorted_files):
-            _logger.debug(f"- {idx} {file}")
-
-        duplicates: list[SingleFileData] = []
-        required: list[SingleFileData] = [sorted_files.pop(0)]
-        for file in sorted_files:
-            if (
-                file.first_timestamp <= required[-1].last_timestamp
-                and file.last_timestamp <= required[-1].last_timestamp
-            ):
-                duplicates.append(file)
+            for name, file in files.items()
+        ]
+        duplicates = [files[interval.file] for interval in find_covered_files(intervals, int(max_gap.total_seconds()))]
         _logger.debug(f"Found {len(duplicates)} duplicate files")
         return duplicates
 
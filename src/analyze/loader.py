@@ -1,10 +1,14 @@
 import datetime
 import glob
-from functools import reduce
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 import polars as pl
 
+from analyze.cache import DeviceFrameCache
+from analyze.common import ALL_CSV_COLUMNS, PHASE_COLUMNS, Phase
 from analyze.data import (
     DeviceDataSource,
     MultiDeviceData,
@@ -12,62 +16,240 @@ from analyze.data import (
     SingleFileData,
 )
 from analyze.logger import POLAR_ANALYZER_LOGGER
+from importer.csv_index import RECORD_PERIOD, CsvFileRange, CsvIndex
 from util import format_local_timestamp
 
 _logger = POLAR_ANALYZER_LOGGER.getChild("loader")
 
+LOAD_WORKERS = min(8, os.cpu_count() or 1)
+"""Devices loaded concurrently by read_data"""
 
-def read_data(devices: list[DeviceDataSource]) -> MultiDeviceData:
+
+def read_data(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    devices: list[DeviceDataSource],
+    cache_dir: Optional[Path] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    columns: Optional[list[str]] = None,
+    max_workers: int = LOAD_WORKERS,
+) -> MultiDeviceData:
+    """Read the data of all devices. If a cache directory is given, the merged data of each device is cached
+    there and reused as long as the device's CSV files do not change.
+
+    Only rows with start <= timestamp < end and the given columns (see csv_columns) are read. Without cache the
+    time range selects the files and rows to parse via the CSV index and the columns are pushed into the CSV scan.
+
+    Up to max_workers devices are loaded concurrently, the files of a device are collected in parallel by polars.
+    """
     if len(devices) == 0:
         raise ValueError("No devices given")
+    selected_columns = csv_columns(columns)
+    cache = DeviceFrameCache(cache_dir) if cache_dir is not None else None
 
-    def merge(a: pl.DataFrame, b: pl.DataFrame) -> pl.DataFrame:
-        return a.vstack(other=b, in_place=False)
+    def read_device(data: DeviceDataSource) -> SingleDeviceData:
+        if cache is not None:
+            return _read_cached(data, cache, start, end, selected_columns)
+        return read_csv_dir(data, start, end, selected_columns)
 
-    _logger.debug(f"Merging data for {len(devices)} devices...")
-    all_data = [read_csv_dir(data) for data in devices]
-    df = reduce(merge, (data.df for data in all_data))
+    _logger.debug(f"Loading data for {len(devices)} devices with {max_workers} workers...")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="load") as executor:
+        all_data = list(executor.map(read_device, devices))
+    df = pl.concat([data.df for data in all_data], how="vertical")
     _logger.info(f"Found {len(df)} rows for {len(devices)} devices.")
     return MultiDeviceData(devices=all_data, df=df.lazy())
 
 
-def read_csv_dir(data: DeviceDataSource) -> SingleDeviceData:
+def csv_columns(columns: Optional[list[str]]) -> Optional[list[str]]:
+    """CSV columns to read besides the timestamp, None means all columns. Columns are given as CSV column names,
+    e.g. a_max_act_power, or as phase column names, e.g. max_act_power for the columns of all three phases."""
+    if columns is None:
+        return None
+    result: list[str] = []
+    for column in columns:
+        if column in PHASE_COLUMNS:
+            result.extend(f"{phase.value}_{column}" for phase in Phase)
+        elif column in ALL_CSV_COLUMNS:
+            result.append(column)
+        else:
+            raise ValueError(f"Unsupported column '{column}'. Use one of {ALL_CSV_COLUMNS} or {PHASE_COLUMNS}")
+    return [column for column in dict.fromkeys(result) if column != "timestamp"]
+
+
+def _read_cached(
+    data: DeviceDataSource,
+    cache: DeviceFrameCache,
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+    columns: Optional[list[str]],
+) -> SingleDeviceData:
+    device_data = cache.load(data)
+    if device_data is None:
+        device_data = read_csv_dir(data)
+        cache.store(data, device_data)
+    if start is None and end is None and columns is None:
+        return device_data
+    file_data = [
+        _file_data(_select(file.df.lazy(), start, end, columns).collect(), file.file, data.device)
+        for file in device_data.file_data
+    ]
+    file_data = [file for file in file_data if not file.df.is_empty()]
+    if not file_data:
+        raise ValueError(f"No data for device '{data.device}' between {start} and {end}")
+    df = _select(device_data.df.lazy(), start, end, columns).collect()
+    return SingleDeviceData(device=data.device, df=df, file_data=file_data)
+
+
+def read_csv_dir(
+    data: DeviceDataSource,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    columns: Optional[list[str]] = None,
+) -> SingleDeviceData:
+    """Read the CSV files of a device, skipping files whose rows are contained in other files. If a time range is
+    given, only rows with start <= timestamp < end are read from the files overlapping it. Uses the directory's
+    CSV index."""
+    if start is not None or end is not None:
+        return read_csv_ranges(CsvIndex.open(data.data_dir).select(start, end), data.device, start, end, columns)
     csv_files = [Path(file) for file in glob.glob(glob.escape(str(data.data_dir)) + "/*.csv")]
     if not csv_files:
         raise ValueError(f"Data dir {data.data_dir.absolute()} does not contain CSV files")
-    return read_csv_files(csv_files, data.device)
+    covered = set(CsvIndex.open(data.data_dir).covered_files())
+    return read_csv_files([file for file in csv_files if file.name not in covered], data.device, columns)
+
 
+def find_duplicate_files(
+    data: DeviceDataSource, max_gap: datetime.timedelta = datetime.timedelta(seconds=RECORD_PERIOD)
+) -> list[Path]:
+    """CSV files of a device whose rows are all contained in other files. Uses only the directory's CSV index,
+    see SingleDeviceData.find_duplicate_files() for loaded data."""
+    index = CsvIndex.open(data.data_dir)
+    duplicates = [data.data_dir / name for name in index.covered_files(int(max_gap.total_seconds()))]
+    _logger.info(f"Found {len(duplicates)} duplicate files of {len(index.files)} for device '{data.device}'")
+    return duplicates
 
-def read_csv_files(files: list[Path], device: str) -> SingleDeviceData:
+
+def read_csv_files(files: list[Path], device: str, columns: Optional[list[str]] = None) -> SingleDeviceData:
     if not files:
         raise ValueError("No input files")
     _logger.info(f"Reading {len(files)} files for device '{device}'...")
+    files = sorted(files)
+    dfs = _collect_all([_scan_csv(file, device, columns) for file in files], files, device)
+    return _merge_file_data([_file_data(df, file, device) for df, file in zip(dfs, files)], device)
+
 
-    def merge(a: pl.DataFrame, b: pl.DataFrame) -> pl.DataFrame:
-        df = a.vstack(other=b, in_place=False)
-        df = df.unique(subset="timestamp", keep="first", maintain_order=False)
-        return df
+def read_csv_ranges(
+    ranges: list[CsvFileRange],
+    device: str,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    columns: Optional[list[str]] = None,
+) -> SingleDeviceData:
+    ranges = [file_range for file_range in ranges if file_range.rows > 0]
+    files = [file_range.file for file_range in ranges]
+    lazy_dfs = [_scan_csv_range(file_range, device, start, end, columns) for file_range in ranges]
+    file_data = [
+        _file_data(df, file, device)
+        for df, file in zip(_collect_all(lazy_dfs, files, device), files)
+        if not df.is_empty()
+    ]
+    if not file_data:
+        raise ValueError(f"No data for device '{device}' between {start} and {end}")
+    _logger.info(f"Read {len(file_data)} of {len(ranges)} file ranges for device '{device}'")
+    return _merge_file_data(file_data, device)
 
-    _logger.debug(f"Merging data frames for {len(files)} files...")
-    file_data = [load_csv(file, device) for file in sorted(files)]
-    df = reduce(merge, (data.df for data in file_data))
-    _logger.debug(f"Found {len(df)} unique rows in {len(files)} files")
+
+def _merge_file_data(file_data: list[SingleFileData], device: str) -> SingleDeviceData:
+    df = pl.concat([data.df for data in file_data], how="vertical")
+    df = df.unique(subset="timestamp", keep="first", maintain_order=False)
+    _logger.debug(f"Found {len(df)} unique rows in {len(file_data)} files")
     df = df.sort(by="timestamp", descending=False)
     return SingleDeviceData(device=device, df=df, file_data=file_data)
 
 
-def load_csv(file: Path, device: str) -> SingleFileData:
+def load_csv(file: Path, device: str, columns: Optional[list[str]] = None) -> SingleFileData:
+    df = _collect(_scan_csv(file, device, columns), file, device)
+    return _file_data(df, file, device)
+
+
+def load_csv_range(
+    file_range: CsvFileRange,
+    device: str,
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+    columns: Optional[list[str]] = None,
+) -> Optional[SingleFileData]:
+    """Load the rows of a file range with start <= timestamp < end, None if there are no such rows"""
+    df = _collect(_scan_csv_range(file_range, device, start, end, columns), file_range.file, device)
+    if df.is_empty():
+        return None
+    return _file_data(df, file_range.file, device)
+
+
+def _scan_csv(file: Path, device: str, columns: Optional[list[str]]) -> pl.LazyFrame:
     lazy_df = pl.scan_csv(source=file, has_header=True, infer_schema=True, raise_if_empty=True, include_file_paths=None)
+    return _select(_with_device_columns(lazy_df, file, device), start=None, end=None, columns=columns)
+
+
+def _scan_csv_range(
+    file_range: CsvFileRange,
+    device: str,
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+    columns: Optional[list[str]],
+) -> pl.LazyFrame:
+    lazy_df = pl.scan_csv(
+        source=file_range.file,
+        has_header=True,
+        infer_schema=True,
+        skip_rows_after_header=file_range.start_row,
+        n_rows=file_range.rows,
+    )
+    return _select(_with_device_columns(lazy_df, file_range.file, device), start, end, columns)
+
+
+def _select(
+    lazy_df: pl.LazyFrame,
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+    columns: Optional[list[str]],
+) -> pl.LazyFrame:
+    """Keep only rows with start <= timestamp < end and only the given columns besides timestamp, device and file.
+    Polars pushes the filter and the projection into the CSV scan."""
+    if columns is not None:
+        lazy_df = lazy_df.select("timestamp", *columns, "device", "file")
+    if start is not None:
+        lazy_df = lazy_df.filter(pl.col("timestamp") >= start)
+    if end is not None:
+        lazy_df = lazy_df.filter(pl.col("timestamp") < end)
+    return lazy_df
+
+
+def _with_device_columns(lazy_df: pl.LazyFrame, file: Path, device: str) -> pl.LazyFrame:
     lazy_df = lazy_df.with_columns(
         pl.lit(device).alias("device"),
         pl.lit(str(file)).alias("file"),
         pl.from_epoch(column=pl.col("timestamp"), time_unit="s").alias("timestamp"),
     )
-    lazy_df = lazy_df.with_columns(pl.col("timestamp").dt.replace_time_zone("UTC"))
+    return lazy_df.with_columns(pl.col("timestamp").dt.replace_time_zone("UTC"))
+
+
+def _collect(lazy_df: pl.LazyFrame, file: Path, device: str) -> pl.DataFrame:
     try:
-        df = lazy_df.collect()
+        return lazy_df.collect()
     except pl.exceptions.PolarsError as e:
         raise ValueError(f"Error loading data for device {device} from {file}") from e
+
+
+def _collect_all(lazy_dfs: list[pl.LazyFrame], files: list[Path], device: str) -> list[pl.DataFrame]:
+    """Collect the frames of several files in parallel"""
+    try:
+        return pl.collect_all(lazy_dfs)
+    except pl.exceptions.PolarsError:
+        # Collect the files one by one to report the failing file
+        return [_collect(lazy_df, file, device) for lazy_df, file in zip(lazy_dfs, files)]
+
+
+def _file_data(df: pl.DataFrame, file: Path, device: str) -> SingleFileData:
     first_timestamp = df["timestamp"].min()
     last_timestamp = df["timestamp"].max()
     if not isinstance(first_timestamp, datetime.datetime) or not isinstance(last_timestamp, datetime.datetime):
@@ -1,6 +1,6 @@
 import logging
 
-from analyze.loader import DeviceDataSource
+from analyze.loader import DeviceDataSource, find_duplicate_files
 from analyze.logger import POLAR_ANALYZER_LOGGER
 from analyze.model import PolarDeviceData
 from config import config
@@ -11,9 +11,11 @@ _logger = POLAR_ANALYZER_LOGGER.getChild("main")
 
 
 def main():
-    data = PolarDeviceData.load([DeviceDataSource(f.dir, f.device) for f in config.files])
-    for device in data.device_data:
-        print(device.find_duplicate_files())
+    sources = [DeviceDataSource(f.dir, f.device) for f in config.files]
+    for source in sources:
+        print(find_duplicate_files(source))
+    data = PolarDeviceData.load(sources)
+    _logger.info(f"Loaded data of {len(data.device_data)} devices")
     # df = data.total_energy(every="1mo", group_by=None).collect()
     # print(df)
     # print(data.statistics.to_string())
@@ -1,6 +1,7 @@
 import datetime
 from dataclasses import dataclass
 from functools import reduce
+from pathlib import Path
 from typing import Generator, Optional
 
 import polars as pl
@@ -21,8 +22,23 @@ class PolarDeviceData:
     _collected: Optional[pl.DataFrame] = None
 
     @classmethod
-    def load(cls, devices: list[DeviceDataSource]) -> "PolarDeviceData":
-        data = read_data(devices)
+    def load(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        cls,
+        devices: list[DeviceDataSource],
+        cache_dir: Optional[Path] = None,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        device_names: Optional[list[str]] = None,
+        columns: Optional[list[str]] = None,
+    ) -> "PolarDeviceData":
+        """Load the data of the devices, optionally only of the named devices, rows with start <= timestamp < end
+        and the given columns. See read_data for the cache and the supported columns."""
+        if device_names is not None:
+            unknown = set(device_names) - {device.device for device in devices}
+            if unknown:
+                raise ValueError(f"Unknown devices {sorted(unknown)}, available: {[d.device for d in devices]}")
+            devices = [device for device in devices if device.device in device_names]
+        data = read_data(devices, cache_dir=cache_dir, start=start, end=end, columns=columns)
         return cls(data.df, data.devices)
 
     @property
@@ -0,0 +1,162 @@
+import csv
+import datetime
+import json
+import random
+from pathlib import Path
+from typing import Any, Generator, Iterable, NamedTuple
+
+from analyze.common import ALL_CSV_COLUMNS, PHASE_COLUMNS
+
+PHASES = ["a", "b", "c"]
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+MINUTES_PER_DAY = 24 * 60
+
+
+class CsvLayout(NamedTuple):
+    devices: int = 3
+    """Number of devices, each stored in its own directory"""
+    days: int = 7
+    """Number of days of minute data per device"""
+    files_per_device: int = 4
+    """Number of downloaded files per device"""
+    overlap: float = 0.25
+    """Fraction by which consecutive files overlap"""
+    gaps: int = 3
+    """Number of gaps (device offline) per device"""
+    seed: int = 42
+
+    def device_name(self, index: int) -> str:
+        return f"device{index}"
+
+
+class _PhaseState:
+    """Random walk of a phase's load, so that consecutive rows look like real measurements"""
+
+    def __init__(self, rnd: random.Random) -> None:
+        self._rnd = rnd
+        self.power = rnd.uniform(5, 500)
+
+    def next_row(self) -> dict[str, float]:
+        rnd = self._rnd
+        self.power = min(3_000.0, max(0.0, self.power + rnd.gauss(0, 20)))
+        voltage = rnd.gauss(233, 1.5)
+        current = self.power / voltage
+        apparent = self.power / rnd.uniform(0.5, 1.0)
+        return {
+            "total_act_energy": self.power / 60,
+            "fund_act_energy": self.power / 60 * 0.98,
+            "total_act_ret_energy": 0.0,
+            "fund_act_ret_energy": 0.0,
+            "lag_react_energy": rnd.uniform(0, 0.1),
+            "lead_react_energy": rnd.uniform(0, 0.1),
+            "max_act_power": self.power * 1.1,
+            "min_act_power": self.power * 0.9,
+            "max_aprt_power": apparent * 1.1,
+            "min_aprt_power": apparent * 0.9,
+            "max_voltage": voltage + 1,
+            "min_voltage": voltage - 1,
+            "avg_voltage": voltage,
+            "max_current": current * 1.1,
+            "min_current": current * 0.9,
+            "avg_current": current,
+        }
+
+
+def _format(column: str, value: float) -> str:
+    if column.endswith("energy"):
+        return f"{value:.4f}"
+    if column.endswith("power"):
+        return f"{value:.1f}"
+    return f"{value:.3f}"
+
+
+def generate_csv_rows(rnd: random.Random, start: datetime.datetime, minutes: int) -> list[dict[str, str]]:
+    """Generate rows with one minute resolution in the format of the Shelly's emdata CSV export"""
+    phases = {phase: _PhaseState(rnd) for phase in PHASES}
+    start_ts = int(start.timestamp())
+    rows = []
+    for minute in range(minutes):
+        row = {"timestamp": str(start_ts + minute * 60)}
+        for phase, state in phases.items():
+            values = state.next_row()
+            row.update({f"{phase}_{column}": _format(column, values[column]) for column in PHASE_COLUMNS})
+        neutral = rnd.uniform(0, 0.2)
+        row.update({"n_max_current": f"{neutral:.3f}", "n_min_current": "0.000", "n_avg_current": f"{neutral / 2:.3f}"})
+        rows.append(row)
+    return rows
+
+
+def _gap_mask(rnd: random.Random, minutes: int, gaps: int) -> set[int]:
+    missing: set[int] = set()
+    for _ in range(gaps):
+        gap_start = rnd.randrange(minutes)
+        missing.update(range(gap_start, min(minutes, gap_start + rnd.randint(5, 120))))
+    return missing
+
+
+def write_csv_files(target_dir: Path, layout: CsvLayout) -> list[Path]:
+    """Write CSV files for all devices of the layout into one sub directory per device.
+    Files of a device overlap like repeated downloads and share the same gaps."""
+    rnd = random.Random(layout.seed)
+    files = []
+    for device_index in range(layout.devices):
+        device_dir = target_dir / layout.device_name(device_index)
+        device_dir.mkdir(parents=True, exist_ok=True)
+        files.extend(_write_device_files(rnd, device_dir, layout))
+    return files
+
+
+def _write_device_files(rnd: random.Random, device_dir: Path, layout: CsvLayout) -> list[Path]:
+    minutes = layout.days * MINUTES_PER_DAY
+    file_span = minutes / layout.files_per_device
+    rows = generate_csv_rows(rnd, START, minutes)
+    missing = _gap_mask(rnd, minutes, layout.gaps)
+    files = []
+    for file_index in range(layout.files_per_device):
+        first = int(file_index * file_span)
+        last = min(minutes, int(first + file_span * (1 + layout.overlap)))
+        download_time = START + datetime.timedelta(minutes=last)
+        file = device_dir / f"{device_dir.name}_{download_time.strftime('%Y-%m-%d_%H%M%S')}.csv"
+        _write_csv(file, (rows[minute] for minute in range(first, last) if minute not in missing))
+        files.append(file)
+    return files
+
+
+def _write_csv(file: Path, rows: Iterable[dict[str, str]]) -> None:
+    with open(file, "w", newline="", encoding="UTF-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=ALL_CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def generate_notify_status_frames(devices: int, events_per_device: int, seed: int = 42) -> Generator[str, None, None]:
+    """Generate websocket NotifyStatus frames as sent by Shelly Pro 3EM devices once per second,
+    interleaved for all devices"""
+    rnd = random.Random(seed)
+    states = [{phase: _PhaseState(rnd) for phase in PHASES} for _ in range(devices)]
+    start_ts = START.timestamp()
+    for second in range(events_per_device):
+        for device, phases in enumerate(states):
+            yield json.dumps(_notify_status(rnd, f"shellypro3em-{device:012x}", start_ts + second, phases))
+
+
+def _notify_status(rnd: random.Random, src: str, ts: float, phases: dict[str, _PhaseState]) -> dict[str, Any]:
+    em: dict[str, Any] = {"id": 0}
+    for phase, state in phases.items():
+        values = state.next_row()
+        em[f"{phase}_act_power"] = round(state.power, 1)
+        em[f"{phase}_aprt_power"] = round(values["max_aprt_power"], 1)
+        em[f"{phase}_current"] = round(values["avg_current"], 3)
+        em[f"{phase}_freq"] = round(rnd.gauss(50, 0.02), 1)
+        em[f"{phase}_pf"] = round(rnd.uniform(0.5, 1.0), 2)
+        em[f"{phase}_voltage"] = round(values["avg_voltage"], 1)
+    em["n_current"] = None
+    em["total_act_power"] = round(sum(em[f"{phase}_act_power"] for phase in PHASES), 3)
+    em["total_aprt_power"] = round(sum(em[f"{phase}_aprt_power"] for phase in PHASES), 3)
+    em["total_current"] = round(sum(em[f"{phase}_current"] for phase in PHASES), 3)
+    return {
+        "src": src,
+        "dst": "client-benchmark",
+        "method": "NotifyStatus",
+        "params": {"ts": round(ts + rnd.uniform(0, 0.99), 2), "em:0": em},
+    }
@@ -0,0 +1,62 @@
+import csv
+import json
+from pathlib import Path
+
+from analyze.common import ALL_CSV_COLUMNS
+from benchmark.generators import (
+    CsvLayout,
+    generate_notify_status_frames,
+    write_csv_files,
+)
+from importer.model import CsvRow, NotifyStatusEvent
+
+LAYOUT = CsvLayout(devices=2, days=1, files_per_device=3, overlap=0.5, gaps=2, seed=1)
+
+
+def _read_timestamps(file: Path) -> list[int]:
+    with open(file, newline="", encoding="UTF-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        assert reader.fieldnames == ALL_CSV_COLUMNS
+        return [int(row["timestamp"]) for row in reader]
+
+
+def test_write_csv_files_layout(tmp_path: Path):
+    files = write_csv_files(tmp_path, LAYOUT)
+    assert len(files) == 6
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["device0", "device1"]
+    assert all(file.parent.name in file.name for file in files)
+
+
+def test_write_csv_files_overlap_and_gaps(tmp_path: Path):
+    files = write_csv_files(tmp_path, LAYOUT)
+    first, second, _ = [set(_read_timestamps(file)) for file in files[:3]]
+    assert first & second, "consecutive files overlap"
+    all_timestamps = sorted(first | second)
+    steps = {b - a for a, b in zip(all_timestamps, all_timestamps[1:])}
+    assert 60 in steps
+    assert max(steps) > 60, "data contains gaps"
+
+
+def test_write_csv_files_is_reproducible(tmp_path: Path):
+    files1 = write_csv_files(tmp_path / "run1", LAYOUT)
+    files2 = write_csv_files(tmp_path / "run2", LAYOUT)
+    assert [file.read_text(encoding="UTF-8") for file in files1] == [
+        file.read_text(encoding="UTF-8") for file in files2
+    ]
+
+
+def test_csv_rows_can_be_parsed(tmp_path: Path):
+    files = write_csv_files(tmp_path, LAYOUT)
+    with open(files[0], newline="", encoding="UTF-8") as csvfile:
+        row = CsvRow.from_dict(next(csv.DictReader(csvfile)))
+    assert len(row.phases) == 3
+    assert row.phases[0].avg_voltage > 200
+
+
+def test_generate_notify_status_frames():
+    frames = list(generate_notify_status_frames(devices=3, events_per_device=2))
+    assert len(frames) == 6
+    events = [NotifyStatusEvent.from_dict(json.loads(frame)) for frame in frames]
+    assert len({event.src for event in events}) == 3
+    assert events[0].timestamp < events[3].timestamp
+    assert all(len(event.status.phases) == 3 for event in events)
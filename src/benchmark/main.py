@@ -0,0 +1,135 @@
+import datetime
+import json
+import logging
+import multiprocessing
+import platform
+import subprocess
+import tempfile
+from concurrent import futures
+from pathlib import Path
+from typing import Any, Optional
+
+import typer
+from typing_extensions import Annotated
+
+from benchmark.generators import CsvLayout, write_csv_files
+from benchmark.stages import (
+    STAGES,
+    BenchmarkInput,
+    StageResult,
+    get_stage,
+    run_stage_by_name,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+logger = logging.getLogger("benchmark")
+
+DEFAULT_OUTPUT_DIR = Path("benchmark-results")
+
+app = typer.Typer(no_args_is_help=True)
+
+
+@app.command()
+def run(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    stages: Annotated[Optional[list[str]], typer.Option("--stage", help="Stage to run, default: all")] = None,
+    devices: Annotated[int, typer.Option(help="Number of devices")] = 3,
+    days: Annotated[int, typer.Option(help="Days of CSV data per device")] = 7,
+    files_per_device: Annotated[int, typer.Option(help="Number of overlapping CSV files per device")] = 4,
+    events_per_device: Annotated[int, typer.Option(help="Number of websocket frames per device")] = 3_600,
+    seed: Annotated[int, typer.Option(help="Seed for the data generators")] = 42,
+    output_dir: Annotated[Path, typer.Option(help="Directory for the JSON result")] = DEFAULT_OUTPUT_DIR,
+) -> None:
+    """
+    Generate synthetic data and measure throughput, wall time and memory of each pipeline stage.
+    """
+    selected = [get_stage(name) for name in stages] if stages else STAGES
+    layout = CsvLayout(devices=devices, days=days, files_per_device=files_per_device, seed=seed)
+    with tempfile.TemporaryDirectory(prefix="energy-monitor-benchmark-") as tmp_dir:
+        data = BenchmarkInput(data_dir=Path(tmp_dir), layout=layout, events_per_device=events_per_device)
+        files = write_csv_files(data.data_dir, layout)
+        logger.info(f"Generated {len(files)} CSV files for {devices} devices in {tmp_dir}")
+        results = [_run_in_new_process(stage.name, data) for stage in selected]
+    output_file = _write_results(output_dir, data, results)
+    _print_results(results)
+    logger.info(f"Wrote results to {output_file}")
+
+
+def _run_in_new_process(stage_name: str, data: BenchmarkInput) -> StageResult:
+    """Run each stage in a fresh interpreter, so that peak memory and caches are not shared between stages"""
+    logger.info(f"Running stage {stage_name}...")
+    with futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_stage_by_name, stage_name, data).result()
+
+
+def _write_results(output_dir: Path, data: BenchmarkInput, results: list[StageResult]) -> Path:
+    now = datetime.datetime.now()
+    commit = _git_commit()
+    content: dict[str, Any] = {
+        "timestamp": now.isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "layout": data.layout._asdict(),
+        "events_per_device": data.events_per_device,
+        "stages": [result.to_dict() for result in results],
+    }
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir / f"{now.strftime('%Y-%m-%d_%H%M%S')}_{commit}.json"
+    output_file.write_text(json.dumps(content, indent=2), encoding="UTF-8")
+    return output_file
+
+
+def _git_commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return result.stdout.strip()
+
+
+def _print_results(results: list[StageResult]) -> None:
+    print(f"{'stage':<24} {'items':>10} {'unit':<7} {'items/s':>12} {'wall [s]':>9} {'cpu [s]':>9} {'max rss':>10}")
+    for result in results:
+        print(
+            f"{result.stage:<24} {result.items:>10} {result.unit:<7} {result.items_per_second:>12.0f} "
+            f"{result.wall_seconds:>9.3f} {result.cpu_seconds:>9.3f} {result.max_rss_bytes / 2**20:>8.1f}MB"
+        )
+
+
+@app.command()
+def compare(
+    baseline: Annotated[Path, typer.Argument(help="JSON result of the baseline run")],
+    current: Annotated[Path, typer.Argument(help="JSON result of the run to compare")],
+) -> None:
+    """
+    Compare throughput and memory of two benchmark results.
+    """
+    baseline_stages = _load_stages(baseline)
+    current_stages = _load_stages(current)
+    print(f"{'stage':<24} {'baseline/s':>12} {'current/s':>12} {'change':>8} {'rss change':>11}")
+    for name, current_stage in current_stages.items():
+        baseline_stage = baseline_stages.get(name)
+        if baseline_stage is None:
+            print(f"{name:<24} {'-':>12} {current_stage['items_per_second']:>12.0f}")
+            continue
+        throughput_change = _relative_change(baseline_stage["items_per_second"], current_stage["items_per_second"])
+        rss_change = _relative_change(baseline_stage["max_rss_bytes"], current_stage["max_rss_bytes"])
+        print(
+            f"{name:<24} {baseline_stage['items_per_second']:>12.0f} {current_stage['items_per_second']:>12.0f} "
+            f"{throughput_change:>+7.1f}% {rss_change:>+10.1f}%"
+        )
+
+
+def _load_stages(file: Path) -> dict[str, dict[str, Any]]:
+    content = json.loads(file.read_text(encoding="UTF-8"))
+    return {stage["stage"]: stage for stage in content["stages"]}
+
+
+def _relative_change(baseline: float, current: float) -> float:
+    if baseline == 0:
+        return 0.0
+    return (current - baseline) / baseline * 100
+
+
+if __name__ == "__main__":
+    app()
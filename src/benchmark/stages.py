@@ -0,0 +1,373 @@
+import csv
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+from analyze.data import DeviceDataSource
+from analyze.loader import LOAD_WORKERS, read_data
+from analyze.model import PolarDeviceData
+from benchmark.generators import (
+    START,
+    CsvLayout,
+    generate_notify_status_frames,
+    write_csv_files,
+)
+from importer import fast_json
+from importer.aggregation import EventAggregator
+from importer.csv_index import CsvIndex
+from importer.db.influx_converter import PointConverter
+from importer.deadband import DEFAULT_RULES, DeadbandConfig, DeadbandFilter
+from importer.main import read_csv_files
+from importer.model import (
+    CsvRow,
+    EnergyMeterStatus,
+    EnergyMeterStatusRaw,
+    NotifyStatusEvent,
+    Schema,
+)
+
+Run = Callable[[], int]
+"""Timed part of a stage, returns the number of processed items"""
+
+
+class BenchmarkInput(NamedTuple):
+    data_dir: Path
+    """Directory containing one sub directory with CSV files per device"""
+    layout: CsvLayout
+    events_per_device: int
+
+    @property
+    def device_dirs(self) -> list[Path]:
+        return [self.data_dir / self.layout.device_name(i) for i in range(self.layout.devices)]
+
+
+class Stage(NamedTuple):
+    name: str
+    unit: str
+    prepare: Callable[[BenchmarkInput], Run]
+    """Prepares the input of the stage (not timed) and returns the timed run function"""
+
+
+class StageResult(NamedTuple):
+    stage: str
+    unit: str
+    items: int
+    wall_seconds: float
+    cpu_seconds: float
+    max_rss_before_bytes: int
+    """Peak resident set size of the process after preparing the input"""
+    max_rss_bytes: int
+    """Peak resident set size of the process after running the stage"""
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    def to_dict(self) -> dict[str, str | int | float]:
+        return {**self._asdict(), "items_per_second": self.items_per_second}  # pylint: disable=no-member
+
+
+CLI_STARTUP_RUNS = 5
+
+
+def _prepare_cli_startup(_data: BenchmarkInput) -> Run:
+    command = [sys.executable, "-c", "import importer.main"]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+
+    def run() -> int:
+        for _ in range(CLI_STARTUP_RUNS):
+            subprocess.run(command, env=env, check=True)
+        return CLI_STARTUP_RUNS
+
+    return run
+
+
+def _csv_dicts(data: BenchmarkInput) -> list[dict[str, str]]:
+    rows: list[dict[str, str]] = []
+    for device_dir in data.device_dirs:
+        for file in sorted(device_dir.glob("*.csv")):
+            with open(file, newline="", encoding="UTF-8") as csvfile:
+                rows.extend(csv.DictReader(csvfile))
+    return rows
+
+
+def _prepare_read_csv_files(data: BenchmarkInput) -> Run:
+    def run() -> int:
+        return sum(len(read_csv_files(device_dir)) for device_dir in data.device_dirs)
+
+    return run
+
+
+def _prepare_csv_row_from_dict(data: BenchmarkInput) -> Run:
+    rows = _csv_dicts(data)
+
+    def run() -> int:
+        for row in rows:
+            CsvRow.from_dict(row)
+        return len(rows)
+
+    return run
+
+
+def _prepare_csv_point_conversion(data: BenchmarkInput) -> Run:
+    rows = [CsvRow.from_dict(row) for row in _csv_dicts(data)]
+    converter = PointConverter()
+
+    def run() -> int:
+        return sum(len(list(converter.convert("device", row))) for row in rows)
+
+    return run
+
+
+def _prepare_csv_line_protocol(data: BenchmarkInput) -> Run:
+    converter = PointConverter()
+    points = [point for row in _csv_dicts(data) for point in converter.convert("device", CsvRow.from_dict(row))]
+
+    def run() -> int:
+        for point in points:
+            point.to_line_protocol()
+        return len(points)
+
+    return run
+
+
+def _prepare_csv_block_line_protocol(schema: Schema) -> Callable[[BenchmarkInput], Run]:
+    def prepare(data: BenchmarkInput) -> Run:
+        blocks = [read_csv_files(device_dir) for device_dir in data.device_dirs]
+        converter = PointConverter(schema)
+
+        def run() -> int:
+            count = 0
+            for block in blocks:
+                for index in range(len(block)):
+                    count += len(converter.line_protocol("device", block, index))
+            return count
+
+        return run
+
+    return prepare
+
+
+def _frames(data: BenchmarkInput) -> list[str]:
+    return list(generate_notify_status_frames(data.layout.devices, data.events_per_device, data.layout.seed))
+
+
+def _prepare_event_parse(data: BenchmarkInput) -> Run:
+    frames = _frames(data)
+
+    def run() -> int:
+        for frame in frames:
+            NotifyStatusEvent.from_dict(fast_json.loads(frame))
+        return len(frames)
+
+    return run
+
+
+def _prepare_event_parse_reference(data: BenchmarkInput) -> Run:
+    """Parsing as before the optimized decoder: stdlib json and the intermediate EnergyMeterStatusRaw"""
+    frames = _frames(data)
+
+    def run() -> int:
+        for frame in frames:
+            params = json.loads(frame)["params"]
+            datetime.datetime.fromtimestamp(float(params["ts"]), tz=datetime.timezone.utc)
+            em_data = params["em:0"]
+            em_data["user_calibrated_phase"] = []
+            EnergyMeterStatus.from_raw(EnergyMeterStatusRaw.from_dict(em_data))
+        return len(frames)
+
+    return run
+
+
+def _prepare_event_json_decode(data: BenchmarkInput) -> Run:
+    frames = _frames(data)
+
+    def run() -> int:
+        for frame in frames:
+            fast_json.loads(frame)
+        return len(frames)
+
+    return run
+
+
+def _prepare_event_point_conversion(schema: Schema) -> Callable[[BenchmarkInput], Run]:
+    def prepare(data: BenchmarkInput) -> Run:
+        frames = generate_notify_status_frames(data.layout.devices, data.events_per_device, data.layout.seed)
+        events = [NotifyStatusEvent.from_dict(json.loads(frame)) for frame in frames]
+        converter = PointConverter(schema)
+
+        def run() -> int:
+            count = 0
+            for event in events:
+                for point in converter.convert("device", event):
+                    point.to_line_protocol()
+                    count += 1
+            return count
+
+        return run
+
+    return prepare
+
+
+def _prepare_event_aggregation(data: BenchmarkInput) -> Run:
+    """Aggregate events into windows of 10 seconds like `live --aggregate 10s`"""
+    events = [NotifyStatusEvent.from_dict(json.loads(frame)) for frame in _frames(data)]
+
+    def run() -> int:
+        aggregator = EventAggregator(datetime.timedelta(seconds=10))
+        for event in events:
+            aggregator.add(event.src, event)
+        aggregator.flush()
+        return len(events)
+
+    return run
+
+
+def _prepare_event_deadband(data: BenchmarkInput) -> Run:
+    """Filter events with the default deadband rules like `live --deadband`"""
+    events = [NotifyStatusEvent.from_dict(json.loads(frame)) for frame in _frames(data)]
+
+    def run() -> int:
+        deadband = DeadbandFilter(DeadbandConfig(DEFAULT_RULES))
+        for event in events:
+            deadband.filter(event.src, event)
+        return len(events)
+
+    return run
+
+
+def _device_sources(data: BenchmarkInput) -> list[DeviceDataSource]:
+    return [DeviceDataSource(device_dir, device_dir.name) for device_dir in data.device_dirs]
+
+
+def _prepare_analyze_load(data: BenchmarkInput) -> Run:
+    sources = _device_sources(data)
+
+    def run() -> int:
+        return len(read_data(sources).df.select("timestamp").collect())
+
+    return run
+
+
+def _prepare_analyze_load_cached(data: BenchmarkInput) -> Run:
+    sources = _device_sources(data)
+    cache_dir = data.data_dir / "analyze-cache"
+    read_data(sources, cache_dir=cache_dir)
+
+    def run() -> int:
+        return len(read_data(sources, cache_dir=cache_dir).df.select("timestamp").collect())
+
+    return run
+
+
+def _prepare_analyze_load_filtered(data: BenchmarkInput) -> Run:
+    """Load only the last day and the active power columns"""
+    sources = _device_sources(data)
+    end = START + datetime.timedelta(days=data.layout.days)
+    start = end - datetime.timedelta(days=1)
+    for source in sources:
+        CsvIndex.open(source.data_dir)
+
+    def run() -> int:
+        device_data = PolarDeviceData.load(sources, start=start, end=end, columns=["max_act_power"])
+        return len(device_data.df)
+
+    return run
+
+
+def _many_small_files(data: BenchmarkInput) -> list[DeviceDataSource]:
+    """Four times the devices of the layout, each with one file per hour"""
+    layout = data.layout._replace(devices=data.layout.devices * 4, files_per_device=data.layout.days * 24)
+    target_dir = data.data_dir / "many-small-files"
+    if not target_dir.exists():
+        write_csv_files(target_dir, layout)
+    return [DeviceDataSource(target_dir / layout.device_name(i), layout.device_name(i)) for i in range(layout.devices)]
+
+
+def _prepare_analyze_load_many_files(max_workers: int) -> Callable[[BenchmarkInput], Run]:
+    def prepare(data: BenchmarkInput) -> Run:
+        sources = _many_small_files(data)
+        for source in sources:
+            CsvIndex.open(source.data_dir)
+
+        def run() -> int:
+            return len(read_data(sources, max_workers=max_workers).df.select("timestamp").collect())
+
+        return run
+
+    return prepare
+
+
+def _prepare_analyze_phase_data(data: BenchmarkInput) -> Run:
+    device_data = PolarDeviceData.load(_device_sources(data))
+    device_data.df  # pylint: disable=pointless-statement
+
+    def run() -> int:
+        return len(device_data.phase_data.collect())
+
+    return run
+
+
+STAGES = [
+    Stage("cli_startup", "starts", _prepare_cli_startup),
+    Stage("read_csv_files", "rows", _prepare_read_csv_files),
+    Stage("csv_row_from_dict", "rows", _prepare_csv_row_from_dict),
+    Stage("csv_point_conversion", "points", _prepare_csv_point_conversion),
+    Stage("csv_line_protocol", "points", _prepare_csv_line_protocol),
+    Stage("csv_block_line_protocol", "points", _prepare_csv_block_line_protocol(Schema.NARROW)),
+    Stage("csv_block_line_protocol_wide", "rows", _prepare_csv_block_line_protocol(Schema.WIDE)),
+    Stage("event_json_decode", "frames", _prepare_event_json_decode),
+    Stage("event_parse", "frames", _prepare_event_parse),
+    Stage("event_parse_reference", "frames", _prepare_event_parse_reference),
+    Stage("event_point_conversion", "points", _prepare_event_point_conversion(Schema.NARROW)),
+    Stage("event_point_conversion_wide", "events", _prepare_event_point_conversion(Schema.WIDE)),
+    Stage("event_aggregation", "events", _prepare_event_aggregation),
+    Stage("event_deadband", "events", _prepare_event_deadband),
+    Stage("analyze_load", "rows", _prepare_analyze_load),
+    Stage("analyze_load_cached", "rows", _prepare_analyze_load_cached),
+    Stage("analyze_load_filtered", "rows", _prepare_analyze_load_filtered),
+    Stage("analyze_load_many_files", "rows", _prepare_analyze_load_many_files(LOAD_WORKERS)),
+    Stage("analyze_load_many_files_sequential", "rows", _prepare_analyze_load_many_files(1)),
+    Stage("analyze_phase_data", "rows", _prepare_analyze_phase_data),
+]
+
+
+def get_stage(name: str) -> Stage:
+    for stage in STAGES:
+        if stage.name == name:
+            return stage
+    raise ValueError(f"Unknown stage '{name}'. Use one of {[stage.name for stage in STAGES]}")
+
+
+def run_stage(stage: Stage, data: BenchmarkInput) -> StageResult:
+    run = stage.prepare(data)
+    max_rss_before = _max_rss_bytes()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    items = run()
+    wall_seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - start_cpu
+    return StageResult(
+        stage=stage.name,
+        unit=stage.unit,
+        items=items,
+        wall_seconds=wall_seconds,
+        cpu_seconds=cpu_seconds,
+        max_rss_before_bytes=max_rss_before,
+        max_rss_bytes=_max_rss_bytes(),
+    )
+
+
+def run_stage_by_name(stage_name: str, data: BenchmarkInput) -> StageResult:
+    return run_stage(get_stage(stage_name), data)
+
+
+def _max_rss_bytes() -> int:
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,31 @@
+from pathlib import Path
+
+import pytest
+
+from benchmark.generators import CsvLayout, write_csv_files
+from benchmark.stages import STAGES, BenchmarkInput, get_stage, run_stage
+
+LAYOUT = CsvLayout(devices=2, days=1, files_per_device=2, seed=1)
+
+
+@pytest.fixture(name="data", scope="module")
+def data_fixture(tmp_path_factory: pytest.TempPathFactory) -> BenchmarkInput:
+    data_dir: Path = tmp_path_factory.mktemp("benchmark")
+    write_csv_files(data_dir, LAYOUT)
+    return BenchmarkInput(data_dir=data_dir, layout=LAYOUT, events_per_device=10)
+
+
+@pytest.mark.parametrize("stage_name", [stage.name for stage in STAGES])
+def test_run_stage(data: BenchmarkInput, stage_name: str):
+    result = run_stage(get_stage(stage_name), data)
+    assert result.stage == stage_name
+    assert result.items > 0
+    assert result.wall_seconds > 0
+    assert result.items_per_second > 0
+    assert result.max_rss_bytes >= result.max_rss_before_bytes > 0
+    assert result.to_dict()["items_per_second"] == result.items_per_second
+
+
+def test_get_stage_unknown():
+    with pytest.raises(ValueError, match="Unknown stage 'unknown'"):
+        get_stage("unknown")
@@ -0,0 +1,157 @@
+import datetime
+import threading
+from typing import Iterable, Optional
+
+from influxdb_client import Point, WritePrecision
+
+from importer.logger import MAIN_LOGGER
+from importer.model import NotifyStatusEvent
+
+logger = MAIN_LOGGER.getChild("aggregation")
+
+EDGE_AGGREGATES = ["mean", "min", "max", "last"]
+"""Values of the agg tag of aggregated live points. mean, min and max match the downsampling tiers."""
+
+PHASE_FIELDS = ["current", "voltage", "act_power", "aprt_power", "pf", "freq"]
+TOTAL_FIELDS = ["current", "act_power", "aprt_power"]
+
+
+class _FieldStats:
+    __slots__ = ("count", "total", "minimum", "maximum", "last")
+
+    def __init__(self, value: float) -> None:
+        self.count = 1
+        self.total = value
+        self.minimum = value
+        self.maximum = value
+        self.last = value
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.last = value
+
+    def value(self, aggregate: str) -> float:
+        if aggregate == "mean":
+            return self.total / self.count
+        if aggregate == "min":
+            return self.minimum
+        if aggregate == "max":
+            return self.maximum
+        return self.last
+
+
+class _Window:
+    __slots__ = ("start", "series")
+
+    def __init__(self, start: int) -> None:
+        self.start = start
+        self.series: dict[str, dict[str, _FieldStats]] = {}
+        """Statistics per phase and field"""
+
+    def add(self, phase: str, field: str, value: Optional[float]) -> None:
+        if value is None:
+            return
+        fields = self.series.setdefault(phase, {})
+        stats = fields.get(field)
+        # Always write floats, InfluxDB rejects fields whose type changes
+        if stats is None:
+            fields[field] = _FieldStats(float(value))
+        else:
+            stats.add(float(value))
+
+
+def event_values(event: NotifyStatusEvent) -> Iterable[tuple[str, str, Optional[float]]]:
+    """Phase, field and value of each value of an event, as written by EventPointConverter"""
+    status = event.status
+    for phase in status.phases:
+        for field in PHASE_FIELDS:
+            yield phase.phase_name, field, getattr(phase, field)
+    yield "neutral", "current", status.n_current
+    for field in TOTAL_FIELDS:
+        yield "total", field, getattr(status, f"total_{field}")
+
+
+class EventAggregator:
+    """Aggregates the live events of each device into windows of fixed length aligned to the epoch.
+
+    For each window, device, phase and field the mean, minimum, maximum and last value is emitted as point with the
+    agg tag, timestamped with the start of the window. A window is emitted when the device sends an event for a later
+    window, or when any device has reached the window after next, so silent devices do not hold back their data.
+    Events arriving late for an already emitted window are added to the device's current window, or to the window
+    after the emitted one if the device has no open window, so an emitted aggregate is never overwritten."""
+
+    def __init__(self, window: datetime.timedelta) -> None:
+        self.window = int(window.total_seconds())
+        if self.window < 1:
+            raise ValueError(f"Aggregation window must be at least one second, got {window}")
+        self._windows: dict[str, _Window] = {}
+        self._emitted: dict[str, int] = {}
+        """Start of the last emitted window per device"""
+        self._latest_start = 0
+        self._lock = threading.Lock()
+        self.events = 0
+        self.points = 0
+
+    def add(self, device: str, event: NotifyStatusEvent) -> list[Point]:
+        """Add an event and return the points of the windows completed by it. Thread-safe."""
+        with self._lock:
+            return self._add(device, event)
+
+    def _add(self, device: str, event: NotifyStatusEvent) -> list[Point]:
+        timestamp = int(event.timestamp.timestamp())
+        start = timestamp - timestamp % self.window
+        emitted = self._emitted.get(device)
+        if emitted is not None and start <= emitted:
+            start = emitted + self.window
+        points: list[Point] = []
+        window = self._windows.get(device)
+        if window is None or start > window.start:
+            if window is not None:
+                points.extend(self._points(device, window))
+            window = _Window(start)
+            self._windows[device] = window
+        for phase, field, value in event_values(event):
+            window.add(phase, field, value)
+        self.events += 1
+        if start > self._latest_start:
+            self._latest_start = start
+            points.extend(self._close_expired(start - self.window))
+        return points
+
+    def flush(self) -> list[Point]:
+        """Return the points of all open windows"""
+        with self._lock:
+            points = [point for device, window in self._windows.items() for point in self._points(device, window)]
+            self._windows.clear()
+            return points
+
+    def _close_expired(self, before: int) -> list[Point]:
+        expired = [device for device, window in self._windows.items() if window.start < before]
+        points = []
+        for device in expired:
+            logger.debug(f"Closing window of silent device {device}")
+            points.extend(self._points(device, self._windows.pop(device)))
+        return points
+
+    def _points(self, device: str, window: _Window) -> list[Point]:
+        self._emitted[device] = window.start
+        timestamp = datetime.datetime.fromtimestamp(window.start, tz=datetime.timezone.utc)
+        points = []
+        for phase, fields in window.series.items():
+            for aggregate in EDGE_AGGREGATES:
+                point = (
+                    Point("em")
+                    .tag("device", device)
+                    .tag("source", "live")
+                    .tag("phase", phase)
+                    .tag("agg", aggregate)
+                    .time(timestamp, write_precision=WritePrecision.S)
+                )
+                for field, stats in fields.items():
+                    point.field(field, stats.value(aggregate))
+                points.append(point)
+        self.points += len(points)
+        return points
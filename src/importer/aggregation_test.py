@@ -0,0 +1,143 @@
+import datetime
+from unittest.mock import Mock
+
+import pytest
+
+from importer.aggregation import EDGE_AGGREGATES, EventAggregator
+from importer.db.influx import BatchWriter
+from importer.db.influx_converter import PointConverter
+from importer.model import EnergyMeterPhase, EnergyMeterStatus, NotifyStatusEvent
+
+START = datetime.datetime(2024, 10, 1, tzinfo=datetime.timezone.utc)
+START_TS = int(START.timestamp())
+
+
+def _event(second: int, act_power: float, n_current: float | None = 0.5) -> NotifyStatusEvent:
+    phases = [
+        EnergyMeterPhase(
+            phase_name=phase,
+            current=1.0,
+            voltage=230.0,
+            act_power=act_power,
+            aprt_power=2.0,
+            pf=1,
+            freq=50.0,
+            errors=[],
+        )
+        for phase in ["a", "b", "c"]
+    ]
+    return NotifyStatusEvent(
+        timestamp=START + datetime.timedelta(seconds=second),
+        src="src",
+        status=EnergyMeterStatus(
+            id=0,
+            phases=phases,
+            n_current=n_current,
+            n_errors=[],
+            total_current=3.0,
+            total_act_power=3 * act_power,
+            total_aprt_power=6.0,
+            user_calibrated_phase=[],
+            errors=[],
+        ),
+    )
+
+
+def _lines(points) -> list[str]:
+    return [point.to_line_protocol() for point in points]
+
+
+def test_aggregate_window():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    for second, power in enumerate([10.0, 30.0, 20.0]):
+        assert not aggregator.add("dev", _event(second, power))
+    lines = _lines(aggregator.add("dev", _event(10, 5.0)))
+    assert len(lines) == 5 * len(EDGE_AGGREGATES)
+    assert (
+        f"em,agg=max,device=dev,phase=a,source=live act_power=30,aprt_power=2,current=1,freq=50,pf=1,voltage=230 "
+        f"{START_TS}" in lines
+    )
+    assert f"em,agg=mean,device=dev,phase=total,source=live act_power=60,aprt_power=6,current=3 {START_TS}" in lines
+    assert f"em,agg=min,device=dev,phase=total,source=live act_power=30,aprt_power=6,current=3 {START_TS}" in lines
+    assert "em,agg=last,device=dev,phase=b,source=live act_power=20" in " ".join(lines)
+    assert f"em,agg=mean,device=dev,phase=neutral,source=live current=0.5 {START_TS}" in lines
+    remaining = _lines(aggregator.flush())
+    assert f"em,agg=max,device=dev,phase=total,source=live act_power=15,aprt_power=6,current=3 {START_TS + 10}" in (
+        remaining
+    )
+    assert not aggregator.flush()
+    assert (aggregator.events, aggregator.points) == (4, 2 * 5 * len(EDGE_AGGREGATES))
+
+
+def test_aggregate_without_neutral_current():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    aggregator.add("dev", _event(0, 1.0, n_current=None))
+    assert "neutral" not in " ".join(_lines(aggregator.flush()))
+
+
+def test_aggregate_devices_separately():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    aggregator.add("dev1", _event(1, 10.0))
+    aggregator.add("dev2", _event(2, 20.0))
+    points = _lines(aggregator.add("dev1", _event(11, 10.0)))
+    assert points and all("device=dev1" in line for line in points)
+    assert all("device=dev2" in line for line in _lines(aggregator.flush()) if f" {START_TS}" in line)
+
+
+def test_silent_device_window_is_closed():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    aggregator.add("silent", _event(1, 10.0))
+    aggregator.add("active", _event(2, 10.0))
+    assert all("device=active" in line for line in _lines(aggregator.add("active", _event(12, 10.0))))
+    closed = _lines(aggregator.add("active", _event(22, 10.0)))
+    assert any("device=silent" in line for line in closed)
+
+
+def test_late_event_is_added_to_current_window():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    aggregator.add("dev", _event(1, 10.0))
+    aggregator.add("dev", _event(11, 10.0))
+    assert not aggregator.add("dev", _event(9, 99.0))
+    assert f"em,agg=max,device=dev,phase=total,source=live act_power=297,aprt_power=6,current=3 {START_TS + 10}" in (
+        _lines(aggregator.flush())
+    )
+
+
+def test_late_event_does_not_overwrite_closed_window():
+    aggregator = EventAggregator(datetime.timedelta(seconds=10))
+    aggregator.add("silent", _event(1, 10.0))
+    aggregator.add("active", _event(2, 10.0))
+    aggregator.add("active", _event(12, 10.0))
+    closed = _lines(aggregator.add("active", _event(22, 10.0)))
+    assert f"em,agg=max,device=silent,phase=total,source=live act_power=30,aprt_power=6,current=3 {START_TS}" in closed
+    # The window of the late event was emitted already, its values go to the next window
+    assert not aggregator.add("silent", _event(5, 99.0))
+    late = [line for line in _lines(aggregator.flush()) if "device=silent" in line]
+    assert f"em,agg=max,device=silent,phase=total,source=live act_power=297,aprt_power=6,current=3 {START_TS + 10}" in (
+        late
+    )
+    assert not any(line.endswith(f" {START_TS}") for line in late)
+
+
+def test_invalid_window():
+    with pytest.raises(ValueError, match="at least one second"):
+        EventAggregator(datetime.timedelta(milliseconds=500))
+
+
+def test_batch_writer_aggregates_and_keeps_raw_events():
+    write_api = Mock()
+    write_api.write.return_value = None
+    writer = BatchWriter(
+        PointConverter(),
+        write_api,
+        bucket="em",
+        aggregator=EventAggregator(datetime.timedelta(seconds=10)),
+        raw_bucket="em_live_raw",
+    )
+    for second in range(20):
+        writer.insert_status_event("dev", _event(second, 10.0))
+    writer.close()
+    buckets = [call.kwargs["bucket"] for call in write_api.write.call_args_list]
+    assert buckets.count("em_live_raw") == 20 * 5
+    assert buckets.count("em") == 2 * 5 * len(EDGE_AGGREGATES)
+    write_api.close.assert_called_once()
@@ -0,0 +1,140 @@
+import contextlib
+import datetime
+import os
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from importer.csv_index import RECORD_PERIOD, CsvFileIndex, CsvIndex
+from importer.logger import MAIN_LOGGER
+
+logger = MAIN_LOGGER.getChild("compaction")
+
+ARCHIVE_DIR_NAME = "compacted"
+"""Sub directory of a device directory receiving the files replaced by a compaction"""
+
+
+class CompactionResult(NamedTuple):
+    device_dir: Path
+    files: int
+    """Number of CSV files before the compaction"""
+    covered: list[str]
+    """Files whose rows are all contained in the required files"""
+    required: list[str]
+    """Minimal set of files containing all rows, merged into the target file"""
+    target_file: Optional[Path]
+    """Merged file, None if there was nothing to merge or for a dry run"""
+    rows: int
+    """Rows of the target file, without duplicates also for a dry run"""
+    size_before: int
+    size_after: int
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.covered) or len(self.required) > 1
+
+
+def compact_device_dir(device_dir: Path, dry_run: bool = False, max_gap: int = RECORD_PERIOD) -> CompactionResult:
+    """Replace the CSV files of a device directory by a single file containing each row once.
+
+    The required files are merged in the order of their time ranges, copying each row verbatim unless an earlier
+    file already contained its timestamp. The merged file is written atomically, then the original files are moved
+    to the ARCHIVE_DIR_NAME sub directory. All files must be sorted by timestamp and have the same header."""
+    index = CsvIndex.open(device_dir)
+    covered = index.covered_files(max_gap)
+    required = sorted(
+        (entry for entry in index.files.values() if entry.file not in covered),
+        key=lambda entry: (entry.first_timestamp, entry.file),
+    )
+    result = CompactionResult(
+        device_dir=device_dir,
+        files=len(index.files),
+        covered=covered,
+        required=[entry.file for entry in required],
+        target_file=None,
+        rows=sum(entry.rows for entry in required),
+        size_before=sum(entry.size for entry in index.files.values()),
+        size_after=sum(entry.size for entry in required),
+    )
+    if not result.changed:
+        logger.info(f"Nothing to compact in {device_dir}")
+        return result
+    _check_mergeable(device_dir, required)
+    if dry_run:
+        if len(required) > 1:
+            # Overlapping files contain rows more than once, count the rows the merge would write
+            rows, size_after = _merge(device_dir, required, target_file=None)
+            result = result._replace(rows=rows, size_after=size_after)
+        return result
+
+    target_file: Optional[Path] = None
+    rows = result.rows
+    if len(required) > 1:
+        file_name_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        target_file = device_dir / f"{device_dir.name}_{file_name_timestamp}_compacted.csv"
+        rows, _size = _merge(device_dir, required, target_file)
+    archive_dir = device_dir / ARCHIVE_DIR_NAME
+    archive_dir.mkdir(exist_ok=True)
+    for name in covered + (result.required if target_file is not None else []):
+        os.replace(device_dir / name, archive_dir / name)
+    CsvIndex.open(device_dir)
+    size_after = target_file.stat().st_size if target_file is not None else result.size_after
+    logger.info(
+        f"Compacted {result.files} files ({result.size_before} bytes) in {device_dir} "
+        f"to {target_file or result.required[0]} with {rows} rows ({size_after} bytes)"
+    )
+    return result._replace(target_file=target_file, rows=rows, size_after=size_after)
+
+
+def _check_mergeable(device_dir: Path, files: list[CsvFileIndex]) -> None:
+    unsorted = [entry.file for entry in files if not entry.hours]
+    if unsorted:
+        raise ValueError(f"Cannot compact {device_dir}, files {unsorted} are not sorted by timestamp")
+    headers = {_read_header(device_dir / entry.file) for entry in files}
+    if len(headers) > 1:
+        raise ValueError(f"Cannot compact {device_dir}, the files have different headers")
+
+
+def _read_header(path: Path) -> bytes:
+    with open(path, "rb") as file:
+        return file.readline().rstrip(b"\r\n")
+
+
+def _merge(device_dir: Path, files: list[CsvFileIndex], target_file: Optional[Path]) -> tuple[int, int]:
+    """Write the header and the rows of the files with increasing timestamps to the target file, or only count them
+    without target file. Returns the number of rows and bytes of the merged file."""
+    rows = size = 0
+    with contextlib.ExitStack() as stack:
+        target = None
+        if target_file is not None:
+            temp_file = target_file.with_suffix(".tmp")
+            target = stack.enter_context(open(temp_file, "wb"))
+        for line in _merged_lines(device_dir, files):
+            if target is not None:
+                target.write(line)
+            size += len(line)
+            rows += 1
+    if target_file is not None:
+        os.replace(temp_file, target_file)
+    # The first line is the header
+    return rows - 1, size
+
+
+def _merged_lines(device_dir: Path, files: list[CsvFileIndex]) -> Iterator[bytes]:
+    last_timestamp: Optional[int] = None
+    for entry in files:
+        with open(device_dir / entry.file, "rb") as source:
+            header = source.readline()
+            if entry is files[0]:
+                yield header
+            column = header.decode().strip().split(",").index("timestamp")
+            if last_timestamp is not None:
+                # Continue at the hour of the first new row instead of reading the overlap
+                hour = max((hour for hour in entry.hours if hour.timestamp <= last_timestamp), default=None)
+                source.seek(hour.offset if hour is not None else entry.data_offset)
+            for line in source:
+                if not line.strip():
+                    continue
+                timestamp = int(line.split(b",", column + 1)[column])
+                if last_timestamp is None or timestamp > last_timestamp:
+                    yield line if line.endswith(b"\n") else line + b"\n"
+                    last_timestamp = timestamp
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import pytest
+
+from importer.compaction import ARCHIVE_DIR_NAME, compact_device_dir
+from importer.csv_index import INDEX_FILE_NAME, CsvIndex
+from importer.csv_index_test import HOUR, START, _minutes, _write_csv
+from importer.main import read_csv_files
+
+
+def _lines(path: Path) -> list[str]:
+    return path.read_text(encoding="UTF-8").splitlines()
+
+
+def _device_dir(tmp_path: Path) -> Path:
+    device_dir = tmp_path / "device"
+    device_dir.mkdir()
+    _write_csv(device_dir / "a.csv", _minutes(START, 3 * 60))
+    _write_csv(device_dir / "b.csv", _minutes(START + HOUR, 60))
+    _write_csv(device_dir / "c.csv", _minutes(START + 2 * HOUR, 3 * 60))
+    return device_dir
+
+
+def test_compact_device_dir(tmp_path: Path):
+    device_dir = _device_dir(tmp_path)
+    expected = [view.to_row() for view in read_csv_files(device_dir)]
+    lines = _lines(device_dir / "a.csv") + _lines(device_dir / "c.csv")[61:]
+
+    result = compact_device_dir(device_dir)
+
+    assert result.covered == ["b.csv"]
+    assert result.required == ["a.csv", "c.csv"]
+    assert result.rows == 5 * 60
+    assert result.target_file is not None
+    assert sorted(path.name for path in device_dir.glob("*.csv")) == [result.target_file.name]
+    assert sorted(path.name for path in (device_dir / ARCHIVE_DIR_NAME).iterdir()) == ["a.csv", "b.csv", "c.csv"]
+    assert _lines(result.target_file) == lines
+    assert result.size_after == result.target_file.stat().st_size
+    assert list(CsvIndex.load(device_dir).files) == [result.target_file.name]
+    assert [view.to_row() for view in read_csv_files(device_dir)] == expected
+
+
+def test_compact_device_dir_only_moves_covered_files(tmp_path: Path):
+    device_dir = tmp_path / "device"
+    device_dir.mkdir()
+    _write_csv(device_dir / "a.csv", _minutes(START, 3 * 60))
+    _write_csv(device_dir / "b.csv", _minutes(START + HOUR, 60))
+    result = compact_device_dir(device_dir)
+    assert result.target_file is None
+    assert sorted(path.name for path in device_dir.iterdir()) == ["a.csv", ARCHIVE_DIR_NAME, INDEX_FILE_NAME]
+    assert not compact_device_dir(device_dir).changed
+
+
+def test_compact_device_dir_dry_run(tmp_path: Path):
+    device_dir = _device_dir(tmp_path)
+    result = compact_device_dir(device_dir, dry_run=True)
+    assert result.changed
+    assert result.covered == ["b.csv"]
+    assert result.target_file is None
+    assert sorted(path.name for path in device_dir.glob("*.csv")) == ["a.csv", "b.csv", "c.csv"]
+    assert not (device_dir / ARCHIVE_DIR_NAME).exists()
+    # a.csv and c.csv overlap by one hour, the merged file contains those rows once
+    compacted = compact_device_dir(device_dir)
+    assert result.rows == compacted.rows == 5 * 60
+    assert result.size_after == compacted.size_after
+
+
+def test_compact_device_dir_unsorted_file(tmp_path: Path):
+    device_dir = _device_dir(tmp_path)
+    _write_csv(device_dir / "d.csv", [START + 6 * HOUR, START + 5 * HOUR])
+    with pytest.raises(ValueError, match="not sorted"):
+        compact_device_dir(device_dir)
+    assert sorted(path.name for path in device_dir.glob("*.csv")) == ["a.csv", "b.csv", "c.csv", "d.csv"]
@@ -0,0 +1,155 @@
+import datetime
+from array import array
+from typing import Any, Iterable, Iterator, Sequence
+
+from importer.model import CsvRow, Phase, PhaseData
+
+PHASES = [Phase.A, Phase.B, Phase.C]
+PHASE_FIELDS: tuple[str, ...] = PhaseData._fields[1:]
+NEUTRAL_FIELDS = ("n_max_current", "n_min_current", "n_avg_current")
+COLUMNS: tuple[str, ...] = (
+    *(f"{phase.value}_{field}" for phase in PHASES for field in PHASE_FIELDS),
+    *NEUTRAL_FIELDS,
+)
+"""Measurement columns in the order they are stored per row"""
+ROW_WIDTH = len(COLUMNS)
+NEUTRAL_OFFSET = len(PHASES) * len(PHASE_FIELDS)
+
+
+class _Field:
+    """Reads a float at a fixed offset relative to the view's position in the block"""
+
+    def __init__(self, offset: int) -> None:
+        self._offset = offset
+
+    def __get__(self, view: Any, _owner: Any = None) -> float:
+        value: float = view._values[view._offset + self._offset]
+        return value
+
+
+class PhaseView:
+    """Lightweight view on the values of one phase in a CsvRowBlock, with the same attributes as PhaseData"""
+
+    __slots__ = ("phase_name", "_values", "_offset")
+    _fields = PhaseData._fields
+
+    total_act_energy = _Field(0)
+    fund_act_energy = _Field(1)
+    total_act_ret_energy = _Field(2)
+    fund_act_ret_energy = _Field(3)
+    lag_react_energy = _Field(4)
+    lead_react_energy = _Field(5)
+    max_act_power = _Field(6)
+    min_act_power = _Field(7)
+    max_aprt_power = _Field(8)
+    min_aprt_power = _Field(9)
+    max_voltage = _Field(10)
+    min_voltage = _Field(11)
+    avg_voltage = _Field(12)
+    max_current = _Field(13)
+    min_current = _Field(14)
+    avg_current = _Field(15)
+
+    def __init__(self, phase_name: Phase, values: array, offset: int) -> None:
+        self.phase_name = phase_name
+        self._values = values
+        self._offset = offset
+
+    def to_phase_data(self) -> PhaseData:
+        return PhaseData(self.phase_name, *self._values[self._offset : self._offset + len(PHASE_FIELDS)])
+
+
+class CsvRowView:
+    """Lightweight view on one row of a CsvRowBlock, with the same attributes as CsvRow"""
+
+    __slots__ = ("epoch", "_values", "_offset")
+
+    n_max_current = _Field(NEUTRAL_OFFSET)
+    n_min_current = _Field(NEUTRAL_OFFSET + 1)
+    n_avg_current = _Field(NEUTRAL_OFFSET + 2)
+
+    def __init__(self, epoch: int, values: array, offset: int) -> None:
+        self.epoch = epoch
+        """Timestamp in seconds since the epoch"""
+        self._values = values
+        self._offset = offset
+
+    @property
+    def timestamp(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.epoch, tz=datetime.timezone.utc)
+
+    @property
+    def phases(self) -> list[PhaseView]:
+        return [
+            PhaseView(phase, self._values, self._offset + index * len(PHASE_FIELDS))
+            for index, phase in enumerate(PHASES)
+        ]
+
+    def to_row(self) -> CsvRow:
+        return CsvRow(
+            timestamp=self.timestamp,
+            phases=[phase.to_phase_data() for phase in self.phases],
+            n_max_current=self.n_max_current,
+            n_min_current=self.n_min_current,
+            n_avg_current=self.n_avg_current,
+        )
+
+
+class CsvRowBlock:
+    """Rows of CSV data stored in two flat arrays: epoch seconds (int64) and ROW_WIDTH measurements (float64) per row.
+    Needs about 420 bytes per row instead of more than 1 KiB for CsvRow with its PhaseData tuples."""
+
+    def __init__(self) -> None:
+        self.timestamps = array("q")
+        self.values = array("d")
+
+    @classmethod
+    def from_csv(cls, header: Sequence[str], rows: Iterable[Sequence[str]]) -> "CsvRowBlock":
+        """Create a block from CSV rows as returned by csv.reader, header contains the column names"""
+        block = cls()
+        timestamp_index = list(header).index("timestamp")
+        indices = [list(header).index(column) for column in COLUMNS]
+        for row in rows:
+            block.timestamps.append(int(row[timestamp_index]))
+            block.values.extend([float(row[index]) for index in indices])
+        return block
+
+    @classmethod
+    def from_dicts(cls, rows: Iterable[dict[str, str]]) -> "CsvRowBlock":
+        block = cls()
+        for row in rows:
+            block.timestamps.append(int(row["timestamp"]))
+            block.values.extend([float(row[column]) for column in COLUMNS])
+        return block
+
+    def extend(self, other: "CsvRowBlock") -> None:
+        self.timestamps.extend(other.timestamps)
+        self.values.extend(other.values)
+
+    def unique(self) -> "CsvRowBlock":
+        """Remove rows with duplicate timestamps. Rows keep the position of the first and the values of the last
+        occurrence of their timestamp."""
+        last_index = {timestamp: index for index, timestamp in enumerate(self.timestamps)}
+        if len(last_index) == len(self):
+            return self
+        block = CsvRowBlock()
+        for timestamp, index in last_index.items():
+            block.timestamps.append(timestamp)
+            block.values.extend(self.values[index * ROW_WIDTH : (index + 1) * ROW_WIDTH])
+        return block
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.itemsize * len(self.timestamps) + self.values.itemsize * len(self.values)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index: int) -> CsvRowView:
+        if index < 0:
+            index += len(self)
+        return CsvRowView(self.timestamps[index], self.values, index * ROW_WIDTH)
+
+    def __iter__(self) -> Iterator[CsvRowView]:
+        for index, timestamp in enumerate(self.timestamps):
+            yield CsvRowView(timestamp, self.values, index * ROW_WIDTH)
@@ -0,0 +1,83 @@
+import csv
+import io
+
+import pytest
+
+from importer.csv_block import COLUMNS, ROW_WIDTH, CsvRowBlock
+from importer.model import ALL_FIELD_NAMES, CsvRow, Phase
+
+HEADER = ["timestamp", *sorted(ALL_FIELD_NAMES - {"timestamp"})]
+
+
+def _csv_rows(timestamps: list[int]) -> list[dict[str, str]]:
+    return [
+        {"timestamp": str(timestamp), **{column: f"{row + index / 8:.3f}" for index, column in enumerate(COLUMNS)}}
+        for row, timestamp in enumerate(timestamps)
+    ]
+
+
+def _block(rows: list[dict[str, str]]) -> CsvRowBlock:
+    content = io.StringIO()
+    writer = csv.DictWriter(content, fieldnames=HEADER)
+    writer.writeheader()
+    writer.writerows(rows)
+    reader = csv.reader(io.StringIO(content.getvalue()))
+    return CsvRowBlock.from_csv(next(reader), reader)
+
+
+def test_from_csv():
+    rows = _csv_rows([1716140640, 1716140700])
+    block = _block(rows)
+    assert len(block) == 2
+    assert list(block.timestamps) == [1716140640, 1716140700]
+    assert len(block.values) == 2 * ROW_WIDTH
+    assert block.nbytes == 2 * 8 + 2 * ROW_WIDTH * 8
+
+
+def test_from_dicts_equals_from_csv():
+    rows = _csv_rows([1716140640, 1716140700])
+    assert list(CsvRowBlock.from_dicts(rows).values) == list(_block(rows).values)
+
+
+def test_views_equal_csv_rows():
+    rows = _csv_rows([1716140640, 1716140700, 1716140760])
+    block = _block(rows)
+    assert [view.to_row() for view in block] == [CsvRow.from_dict(row) for row in rows]
+
+
+def test_view_attributes():
+    view = _block(_csv_rows([1716140640, 1716140700]))[1]
+    expected = CsvRow.from_dict(_csv_rows([1716140640, 1716140700])[1])
+    assert view.epoch == 1716140700
+    assert view.timestamp == expected.timestamp
+    assert [phase.phase_name for phase in view.phases] == [Phase.A, Phase.B, Phase.C]
+    assert view.phases[2].avg_current == expected.phases[2].avg_current
+    assert view.phases[1].total_act_energy == expected.phases[1].total_act_energy
+    assert view.n_avg_current == expected.n_avg_current
+
+
+def test_negative_index():
+    block = _block(_csv_rows([1716140640, 1716140700]))
+    assert block[-1].epoch == 1716140700
+    with pytest.raises(IndexError):
+        block[2]  # pylint: disable=pointless-statement
+
+
+def test_unique_keeps_first_position_and_last_values():
+    rows = _csv_rows([60, 120, 60, 180])
+    block = _block(rows).unique()
+    assert list(block.timestamps) == [60, 120, 180]
+    assert block[0].to_row() == CsvRow.from_dict(rows[2])
+    assert block[1].to_row() == CsvRow.from_dict(rows[1])
+
+
+def test_unique_without_duplicates_returns_same_block():
+    block = _block(_csv_rows([60, 120]))
+    assert block.unique() is block
+
+
+def test_extend():
+    block = _block(_csv_rows([60]))
+    block.extend(_block(_csv_rows([120, 180])))
+    assert list(block.timestamps) == [60, 120, 180]
+    assert len(block.values) == 3 * ROW_WIDTH
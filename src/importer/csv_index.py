@@ -0,0 +1,277 @@
+import datetime
+import itertools
+import json
+import os
+from pathlib import Path
+from typing import Any, BinaryIO, NamedTuple, Optional
+
+from importer.logger import MAIN_LOGGER
+
+logger = MAIN_LOGGER.getChild("csv_index")
+
+INDEX_FILE_NAME = "csv_index.json"
+INDEX_VERSION = 1
+SECONDS_PER_HOUR = 3600
+RECORD_PERIOD = 60
+"""Seconds between two rows of the CSV data"""
+
+
+class HourOffset(NamedTuple):
+    """Position of the first row of an hour in a CSV file"""
+
+    timestamp: int
+    """Start of the hour in seconds since the epoch"""
+    offset: int
+    """Byte offset of the row"""
+    row: int
+    """Number of the row, not counting the header"""
+
+
+class FileInterval(NamedTuple):
+    """Time range of the rows of a file"""
+
+    file: str
+    first_timestamp: int
+    last_timestamp: int
+    rows: int
+
+    @property
+    def is_continuous(self) -> bool:
+        """True if the file has a row for every record period of its time range"""
+        return self.rows >= (self.last_timestamp - self.first_timestamp) // RECORD_PERIOD + 1
+
+
+class CsvFileIndex(NamedTuple):
+    file: str
+    """File name relative to the device directory"""
+    size: int
+    mtime_ns: int
+    rows: int
+    first_timestamp: Optional[int]
+    last_timestamp: Optional[int]
+    data_offset: int
+    """Byte offset of the first row after the header"""
+    hours: list[HourOffset]
+    """Empty if the rows are not sorted by timestamp"""
+
+    def is_current(self, path: Path) -> bool:
+        stat = path.stat()
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    @property
+    def interval(self) -> Optional[FileInterval]:
+        if self.first_timestamp is None or self.last_timestamp is None:
+            return None
+        return FileInterval(
+            file=self.file, first_timestamp=self.first_timestamp, last_timestamp=self.last_timestamp, rows=self.rows
+        )
+
+    def overlaps(self, start: Optional[int], end: Optional[int]) -> bool:
+        if self.first_timestamp is None or self.last_timestamp is None:
+            return False
+        return (start is None or self.last_timestamp >= start) and (end is None or self.first_timestamp < end)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {**self._asdict(), "hours": [list(hour) for hour in self.hours]}  # pylint: disable=no-member
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "CsvFileIndex":
+        return cls(**{**data, "hours": [HourOffset(*hour) for hour in data["hours"]]})
+
+
+class CsvFileRange(NamedTuple):
+    """Rows of a CSV file that may contain data for a time range. The rows are a superset of the time range
+    at hour granularity, readers must still filter by timestamp."""
+
+    file: Path
+    data_offset: int
+    """Byte offset of the first row after the header"""
+    start_offset: int
+    end_offset: int
+    """Byte offset after the last row of the range"""
+    start_row: int
+    rows: int
+
+
+def find_covered_files(files: list[FileInterval], max_gap: int = RECORD_PERIOD) -> list[FileInterval]:
+    """Files that are not needed because a minimal set of the other files covers their time range.
+
+    All files of a device contain the same rows for the same timestamps, so a file is redundant if the union of the
+    time ranges of the required files includes its range. Ranges at most max_gap seconds apart count as continuous.
+    Only continuous files can cover others, a file with missing rows only knows the timestamps of its rows.
+    Of files covering the same range the one with more rows, then the one with the lower name is required.
+    Returns the redundant files sorted by first timestamp and name."""
+    candidates = sorted(
+        (f for f in files if f.is_continuous), key=lambda f: (f.first_timestamp, -f.last_timestamp, -f.rows, f.file)
+    )
+    required: set[str] = set()
+    ranges: list[tuple[int, int]] = []
+    reach: Optional[int] = None
+    index = 0
+    while index < len(candidates):
+        if reach is None or candidates[index].first_timestamp > reach + max_gap:
+            # Start of a new continuous range
+            best = candidates[index]
+            ranges.append((best.first_timestamp, best.last_timestamp))
+            index += 1
+        else:
+            # Of all files continuing the current range, require the one that extends it the furthest
+            best = candidates[index]
+            while index < len(candidates) and candidates[index].first_timestamp <= reach + max_gap:
+                if candidates[index].last_timestamp > best.last_timestamp:
+                    best = candidates[index]
+                index += 1
+            if best.last_timestamp <= reach:
+                continue
+        required.add(best.file)
+        reach = best.last_timestamp
+        ranges[-1] = (ranges[-1][0], reach)
+    covered = [
+        file
+        for file in files
+        if file.file not in required
+        and any(start <= file.first_timestamp and file.last_timestamp <= end for start, end in ranges)
+    ]
+    return sorted(covered, key=lambda f: (f.first_timestamp, f.file))
+
+
+def index_csv_file(path: Path) -> CsvFileIndex:
+    """Scan a CSV file and record its time range and the positions of hour boundaries"""
+    stat = path.stat()
+    with open(path, "rb") as file:
+        header = file.readline()
+        rows = _scan_timestamps(file, column=header.decode().strip().split(",").index("timestamp"), offset=len(header))
+    timestamps = [timestamp for _, timestamp in rows]
+    hours: list[HourOffset] = []
+    for row, (offset, timestamp) in enumerate(rows):
+        hour = timestamp - timestamp % SECONDS_PER_HOUR
+        if not hours or hours[-1].timestamp != hour:
+            hours.append(HourOffset(timestamp=hour, offset=offset, row=row))
+    return CsvFileIndex(
+        file=path.name,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        rows=len(rows),
+        first_timestamp=min(timestamps, default=None),
+        last_timestamp=max(timestamps, default=None),
+        data_offset=len(header),
+        hours=hours if all(a <= b for a, b in itertools.pairwise(timestamps)) else [],
+    )
+
+
+def _scan_timestamps(file: BinaryIO, column: int, offset: int) -> list[tuple[int, int]]:
+    """Byte offset and timestamp of each non-empty line"""
+    rows = []
+    for line in file:
+        if line.strip():
+            rows.append((offset, int(line.split(b",", column + 1)[column])))
+        offset += len(line)
+    return rows
+
+
+class CsvIndex:
+    """Sidecar index of the CSV files in a device directory, stored in INDEX_FILE_NAME.
+    Allows selecting the files and byte ranges overlapping a time range without reading all files."""
+
+    def __init__(self, device_dir: Path, files: Optional[dict[str, CsvFileIndex]] = None) -> None:
+        self.device_dir = device_dir
+        self.files: dict[str, CsvFileIndex] = files or {}
+
+    @property
+    def path(self) -> Path:
+        return self.device_dir / INDEX_FILE_NAME
+
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        """Newest timestamp of all indexed files, None if there are no rows"""
+        return max((entry.last_timestamp for entry in self.files.values() if entry.last_timestamp), default=None)
+
+    @classmethod
+    def load(cls, device_dir: Path) -> "CsvIndex":
+        """Load the index of the directory, an unreadable or outdated index is treated as empty"""
+        path = device_dir / INDEX_FILE_NAME
+        try:
+            data = json.loads(path.read_text(encoding="UTF-8"))
+        except FileNotFoundError:
+            return cls(device_dir)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable index {path}: {e}")
+            return cls(device_dir)
+        if data.get("version") != INDEX_VERSION:
+            logger.info(f"Ignoring index {path} with version {data.get('version')}")
+            return cls(device_dir)
+        return cls(device_dir, {entry["file"]: CsvFileIndex.from_dict(entry) for entry in data["files"]})
+
+    @classmethod
+    def open(cls, device_dir: Path) -> "CsvIndex":
+        """Load the index of the directory and bring it up to date with the CSV files"""
+        index = cls.load(device_dir)
+        if index.update():
+            try:
+                index.save()
+            except OSError as e:
+                logger.warning(f"Cannot save index {index.path}: {e}")
+        return index
+
+    def update(self) -> bool:
+        """Index new and modified files and forget deleted files. Returns True if the index changed."""
+        paths = {path.name: path for path in self.device_dir.glob("*.csv")}
+        removed = self.files.keys() - paths.keys()
+        for name in removed:
+            del self.files[name]
+        changed = bool(removed)
+        for name, path in sorted(paths.items()):
+            entry = self.files.get(name)
+            if entry is None or not entry.is_current(path):
+                logger.debug(f"Indexing {path}...")
+                self.files[name] = index_csv_file(path)
+                changed = True
+        return changed
+
+    def save(self) -> None:
+        data = {"version": INDEX_VERSION, "files": [self.files[name].to_dict() for name in sorted(self.files)]}
+        temp_path = self.path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(data), encoding="UTF-8")
+        os.replace(temp_path, self.path)
+        logger.debug(f"Saved index of {len(self.files)} files to {self.path}")
+
+    def covered_files(self, max_gap: int = RECORD_PERIOD) -> list[str]:
+        """Names of the files whose rows are all contained in other files, see find_covered_files().
+        Files without rows are always covered."""
+        intervals = [interval for entry in self.files.values() if (interval := entry.interval) is not None]
+        empty = sorted(name for name, entry in self.files.items() if entry.interval is None)
+        return empty + [interval.file for interval in find_covered_files(intervals, max_gap)]
+
+    def select(
+        self,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        skip_covered: bool = True,
+    ) -> list[CsvFileRange]:
+        """Ranges of the files that may contain rows with start <= timestamp < end, sorted by file name.
+        Files covered by other files are skipped unless skip_covered is False."""
+        start_ts = int(start.timestamp()) if start is not None else None
+        end_ts = int(end.timestamp()) if end is not None else None
+        covered = set(self.covered_files()) if skip_covered else set()
+        return [
+            _file_range(self.device_dir / name, entry, start_ts, end_ts)
+            for name, entry in sorted(self.files.items())
+            if name not in covered and entry.overlaps(start_ts, end_ts)
+        ]
+
+
+def _file_range(path: Path, entry: CsvFileIndex, start: Optional[int], end: Optional[int]) -> CsvFileRange:
+    first = HourOffset(timestamp=0, offset=entry.data_offset, row=0)
+    after_last = HourOffset(timestamp=0, offset=entry.size, row=entry.rows)
+    if start is not None:
+        first = max((hour for hour in entry.hours if hour.timestamp <= start), default=first)
+    if end is not None:
+        after_last = min((hour for hour in entry.hours if hour.timestamp >= end), default=after_last)
+    return CsvFileRange(
+        file=path,
+        data_offset=entry.data_offset,
+        start_offset=first.offset,
+        end_offset=after_last.offset,
+        start_row=first.row,
+        rows=after_last.row - first.row,
+    )
@@ -0,0 +1,174 @@
+import datetime
+import os
+from pathlib import Path
+
+import pytest
+
+from importer.csv_index import (
+    INDEX_FILE_NAME,
+    CsvIndex,
+    FileInterval,
+    find_covered_files,
+    index_csv_file,
+)
+from importer.main import read_csv_files
+from importer.model import ALL_FIELD_NAMES
+
+HEADER = ["timestamp", *sorted(ALL_FIELD_NAMES - {"timestamp"})]
+HOUR = 3600
+START = 1727740800  # 2024-10-01 00:00 UTC
+
+
+def _write_csv(path: Path, timestamps: list[int]) -> Path:
+    lines = [",".join(HEADER)]
+    for timestamp in timestamps:
+        lines.append(",".join([str(timestamp), *(f"{timestamp % 1000 + index / 8:.3f}" for index in range(51))]))
+    path.write_text("\n".join(lines) + "\n", encoding="UTF-8")
+    return path
+
+
+def _minutes(start: int, count: int) -> list[int]:
+    return [start + minute * 60 for minute in range(count)]
+
+
+def _utc(timestamp: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+
+def test_index_csv_file(tmp_path: Path):
+    path = _write_csv(tmp_path / "a.csv", _minutes(START + 30 * 60, 150))
+    index = index_csv_file(path)
+    assert index.file == "a.csv"
+    assert index.rows == 150
+    assert index.first_timestamp == START + 30 * 60
+    assert index.last_timestamp == START + 179 * 60
+    assert index.size == path.stat().st_size
+    assert [(hour.timestamp, hour.row) for hour in index.hours] == [
+        (START, 0),
+        (START + HOUR, 30),
+        (START + 2 * HOUR, 90),
+    ]
+    content = path.read_bytes()
+    assert content[: index.data_offset].decode().startswith("timestamp,")
+    for hour in index.hours[1:]:
+        assert content[hour.offset :].startswith(str(hour.timestamp).encode())
+
+
+def test_index_unsorted_file_has_no_hours(tmp_path: Path):
+    index = index_csv_file(_write_csv(tmp_path / "a.csv", [START + HOUR, START]))
+    assert index.rows == 2
+    assert index.first_timestamp == START
+    assert index.hours == []
+
+
+def test_index_empty_file(tmp_path: Path):
+    index = index_csv_file(_write_csv(tmp_path / "a.csv", []))
+    assert index.rows == 0
+    assert index.first_timestamp is None
+    assert not index.overlaps(None, None)
+
+
+def test_open_saves_and_updates_index(tmp_path: Path):
+    _write_csv(tmp_path / "a.csv", _minutes(START, 60))
+    _write_csv(tmp_path / "b.csv", _minutes(START + HOUR, 60))
+    index = CsvIndex.open(tmp_path)
+    assert (tmp_path / INDEX_FILE_NAME).exists()
+    assert CsvIndex.load(tmp_path).files == index.files
+
+    (tmp_path / "a.csv").unlink()
+    _write_csv(tmp_path / "b.csv", _minutes(START + HOUR, 120))
+    os.utime(tmp_path / "b.csv", ns=(0, index.files["b.csv"].mtime_ns + 1))
+    index = CsvIndex.open(tmp_path)
+    assert list(index.files) == ["b.csv"]
+    assert index.files["b.csv"].rows == 120
+    assert not CsvIndex.load(tmp_path).update()
+
+
+def test_load_ignores_invalid_index(tmp_path: Path):
+    (tmp_path / INDEX_FILE_NAME).write_text("{invalid", encoding="UTF-8")
+    assert not CsvIndex.load(tmp_path).files
+    (tmp_path / INDEX_FILE_NAME).write_text('{"version": 0, "files": []}', encoding="UTF-8")
+    assert not CsvIndex.load(tmp_path).files
+
+
+def test_select(tmp_path: Path):
+    _write_csv(tmp_path / "a.csv", _minutes(START, 3 * 60))
+    _write_csv(tmp_path / "b.csv", _minutes(START + 5 * HOUR, 60))
+    index = CsvIndex.open(tmp_path)
+    assert [file_range.file.name for file_range in index.select()] == ["a.csv", "b.csv"]
+    assert [file_range.file.name for file_range in index.select(end=_utc(START + 5 * HOUR))] == ["a.csv"]
+    assert index.select(start=_utc(START + 3 * HOUR), end=_utc(START + 5 * HOUR)) == []
+
+    file_range = index.select(start=_utc(START + HOUR + 10 * 60), end=_utc(START + HOUR + 20 * 60))[0]
+    hour = index.files["a.csv"].hours[1]
+    assert (file_range.start_offset, file_range.start_row, file_range.rows) == (hour.offset, 60, 60)
+    assert file_range.end_offset == index.files["a.csv"].hours[2].offset
+
+
+def test_select_unsorted_file_returns_whole_file(tmp_path: Path):
+    _write_csv(tmp_path / "a.csv", [START + HOUR, START, START + 2 * HOUR])
+    index = CsvIndex.open(tmp_path)
+    file_range = index.select(start=_utc(START + 2 * HOUR))[0]
+    assert (file_range.start_row, file_range.rows) == (0, 3)
+    assert file_range.end_offset == index.files["a.csv"].size
+    assert index.files["a.csv"].hours == []
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (START + 90 * 60, START + 150 * 60),
+        (START + 59 * 60, None),
+        (None, START + 61 * 60),
+        (START + 200 * 60, START + 400 * 60),
+    ],
+)
+def test_read_csv_files_with_time_range(tmp_path: Path, start: int | None, end: int | None):
+    _write_csv(tmp_path / "a.csv", _minutes(START, 4 * 60))
+    _write_csv(tmp_path / "b.csv", _minutes(START + 3 * HOUR, 3 * 60))
+    expected = [
+        view.to_row()
+        for view in read_csv_files(tmp_path)
+        if (start is None or view.epoch >= start) and (end is None or view.epoch < end)
+    ]
+    rows = read_csv_files(
+        tmp_path, start=_utc(start) if start is not None else None, end=_utc(end) if end is not None else None
+    )
+    assert [view.to_row() for view in rows] == expected
+
+
+def test_covered_files(tmp_path: Path):
+    _write_csv(tmp_path / "a.csv", _minutes(START, 2 * 60))
+    _write_csv(tmp_path / "b.csv", _minutes(START + HOUR, 2 * 60))
+    _write_csv(tmp_path / "c.csv", _minutes(START + 2 * HOUR, 60))
+    _write_csv(tmp_path / "d.csv", _minutes(START + 30 * 60, 60))
+    _write_csv(tmp_path / "e.csv", [])
+    index = CsvIndex.open(tmp_path)
+    assert index.covered_files() == ["e.csv", "d.csv", "c.csv"]
+    assert [file_range.file.name for file_range in index.select()] == ["a.csv", "b.csv"]
+    assert [file_range.file.name for file_range in index.select(skip_covered=False)] == [
+        "a.csv",
+        "b.csv",
+        "c.csv",
+        "d.csv",
+    ]
+
+
+def test_find_covered_files_adjacent_ranges():
+    files = [
+        FileInterval("a", first_timestamp=0, last_timestamp=600, rows=11),
+        FileInterval("b", first_timestamp=660, last_timestamp=1200, rows=10),
+        FileInterval("c", first_timestamp=300, last_timestamp=900, rows=11),
+    ]
+    assert find_covered_files(files) == [files[2]]
+    assert not find_covered_files(files, max_gap=0)
+
+
+def test_find_covered_files_with_missing_rows():
+    files = [
+        FileInterval("sparse", first_timestamp=0, last_timestamp=1200, rows=3),
+        FileInterval("dense", first_timestamp=300, last_timestamp=900, rows=11),
+        FileInterval("within", first_timestamp=420, last_timestamp=840, rows=2),
+    ]
+    # The sparse file lacks most rows of the dense one, which in turn contains all rows of the third
+    assert find_covered_files(files) == [files[2]]
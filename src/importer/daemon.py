@@ -0,0 +1,227 @@
+import datetime
+import random
+import threading
+import time
+from concurrent import futures
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from importer.csv_block import CsvRowBlock
+from importer.csv_index import CsvIndex
+from importer.logger import MAIN_LOGGER
+from importer.metrics import REGISTRY
+from importer.shelly import CsvBlockWriter, Shelly
+
+logger = MAIN_LOGGER.getChild("daemon")
+
+SUMMARY_INTERVAL = 3600.0
+"""Seconds between two summaries of all devices' jobs in the log"""
+POLL_INTERVAL = 1.0
+"""Maximum seconds before the scheduler notices the stop event"""
+
+DAEMON_JOBS = REGISTRY.counter(
+    "importer_daemon_jobs_total", "Scheduled sync jobs per device by result", labels=("device", "result")
+)
+DAEMON_ROWS = REGISTRY.counter("importer_daemon_rows_total", "CSV rows synced by the daemon per device", ("device",))
+
+SyncJob = Callable[[Shelly, Optional[datetime.datetime]], Optional[datetime.datetime]]
+"""Syncs the data of a device newer than the timestamp, all data if None, and returns the timestamp of the next
+sync, None to sync the same range again"""
+
+
+class DaemonConfig(NamedTuple):
+    interval: datetime.timedelta = datetime.timedelta(minutes=15)
+    """Time between the starts of two jobs of a device"""
+    jitter: datetime.timedelta = datetime.timedelta(minutes=1)
+    """Maximum random delay added to each start, spreads the jobs of the devices"""
+    max_jobs: int = 4
+    """Jobs running concurrently, each device runs at most one job at a time"""
+    retry_delay: datetime.timedelta = datetime.timedelta(minutes=1)
+    """Delay before retrying a failed job, doubled for each further failure up to the interval"""
+
+
+class DeviceJobStats(NamedTuple):
+    runs: int
+    failures: int
+    skipped: int
+    """Starts skipped because the previous job of the device was still running or queued"""
+    since: Optional[datetime.datetime]
+    """Start of the next job's time range"""
+
+
+class _DeviceJob:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, device: Shelly, since: Optional[datetime.datetime], next_run: float) -> None:
+        self.device = device
+        self.since = since
+        self.next_run = next_run
+        """Monotonic time of the next start"""
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.skipped = 0
+
+    def stats(self) -> DeviceJobStats:
+        return DeviceJobStats(runs=self.runs, failures=self.failures, skipped=self.skipped, since=self.since)
+
+
+class DeviceScheduler:
+    """Runs a job for each device periodically, e.g. an incremental download and import.
+
+    Starts are spread by a random jitter, at most max_jobs jobs run concurrently and each device runs at most one
+    job at a time: a start that is due while the device's previous job is still running or queued is skipped. A
+    failed job is retried with exponential backoff, the next job of a successful one continues at the timestamp it
+    returned."""
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        devices: list[Shelly],
+        job: SyncJob,
+        since: dict[str, Optional[datetime.datetime]],
+        config: DaemonConfig = DaemonConfig(),
+        seed: Optional[int] = None,
+    ) -> None:
+        self._job = job
+        self._config = config
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        """Set when a job's next start moves forward"""
+        now = time.monotonic()
+        self._jobs = [_DeviceJob(device, since.get(device.name), now + self._jitter()) for device in devices]
+
+    def stats(self) -> dict[str, DeviceJobStats]:
+        with self._lock:
+            return {job.device.name: job.stats() for job in self._jobs}
+
+    def run(self, stop: threading.Event) -> None:
+        """Run jobs until the stop event is set or Ctrl-C is pressed, then wait for the running jobs"""
+        executor = futures.ThreadPoolExecutor(max_workers=self._config.max_jobs, thread_name_prefix="job")
+        last_summary = time.monotonic()
+        logger.info(
+            f"Scheduling jobs for {len(self._jobs)} devices every {self._config.interval}, "
+            f"{self._config.max_jobs} concurrently"
+        )
+        try:
+            while not stop.is_set():
+                self._wakeup.clear()
+                now = time.monotonic()
+                for job in self._due_jobs(now):
+                    executor.submit(self._run_job, job)
+                if now - last_summary > SUMMARY_INTERVAL:
+                    self._log_summary()
+                    last_summary = now
+                with self._lock:
+                    next_run = min((job.next_run for job in self._jobs), default=now + POLL_INTERVAL)
+                self._wakeup.wait(max(0.0, min(next_run - time.monotonic(), POLL_INTERVAL)))
+        except KeyboardInterrupt:
+            logger.debug("Interrupted by user")
+        finally:
+            logger.info("Waiting for running jobs...")
+            executor.shutdown(cancel_futures=True)
+            self._log_summary()
+
+    def _due_jobs(self, now: float) -> list[_DeviceJob]:
+        interval = self._config.interval.total_seconds()
+        due = []
+        with self._lock:
+            for job in self._jobs:
+                if job.next_run > now:
+                    continue
+                if job.running:
+                    job.skipped += 1
+                    DAEMON_JOBS.inc(device=job.device.name, result="skipped")
+                    logger.warning(f"Skipping job of {job.device.name}, the previous job is still running")
+                else:
+                    job.running = True
+                    due.append(job)
+                # Keep the schedule of a device, unless it fell behind by more than an interval
+                job.next_run = max(job.next_run + interval, now) + self._jitter()
+        return due
+
+    def _run_job(self, job: _DeviceJob) -> None:
+        name = job.device.name
+        start = time.monotonic()
+        try:
+            since = self._job(job.device, job.since)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            with self._lock:
+                job.running = False
+                job.failures += 1
+                job.consecutive_failures += 1
+                delay = min(
+                    self._config.retry_delay.total_seconds() * 2 ** (job.consecutive_failures - 1),
+                    self._config.interval.total_seconds(),
+                )
+                job.next_run = min(job.next_run, time.monotonic() + delay)
+            self._wakeup.set()
+            DAEMON_JOBS.inc(device=name, result="failure")
+            logger.error(f"Job of {name} failed after {time.monotonic() - start:.1f}s: {e}, retrying in {delay:.0f}s")
+            return
+        with self._lock:
+            job.running = False
+            job.runs += 1
+            job.consecutive_failures = 0
+            job.since = since
+        DAEMON_JOBS.inc(device=name, result="success")
+        logger.debug(f"Job of {name} finished in {time.monotonic() - start:.1f}s, next data from {since}")
+
+    def _jitter(self) -> float:
+        return self._random.uniform(0.0, self._config.jitter.total_seconds())
+
+    def _log_summary(self) -> None:
+        for name, stats in self.stats().items():
+            logger.info(
+                f"{name}: {stats.runs} jobs, {stats.failures} failed, {stats.skipped} skipped, next data from "
+                f"{stats.since or 'the start'}"
+            )
+
+
+def local_since(data_dir: Path, device: str) -> Optional[datetime.datetime]:
+    """Start of the data missing in the local CSV files of the device, None if there are none"""
+    device_dir = data_dir / device
+    if not device_dir.is_dir():
+        return None
+    last = CsvIndex.open(device_dir).last_timestamp
+    return _after(last) if last is not None else None
+
+
+def sync_device(
+    device: Shelly, since: Optional[datetime.datetime], writer: CsvBlockWriter, data_dir: Path
+) -> Optional[datetime.datetime]:
+    """Download the device's CSV data newer than since, pass it to the writer and save a copy to the data directory.
+    Returns the start of the next download: after the newest row, or since if there were no new rows."""
+    newest: Optional[int] = None
+
+    def tracked(name: str, blocks: Iterable[CsvRowBlock]) -> int:
+        def track() -> Iterator[CsvRowBlock]:
+            nonlocal newest
+            for block in blocks:
+                if block:
+                    block_newest = max(block.timestamps)
+                    newest = block_newest if newest is None else max(newest, block_newest)
+                yield block
+
+        rows: int = writer(name, track())
+        return rows
+
+    file_name_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    target_file = data_dir / device.name / f"{device.name}_{file_name_timestamp}.csv"
+    number = 1
+    while target_file.exists():
+        # Retries within the same second must not replace the file of the failed job
+        target_file = target_file.with_name(f"{device.name}_{file_name_timestamp}_{number}.csv")
+        number += 1
+    result = device.sync_csv_data(tracked, timestamp=since, target_file=target_file)
+    if result.rows == 0:
+        target_file.unlink(missing_ok=True)
+    else:
+        CsvIndex.open(target_file.parent)
+    DAEMON_ROWS.inc(result.rows, device=device.name)
+    logger.info(f"Synced {result.rows} rows ({result.size} bytes) from {device.name} since {since or 'the start'}")
+    return _after(newest) if newest is not None else since
+
+
+def _after(timestamp: int) -> datetime.datetime:
+    # The download includes rows at the start timestamp
+    return datetime.datetime.fromtimestamp(timestamp + 1, tz=datetime.timezone.utc)
@@ -0,0 +1,159 @@
+import datetime
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import pytest
+import requests
+
+from importer import daemon
+from importer.config_model import DeviceConfig
+from importer.csv_block import CsvRowBlock
+from importer.daemon import DaemonConfig, DeviceScheduler, local_since, sync_device
+from importer.db.influx import DbClient
+from importer.shelly import Shelly
+from simulator.influx import InfluxSimulator
+from simulator.server import FaultConfig, ShellySimulator, fleet
+
+UTC = datetime.timezone.utc
+START = datetime.datetime(2024, 5, 19, tzinfo=UTC)
+CONFIG = DaemonConfig(
+    interval=datetime.timedelta(seconds=0.05),
+    jitter=datetime.timedelta(0),
+    max_jobs=2,
+    retry_delay=datetime.timedelta(seconds=0.01),
+)
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(daemon, "POLL_INTERVAL", 0.01)
+
+
+def _devices(count: int) -> list[Shelly]:
+    return [Shelly(DeviceConfig(name=f"dev{index}", ip="unused")) for index in range(count)]
+
+
+def _run(scheduler: DeviceScheduler, seconds: float) -> None:
+    stop = threading.Event()
+    thread = threading.Thread(target=scheduler.run, args=(stop,))
+    thread.start()
+    time.sleep(seconds)
+    stop.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+class _Job:
+    """Records the calls and the concurrency of a sync job"""
+
+    def __init__(self, duration: float = 0.0, fail: Callable[[int], bool] = lambda call: False) -> None:
+        self.duration = duration
+        self.fail = fail
+        self.calls: list[tuple[str, Optional[datetime.datetime]]] = []
+        self.active: dict[str, int] = {}
+        self.max_active_per_device = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, device: Shelly, since: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+        with self._lock:
+            call = len(self.calls)
+            self.calls.append((device.name, since))
+            self.active[device.name] = self.active.get(device.name, 0) + 1
+            self.max_active_per_device = max(self.max_active_per_device, self.active[device.name])
+            self.max_active = max(self.max_active, sum(self.active.values()))
+        time.sleep(self.duration)
+        with self._lock:
+            self.active[device.name] -= 1
+        if self.fail(call):
+            raise requests.ConnectionError("unreachable")
+        return (since or START) + datetime.timedelta(minutes=1)
+
+
+def test_jobs_continue_at_returned_timestamp():
+    job = _Job()
+    scheduler = DeviceScheduler(_devices(2), job, {"dev0": START}, CONFIG)
+    _run(scheduler, 0.3)
+    for device in ["dev0", "dev1"]:
+        since = [since for name, since in job.calls if name == device]
+        assert len(since) >= 3
+        assert since[1:] == [START + datetime.timedelta(minutes=minutes) for minutes in range(1, len(since))]
+    assert [since for name, since in job.calls if name == "dev0"][0] == START
+    stats = scheduler.stats()
+    assert stats["dev0"].runs == len([name for name, _since in job.calls if name == "dev0"])
+    assert stats["dev0"].failures == stats["dev0"].skipped == 0
+
+
+def test_overlapping_starts_are_skipped():
+    job = _Job(duration=0.2)
+    scheduler = DeviceScheduler(_devices(1), job, {}, CONFIG)
+    _run(scheduler, 0.3)
+    assert job.max_active_per_device == 1
+    assert scheduler.stats()["dev0"].skipped > 0
+
+
+def test_concurrent_jobs_are_limited():
+    job = _Job(duration=0.1)
+    scheduler = DeviceScheduler(_devices(4), job, {}, CONFIG._replace(interval=datetime.timedelta(seconds=1)))
+    _run(scheduler, 0.3)
+    assert len(job.calls) == 4
+    assert job.max_active == 2
+
+
+def test_failed_job_is_retried():
+    job = _Job(fail=lambda call: call == 0)
+    config = CONFIG._replace(interval=datetime.timedelta(seconds=10))
+    scheduler = DeviceScheduler(_devices(1), job, {"dev0": START}, config)
+    _run(scheduler, 0.2)
+    # The retry uses the time range of the failed job
+    assert job.calls == [("dev0", START), ("dev0", START)]
+    stats = scheduler.stats()
+    assert (stats["dev0"].runs, stats["dev0"].failures) == (1, 1)
+    assert stats["dev0"].since == START + datetime.timedelta(minutes=1)
+
+
+@pytest.fixture(name="shelly")
+def shelly_fixture():
+    with ShellySimulator(fleet(1, history=datetime.timedelta(days=1))) as simulator:
+        with requests.Session() as session:
+            yield Shelly(simulator.device_configs()[0], session)
+
+
+def test_sync_device(shelly: Shelly, tmp_path: Path):
+    assert local_since(tmp_path, shelly.name) is None
+    start = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=1)
+    with InfluxSimulator() as influx:
+        with DbClient(url=influx.url, token="token", org="org", bucket="em") as db:
+            db.ensure_bucket_exists()
+            since = sync_device(shelly, start, db.insert_blocks, tmp_path)
+            assert since is not None
+            assert since == local_since(tmp_path, shelly.name)
+            assert datetime.timedelta(0) < datetime.datetime.now(tz=UTC) - since < datetime.timedelta(minutes=2)
+            assert sync_device(shelly, since, db.insert_blocks, tmp_path) in (
+                since,
+                since + datetime.timedelta(minutes=1),
+            )
+        rows = influx.statistics.lines // 4
+    assert rows in (59, 60, 61)
+    files = list((tmp_path / shelly.name).glob("*.csv"))
+    assert len(files) in (1, 2)
+
+
+def test_failed_sync_leaves_no_file(tmp_path: Path):
+    start = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=12)
+    faults = FaultConfig(drop_rate=1.0)
+    with ShellySimulator(fleet(1, history=datetime.timedelta(days=1)), faults=faults) as simulator:
+        shelly = Shelly(simulator.device_configs()[0])
+        rows: list[int] = []
+
+        def writer(_name: str, blocks: Iterable[CsvRowBlock]) -> int:
+            rows.extend(len(block) for block in blocks)
+            return sum(rows)
+
+        with pytest.raises(requests.RequestException):
+            sync_device(shelly, start, writer, tmp_path)
+        assert simulator.statistics.dropped_downloads == 1
+    assert not list((tmp_path / shelly.name).iterdir())
+    assert local_since(tmp_path, shelly.name) is None
@@ -0,0 +1,149 @@
+import datetime
+from typing import NamedTuple, Optional
+
+AGGREGATE_FUNCTIONS = ["mean", "min", "max"]
+
+
+class DownsamplingTier(NamedTuple):
+    name: str
+    """Tier name, used as suffix for bucket and task names, e.g. 1m"""
+    every: datetime.timedelta
+    """Resolution of the data in this tier"""
+    retention: Optional[datetime.timedelta]
+    """Retention period of the tier's bucket, None means infinite"""
+
+    def bucket(self, base_bucket: str) -> str:
+        if self.name == RAW_TIER_NAME:
+            return base_bucket
+        return f"{base_bucket}_{self.name}"
+
+    def task_name(self, base_bucket: str) -> str:
+        return f"{base_bucket}-downsample-{self.name}"
+
+    def is_available(self, start: datetime.datetime, now: datetime.datetime) -> bool:
+        return self.retention is None or start >= now - self.retention
+
+
+RAW_TIER_NAME = "raw"
+LIVE_RAW_BUCKET_SUFFIX = "_live_raw"
+"""Suffix of the bucket of raw live events written next to aggregates, see live --keep-raw"""
+RAW_RESOLUTION = datetime.timedelta(seconds=1)
+
+DEFAULT_TIERS = [
+    DownsamplingTier(name="1m", every=datetime.timedelta(minutes=1), retention=datetime.timedelta(days=400)),
+    DownsamplingTier(name="1h", every=datetime.timedelta(hours=1), retention=None),
+]
+
+DEFAULT_MAX_POINTS = 2_000
+"""Maximum number of points per series a query should return before switching to a coarser tier"""
+
+
+def raw_tier(retention: Optional[datetime.timedelta]) -> DownsamplingTier:
+    return DownsamplingTier(name=RAW_TIER_NAME, every=RAW_RESOLUTION, retention=retention)
+
+
+def flux_duration(delta: datetime.timedelta) -> str:
+    seconds = int(delta.total_seconds())
+    if seconds <= 0:
+        raise ValueError(f"Duration must be positive, got {delta}")
+    for unit, unit_seconds in [("d", 86_400), ("h", 3_600), ("m", 60)]:
+        if seconds % unit_seconds == 0:
+            return f"{seconds // unit_seconds}{unit}"
+    return f"{seconds}s"
+
+
+def downsampling_task(org: str, base_bucket: str, source: DownsamplingTier, target: DownsamplingTier) -> str:
+    """Create the Flux script of a task aggregating data from the source tier into the target tier.
+
+    The raw tier is aggregated directly, using only the matching aggregate of data aggregated by the live importer
+    (see importer.aggregation), coarser tiers are aggregated from the next finer tier using the same
+    aggregate function, i.e. hourly maxima are calculated from the minute maxima.
+    The task reads two windows to catch data that arrived late."""
+    every = flux_duration(target.every)
+    lookback = flux_duration(target.every * 2)
+    source_bucket = source.bucket(base_bucket)
+    target_bucket = target.bucket(base_bucket)
+    lines = [
+        f'option task = {{name: "{target.task_name(base_bucket)}", every: {every}, offset: 10s}}',
+        "",
+        f'data = from(bucket: "{source_bucket}")',
+        f"  |> range(start: -{lookback})",
+        '  |> filter(fn: (r) => r["_measurement"] == "em")',
+        '  |> filter(fn: (r) => r["source"] == "live")',
+    ]
+    for function in AGGREGATE_FUNCTIONS:
+        lines.append("")
+        lines.append("data")
+        if source.name != RAW_TIER_NAME:
+            lines.append(f'  |> filter(fn: (r) => r["agg"] == "{function}")')
+        else:
+            lines.append('  |> filter(fn: (r) => types.isType(v: r._value, type: "float"))')
+            lines.append(f"  |> filter(fn: (r) => {_raw_agg_filter(function)})")
+        lines.append(f"  |> aggregateWindow(every: {every}, fn: {function}, createEmpty: false)")
+        lines.append(f'  |> set(key: "agg", value: "{function}")')
+        lines.append(f'  |> to(bucket: "{target_bucket}", org: "{org}")')
+    if source.name == RAW_TIER_NAME:
+        lines.insert(0, 'import "types"\n')
+    return "\n".join(lines) + "\n"
+
+
+def select_tier(
+    tiers: list[DownsamplingTier],
+    start: datetime.datetime,
+    stop: datetime.datetime,
+    now: datetime.datetime,
+    max_points: int = DEFAULT_MAX_POINTS,
+) -> DownsamplingTier:
+    """Select the finest tier that still contains data for the given start time
+    and returns at most max_points per series. Falls back to the coarsest tier."""
+    if not tiers:
+        raise ValueError("No tiers given")
+    if stop <= start:
+        raise ValueError(f"Stop {stop} must be after start {start}")
+    sorted_tiers = sorted(tiers, key=lambda tier: tier.every)
+    duration = stop - start
+    for tier in sorted_tiers:
+        if tier.is_available(start, now) and duration / tier.every <= max_points:
+            return tier
+    return sorted_tiers[-1]
+
+
+def tier_query(  # pylint: disable=too-many-arguments
+    base_bucket: str,
+    tier: DownsamplingTier,
+    *,
+    start: datetime.datetime,
+    stop: datetime.datetime,
+    field: str,
+    fn: str = "mean",
+    devices: Optional[list[str]] = None,
+) -> str:
+    """Create a Flux query for a field of live data in the given tier"""
+    if fn not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"Unsupported aggregate function '{fn}'. Use one of {AGGREGATE_FUNCTIONS}")
+    lines = [
+        f'from(bucket: "{tier.bucket(base_bucket)}")',
+        f"  |> range(start: {flux_time(start)}, stop: {flux_time(stop)})",
+        '  |> filter(fn: (r) => r["_measurement"] == "em")',
+        '  |> filter(fn: (r) => r["source"] == "live")',
+        f'  |> filter(fn: (r) => r["_field"] == "{field}")',
+    ]
+    if devices:
+        device_filter = " or ".join(f'r["device"] == "{device}"' for device in devices)
+        lines.append(f"  |> filter(fn: (r) => {device_filter})")
+    if tier.name != RAW_TIER_NAME:
+        lines.append(f'  |> filter(fn: (r) => r["agg"] == "{fn}")')
+    else:
+        lines.append(f"  |> filter(fn: (r) => {_raw_agg_filter(fn)})")
+    return "\n".join(lines) + "\n"
+
+
+def _raw_agg_filter(fn: str) -> str:
+    """Flux predicate for raw data: raw points have no agg tag, points aggregated by the live importer have one"""
+    return f'not exists r["agg"] or r["agg"] == "{fn}"'
+
+
+def flux_time(timestamp: datetime.datetime) -> str:
+    if timestamp.tzinfo is None:
+        raise ValueError(f"Timestamp {timestamp} has no timezone")
+    return timestamp.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,124 @@
+import datetime
+
+import pytest
+
+from importer.db.downsampling import (
+    DEFAULT_TIERS,
+    downsampling_task,
+    flux_duration,
+    raw_tier,
+    select_tier,
+    tier_query,
+)
+
+NOW = datetime.datetime.fromisoformat("2024-05-19T17:43:59Z")
+RAW = raw_tier(datetime.timedelta(days=30))
+MINUTE, HOUR = DEFAULT_TIERS
+TIERS = [RAW, MINUTE, HOUR]
+
+
+@pytest.mark.parametrize(
+    "delta, expected",
+    [
+        (datetime.timedelta(seconds=10), "10s"),
+        (datetime.timedelta(seconds=90), "90s"),
+        (datetime.timedelta(minutes=2), "2m"),
+        (datetime.timedelta(hours=2), "2h"),
+        (datetime.timedelta(days=3), "3d"),
+    ],
+)
+def test_flux_duration(delta: datetime.timedelta, expected: str):
+    assert flux_duration(delta) == expected
+
+
+def test_flux_duration_invalid():
+    with pytest.raises(ValueError, match="Duration must be positive"):
+        flux_duration(datetime.timedelta(0))
+
+
+def test_bucket_names():
+    assert RAW.bucket("em") == "em"
+    assert MINUTE.bucket("em") == "em_1m"
+    assert HOUR.bucket("em") == "em_1h"
+
+
+@pytest.mark.parametrize(
+    "age, expected",
+    [
+        (datetime.timedelta(minutes=30), "raw"),
+        (datetime.timedelta(hours=12), "1m"),
+        (datetime.timedelta(days=1), "1m"),
+        (datetime.timedelta(days=7), "1h"),
+        (datetime.timedelta(days=3000), "1h"),
+    ],
+)
+def test_select_tier_by_duration(age: datetime.timedelta, expected: str):
+    assert select_tier(TIERS, start=NOW - age, stop=NOW, now=NOW).name == expected
+
+
+def test_select_tier_skips_expired_tier():
+    start = NOW - datetime.timedelta(days=60)
+    stop = start + datetime.timedelta(minutes=30)
+    assert select_tier(TIERS, start=start, stop=stop, now=NOW).name == "1m"
+
+
+def test_select_tier_falls_back_to_coarsest():
+    start = NOW - datetime.timedelta(days=3000)
+    assert select_tier([RAW, MINUTE], start=start, stop=NOW, now=NOW).name == "1m"
+
+
+def test_select_tier_invalid_range():
+    with pytest.raises(ValueError, match="must be after start"):
+        select_tier(TIERS, start=NOW, stop=NOW, now=NOW)
+
+
+def test_downsampling_task_from_raw():
+    flux = downsampling_task(org="org", base_bucket="em", source=RAW, target=MINUTE)
+    assert flux.startswith('import "types"\n\noption task = {name: "em-downsample-1m", every: 1m, offset: 10s}\n')
+    assert 'from(bucket: "em")' in flux
+    assert "range(start: -2m)" in flux
+    for fn in ["mean", "min", "max"]:
+        assert f'filter(fn: (r) => not exists r["agg"] or r["agg"] == "{fn}")' in flux
+        assert f"aggregateWindow(every: 1m, fn: {fn}, createEmpty: false)" in flux
+        assert f'set(key: "agg", value: "{fn}")' in flux
+    assert flux.count('to(bucket: "em_1m", org: "org")') == 3
+
+
+def test_downsampling_task_cascading():
+    flux = downsampling_task(org="org", base_bucket="em", source=MINUTE, target=HOUR)
+    assert flux.startswith('option task = {name: "em-downsample-1h", every: 1h, offset: 10s}\n')
+    assert 'from(bucket: "em_1m")' in flux
+    assert 'filter(fn: (r) => r["agg"] == "max")' in flux
+    assert flux.count('to(bucket: "em_1h", org: "org")') == 3
+
+
+def test_tier_query():
+    query = tier_query(
+        "em",
+        MINUTE,
+        start=NOW - datetime.timedelta(hours=1),
+        stop=NOW,
+        field="act_power",
+        fn="max",
+        devices=["dev1", "dev2"],
+    )
+    assert query == (
+        'from(bucket: "em_1m")\n'
+        "  |> range(start: 2024-05-19T16:43:59Z, stop: 2024-05-19T17:43:59Z)\n"
+        '  |> filter(fn: (r) => r["_measurement"] == "em")\n'
+        '  |> filter(fn: (r) => r["source"] == "live")\n'
+        '  |> filter(fn: (r) => r["_field"] == "act_power")\n'
+        '  |> filter(fn: (r) => r["device"] == "dev1" or r["device"] == "dev2")\n'
+        '  |> filter(fn: (r) => r["agg"] == "max")\n'
+    )
+
+
+def test_tier_query_raw_accepts_raw_and_edge_aggregated_data():
+    query = tier_query("em", RAW, start=NOW - datetime.timedelta(hours=1), stop=NOW, field="act_power", fn="max")
+    assert 'from(bucket: "em")' in query
+    assert query.endswith('  |> filter(fn: (r) => not exists r["agg"] or r["agg"] == "max")\n')
+
+
+def test_tier_query_unsupported_function():
+    with pytest.raises(ValueError, match="Unsupported aggregate function 'sum'"):
+        tier_query("em", MINUTE, start=NOW - datetime.timedelta(hours=1), stop=NOW, field="act_power", fn="sum")
@@ -1,13 +1,51 @@
+import contextlib
+import datetime
 import time
 from typing import Iterable, Optional
 
-from influxdb_client import InfluxDBClient, WriteApi, WriteOptions
+from influxdb_client import (
+    BucketRetentionRules,
+    InfluxDBClient,
+    Point,
+    TaskCreateRequest,
+    TaskUpdateRequest,
+    WriteApi,
+    WriteOptions,
+    WritePrecision,
+)
 from influxdb_client.client.exceptions import InfluxDBError
 from influxdb_client.client.write_api import PointSettings, WriteType
 
-from importer.db.influx_converter import PointConverter
+from importer.aggregation import EventAggregator
+from importer.csv_block import CsvRowBlock
+from importer.db.downsampling import (
+    DEFAULT_MAX_POINTS,
+    LIVE_RAW_BUCKET_SUFFIX,
+    DownsamplingTier,
+    downsampling_task,
+    raw_tier,
+    select_tier,
+    tier_query,
+)
+from importer.db.influx_converter import CSV_WRITE_PRECISION, PointConverter
+from importer.db.line_writer import LineProtocolWriter, LineWriterOptions
+from importer.db.migration import (
+    DEFAULT_CHUNK,
+    first_timestamp_query,
+    migration_chunks,
+    wide_migration_query,
+)
+from importer.deadband import DeadbandConfig, DeadbandFilter, log_stats
 from importer.logger import MAIN_LOGGER
-from importer.model import CsvRow, NotifyStatusEvent
+from importer.metrics import (
+    POINT_CONVERSION_SECONDS,
+    WRITE_BATCH_DELAY_SECONDS,
+    WRITE_BATCH_LINES,
+    WRITE_BATCHES,
+    WRITE_QUEUE_POINTS,
+)
+from importer.model import CsvRow, NotifyStatusEvent, Schema
+from importer.profiling import stage
 
 logger = MAIN_LOGGER.getChild("db")
 
@@ -18,28 +56,64 @@ class LoggingBatchCallback:
         self.logger = logger.getChild("batch")
         self.logger.info("Created LoggingBatchCallback")
 
-    def success(self, conf: tuple[str, str, str], data: str):
-        self.logger.debug(f"Written batch: {conf}, data: {len(data.splitlines())} lines")
+    # The batching write API passes the serialized batch as bytes
+    def success(self, conf: tuple[str, str, str], data: str | bytes):
+        lines = data.splitlines()
+        self.logger.debug(f"Written batch: {conf}, data: {len(lines)} lines")
+        WRITE_BATCHES.inc(result="success")
+        WRITE_BATCH_LINES.observe(len(lines))
+        WRITE_QUEUE_POINTS.dec(len(lines))
+        delay = _batch_delay(conf[2], lines[-1]) if lines else None
+        if delay is not None:
+            WRITE_BATCH_DELAY_SECONDS.observe(delay)
 
-    def error(self, conf: tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.error(f"Cannot write batch: {conf}, data: {data} due: {exception}")
+    def error(self, conf: tuple[str, str, str], data: str | bytes, exception: InfluxDBError):
+        self.logger.error(f"Cannot write batch: {conf}, data: {data!r} due: {exception}")
+        WRITE_BATCHES.inc(result="error")
+        WRITE_QUEUE_POINTS.dec(len(data.splitlines()))
 
-    def retry(self, conf: tuple[str, str, str], data: str, exception: InfluxDBError):
-        self.logger.warning(f"Retryable error occurs for batch: {conf}, data: {data} retry: {exception}")
+    def retry(self, conf: tuple[str, str, str], data: str | bytes, exception: InfluxDBError):
+        self.logger.warning(f"Retryable error occurs for batch: {conf}, data: {data!r} retry: {exception}")
+        WRITE_BATCHES.inc(result="retry")
 
 
-point_converter = PointConverter()
+_SECONDS_PER_PRECISION_UNIT = {"s": 1.0, "ms": 1e-3, "us": 1e-6, "ns": 1e-9}
+
+
+def _batch_delay(precision: str, line: str | bytes) -> Optional[float]:
+    """Seconds between the timestamp of a line protocol entry and now"""
+    if isinstance(line, bytes):
+        line = line.decode()
+    factor = _SECONDS_PER_PRECISION_UNIT.get(str(precision))
+    timestamp = line.rsplit(" ", 1)[-1]
+    if factor is None or not timestamp.isdigit():
+        return None
+    return time.time() - int(timestamp) * factor
+
+
+def _retention_rules(retention: Optional[datetime.timedelta]) -> list[BucketRetentionRules]:
+    if retention is None:
+        return []
+    return [BucketRetentionRules(type="expire", every_seconds=int(retention.total_seconds()))]
+
+
+def _same_retention(rules: list[BucketRetentionRules], other: list[BucketRetentionRules]) -> bool:
+    # The server adds settings like the shard group duration to the rules
+    return [(rule.type, rule.every_seconds) for rule in rules] == [(rule.type, rule.every_seconds) for rule in other]
 
 
 class DbClient:
     _client: Optional[InfluxDBClient]
 
-    def __init__(self, url: str, token: str, org: str, bucket: str) -> None:
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, url: str, token: str, org: str, bucket: str, schema: Schema = Schema.NARROW
+    ) -> None:
         self.url = url
         self.token = token
         self.org = org
         self.bucket = bucket
-        logger.info(f"Connecting to {self.url} / org {self.org} / bucket {self.bucket}...")
+        self._point_converter = PointConverter(schema)
+        logger.info(f"Connecting to {self.url} / org {self.org} / bucket {self.bucket} / schema {schema.value}...")
         self._client = InfluxDBClient(url=self.url, token=self.token, org=self.org)
         self._logging_callback = LoggingBatchCallback()
 
@@ -48,48 +122,232 @@ class DbClient:
             raise ValueError("Client is closed")
         return self._client
 
-    def ensure_bucket_exists(self):
+    def ensure_bucket_exists(
+        self,
+        bucket_name: Optional[str] = None,
+        retention: Optional[datetime.timedelta] = None,
+        manage_retention: bool = False,
+    ):
+        """Create the bucket if it does not exist yet.
+        If a retention is given, it is also applied to an existing bucket. With manage_retention, the retention
+        of an existing bucket is always set, so None removes its retention rules."""
+        bucket_name = bucket_name or self.bucket
         buckets_api = self._get_client().buckets_api()
-        bucket = buckets_api.find_bucket_by_name(self.bucket)
+        bucket = buckets_api.find_bucket_by_name(bucket_name)
+        retention_rules = _retention_rules(retention)
         if bucket is None:
-            buckets_api.create_bucket(bucket_name=self.bucket, org_id=self.org)
-            logger.info(f"Created bucket {self.bucket}")
+            buckets_api.create_bucket(bucket_name=bucket_name, org_id=self.org, retention_rules=retention_rules)
+            logger.info(f"Created bucket {bucket_name} with retention {retention or 'infinite'}")
+        elif (retention is not None or manage_retention) and not _same_retention(
+            bucket.retention_rules, retention_rules
+        ):
+            bucket.retention_rules = retention_rules
+            buckets_api.update_bucket(bucket)
+            logger.info(f"Updated retention of bucket {bucket_name} to {retention or 'infinite'}")
         else:
-            logger.info(f"Bucket {self.bucket} already exists")
+            logger.info(f"Bucket {bucket_name} already exists")
 
-    def insert_rows(self, device: str, rows: Iterable[CsvRow]):
-        with self._get_client().write_api(
-            write_options=WriteOptions(write_type=WriteType.batching),
-            point_settings=PointSettings(device=device),
-            success_callback=self._logging_callback.success,
-            error_callback=self._logging_callback.error,
-            retry_callback=self._logging_callback.retry,
-        ) as write_api:
+    def ensure_downsampling(self, tiers: list[DownsamplingTier], raw_retention: Optional[datetime.timedelta]) -> None:
+        """Create buckets and tasks for downsampling live data into the given tiers.
+        Existing tasks are updated, so calling this again after changing tiers is safe.
+
+        The main bucket also holds the CSV data, so its retention is left unchanged. raw_retention applies to the
+        bucket of raw live events written next to aggregates (see LIVE_RAW_BUCKET_SUFFIX)."""
+        self.ensure_bucket_exists()
+        self.ensure_bucket_exists(
+            bucket_name=self.bucket + LIVE_RAW_BUCKET_SUFFIX, retention=raw_retention, manage_retention=True
+        )
+        tasks_api = self._get_client().tasks_api()
+        source = raw_tier(None)
+        for tier in sorted(tiers, key=lambda t: t.every):
+            self.ensure_bucket_exists(
+                bucket_name=tier.bucket(self.bucket), retention=tier.retention, manage_retention=True
+            )
+            flux = downsampling_task(org=self.org, base_bucket=self.bucket, source=source, target=tier)
+            task_name = tier.task_name(self.bucket)
+            existing = tasks_api.find_tasks(name=task_name)
+            if existing:
+                tasks_api.update_task_request(existing[0].id, TaskUpdateRequest(flux=flux, status="active"))
+                logger.info(f"Updated downsampling task {task_name}")
+            else:
+                tasks_api.create_task(
+                    task_create_request=TaskCreateRequest(
+                        org=self.org, flux=flux, status="active", description=f"Downsample live data to {tier.name}"
+                    )
+                )
+                logger.info(f"Created downsampling task {task_name}")
+            source = tier
+
+    def query_tiered(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        tiers: list[DownsamplingTier],
+        raw_retention: Optional[datetime.timedelta],
+        start: datetime.datetime,
+        stop: datetime.datetime,
+        field: str,
+        fn: str = "mean",
+        devices: Optional[list[str]] = None,
+        max_points: int = DEFAULT_MAX_POINTS,
+    ):
+        """Query live data from the finest tier that returns at most max_points per series for the time range"""
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        tier = select_tier([raw_tier(raw_retention), *tiers], start=start, stop=stop, now=now, max_points=max_points)
+        logger.debug(f"Using tier {tier.name} for query from {start} to {stop}")
+        query = tier_query(self.bucket, tier, start=start, stop=stop, field=field, fn=fn, devices=devices)
+        return self.query(query)
+
+    def insert_rows(
+        self, device: str, rows: Iterable[CsvRow] | CsvRowBlock, writer: Optional[LineProtocolWriter] = None
+    ):
+        """Write CSV rows with a new batching WriteApi or, if given, a writer from bulk_writer()"""
+        with self._csv_write_api(device, writer) as write_api:
             row_count = 0
             point_count = 0
             start_time = time.time()
-            for row in rows:
-                row_count += 1
-                for point in point_converter.convert(device, row):
-                    assert point is not None
-                    result = write_api.write(org=self.org, bucket=self.bucket, record=point)
-                    point_count += 1
-                    assert result is None
+            if isinstance(rows, CsvRowBlock):
+                row_count, point_count = self._write_block(write_api, device, rows)
+            else:
+                for row in rows:
+                    row_count += 1
+                    with stage("point_conversion"), POINT_CONVERSION_SECONDS.time(source="csv"):
+                        points = list(self._point_converter.convert(device, row))
+                    WRITE_QUEUE_POINTS.inc(len(points))
+                    with stage("db_write"):
+                        for point in points:
+                            assert point is not None
+                            result = write_api.write(org=self.org, bucket=self.bucket, record=point)
+                            point_count += 1
+                            assert result is None
             duration = time.time() - start_time
             logger.debug(f"Wrote {point_count} points for {row_count} rows in {duration:.2f} seconds")
 
-    def batch_writer(self) -> "BatchWriter":
-        write_api = self._get_client().write_api(
-            write_options=WriteOptions(
-                write_type=WriteType.batching,
-                batch_size=1_000,
-                flush_interval=1_000,
-            ),
+    def insert_blocks(
+        self, device: str, blocks: Iterable[CsvRowBlock], writer: Optional[LineProtocolWriter] = None
+    ) -> int:
+        """Write blocks of CSV rows while they arrive, e.g. during a download. Returns the number of written rows.
+        Uses a writer from bulk_writer(), if given."""
+        with self._csv_write_api(device, writer) as write_api:
+            row_count = 0
+            point_count = 0
+            start_time = time.time()
+            for block in blocks:
+                rows, points = self._write_block(write_api, device, block)
+                row_count += rows
+                point_count += points
+            duration = time.time() - start_time
+            logger.debug(f"Wrote {point_count} points for {row_count} rows in {duration:.2f} seconds")
+        return row_count
+
+    def bulk_writer(self, options: LineWriterOptions) -> LineProtocolWriter:
+        """Writer for importing large amounts of CSV data, shared by insert_rows() and insert_blocks() calls for
+        several devices. The lines of consecutive rows of a device form a batch, and batches are sent
+        concurrently. Closing the writer waits until all batches are written."""
+        return self._line_protocol_writer(CSV_WRITE_PRECISION, options)
+
+    def _line_protocol_writer(self, precision: str, options: LineWriterOptions) -> LineProtocolWriter:
+        return LineProtocolWriter(
+            url=self.url,
+            token=self.token,
+            org=self.org,
+            precision=precision,
+            options=options,
+            callback=self._logging_callback,
+        )
+
+    def _csv_write_api(
+        self, device: str, writer: Optional[LineProtocolWriter] = None
+    ) -> WriteApi | contextlib.nullcontext[LineProtocolWriter]:
+        if writer is not None:
+            # The shared writer is closed by its owner
+            return contextlib.nullcontext(writer)
+        return self._get_client().write_api(
+            write_options=WriteOptions(write_type=WriteType.batching),
+            point_settings=PointSettings(device=device),
             success_callback=self._logging_callback.success,
             error_callback=self._logging_callback.error,
             retry_callback=self._logging_callback.retry,
         )
-        return BatchWriter(converter=PointConverter(), write_api=write_api, bucket=self.bucket)
+
+    def _write_block(
+        self, write_api: WriteApi | LineProtocolWriter, device: str, block: CsvRowBlock
+    ) -> tuple[int, int]:
+        point_count = 0
+        for index in range(len(block)):
+            with stage("point_conversion"), POINT_CONVERSION_SECONDS.time(source="csv"):
+                lines = self._point_converter.line_protocol(device, block, index)
+            WRITE_QUEUE_POINTS.inc(len(lines))
+            with stage("db_write"):
+                write_api.write(org=self.org, bucket=self.bucket, record=lines, write_precision=CSV_WRITE_PRECISION)
+            point_count += len(lines)
+        return len(block), point_count
+
+    def batch_writer(
+        self,
+        aggregate: Optional[datetime.timedelta] = None,
+        raw_bucket: Optional[str] = None,
+        deadband: Optional[DeadbandConfig] = None,
+        max_in_flight: Optional[int] = None,
+    ) -> "BatchWriter":
+        """Writer for live events. If an aggregation window is given, only aggregates per window are written to the
+        bucket and the raw events are written to raw_bucket, if given. Otherwise a deadband filter suppresses
+        unchanged values, if configured. Both are only supported with the narrow schema.
+        If max_in_flight is given, points are sent with a LineProtocolWriter with this many concurrent batches
+        instead of the client library's batching WriteApi."""
+        if aggregate is not None and deadband is not None:
+            raise ValueError("Aggregation and deadband filter cannot be combined")
+        schema = self._point_converter.schema
+        if schema != Schema.NARROW and (aggregate is not None or deadband is not None):
+            raise ValueError(f"Aggregation and deadband filter are not supported with the {schema.value} schema")
+        write_api: WriteApi | LineProtocolWriter
+        if max_in_flight is not None:
+            write_api = self._line_protocol_writer(WritePrecision.S, LineWriterOptions(max_in_flight=max_in_flight))
+        else:
+            write_api = self._get_client().write_api(
+                write_options=WriteOptions(
+                    write_type=WriteType.batching,
+                    batch_size=1_000,
+                    flush_interval=1_000,
+                ),
+                success_callback=self._logging_callback.success,
+                error_callback=self._logging_callback.error,
+                retry_callback=self._logging_callback.retry,
+            )
+        return BatchWriter(
+            converter=PointConverter(schema),
+            write_api=write_api,
+            bucket=self.bucket,
+            aggregator=EventAggregator(aggregate) if aggregate is not None else None,
+            raw_bucket=raw_bucket,
+            deadband=DeadbandFilter(deadband) if deadband is not None else None,
+        )
+
+    def migrate_to_wide(
+        self,
+        start: Optional[datetime.datetime],
+        stop: datetime.datetime,
+        chunk: datetime.timedelta = DEFAULT_CHUNK,
+        target_bucket: Optional[str] = None,
+    ) -> int:
+        """Copy the narrow data of the time range to the wide schema in target_bucket, default: the same bucket.
+        Without start, all data is copied. The database copies one chunk per query. Returns the number of copied
+        values."""
+        target_bucket = target_bucket or self.bucket
+        query_api = self._get_client().query_api()
+        if start is None:
+            records = [
+                record for table in query_api.query(first_timestamp_query(self.bucket)) for record in table.records
+            ]
+            if not records:
+                logger.info(f"No narrow data in bucket {self.bucket}")
+                return 0
+            start = records[0].get_time()
+        total = 0
+        for chunk_start, chunk_stop in migration_chunks(start, stop, chunk):
+            query = wide_migration_query(self.org, self.bucket, target_bucket, chunk_start, chunk_stop)
+            values = sum(int(record.get_value()) for table in query_api.query(query) for record in table.records)
+            logger.info(f"Migrated {values} values from {chunk_start} to {chunk_stop} to bucket {target_bucket}")
+            total += values
+        return total
 
     def query(self, query):
         query_api = self._get_client().query_api()
@@ -114,35 +372,76 @@ class DbClient:
 
 class BatchWriter:
     _converter: PointConverter
-    _write_api: Optional[WriteApi]
+    _write_api: Optional[WriteApi | LineProtocolWriter]
     _bucket: str
-
-    def __init__(self, converter: PointConverter, write_api: WriteApi, bucket: str):
+    _aggregator: Optional[EventAggregator]
+    _raw_bucket: Optional[str]
+    _deadband: Optional[DeadbandFilter]
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        converter: PointConverter,
+        write_api: WriteApi | LineProtocolWriter,
+        bucket: str,
+        aggregator: Optional[EventAggregator] = None,
+        raw_bucket: Optional[str] = None,
+        deadband: Optional[DeadbandFilter] = None,
+    ):
         self._converter = converter
         self._write_api = write_api
         self._bucket = bucket
+        self._aggregator = aggregator
+        self._raw_bucket = raw_bucket
+        self._deadband = deadband
 
-    def _get_write_api(self) -> WriteApi:
+    def _get_write_api(self) -> WriteApi | LineProtocolWriter:
         if self._write_api is None:
             raise ValueError("BatchWriter is closed")
         return self._write_api
 
     def insert_status_event(self, device: str, event: NotifyStatusEvent):
+        if self._aggregator is not None:
+            if self._raw_bucket is not None:
+                self._write_event(self._raw_bucket, device, event)
+            with stage("aggregation"):
+                points = self._aggregator.add(device, event)
+            self._write_points(self._bucket, points)
+        elif self._deadband is not None:
+            with stage("point_conversion"), POINT_CONVERSION_SECONDS.time(source="live"):
+                points = self._deadband.filter(device, event)
+            self._write_points(self._bucket, points)
+        else:
+            self._write_event(self._bucket, device, event)
+
+    def _write_event(self, bucket: str, device: str, event: NotifyStatusEvent) -> None:
+        with stage("point_conversion"), POINT_CONVERSION_SECONDS.time(source="live"):
+            points = list(self._converter.convert(device, event))
+        self._write_points(bucket, points)
+
+    def _write_points(self, bucket: str, points: list[Point]) -> None:
         write_api = self._get_write_api()
-        count = 0
-        for point in self._converter.convert(device, event):
-            assert point is not None
-            result = write_api.write(bucket=self._bucket, record=point)
-            assert result is None
-            count += 1
-        self.flush()
+        WRITE_QUEUE_POINTS.inc(len(points))
+        with stage("db_write"):
+            for point in points:
+                assert point is not None
+                result = write_api.write(bucket=bucket, record=point)
+                assert result is None
 
     def flush(self):
+        """Send buffered points. Not needed for writing, both write APIs send batches in the background."""
         self._get_write_api().flush()
 
     def close(self):
         if self._write_api is None:
             return
+        if self._aggregator is not None:
+            self._write_points(self._bucket, self._aggregator.flush())
+            logger.info(
+                f"Aggregated {self._aggregator.events} live events to {self._aggregator.points} points "
+                f"in windows of {self._aggregator.window}s"
+            )
+        if self._deadband is not None:
+            log_stats(self._deadband.stats())
         self._write_api.close()
         self._write_api = None
 
@@ -1,18 +1,97 @@
 import datetime
 import itertools
+import math
 from typing import Any, Callable, Iterable
 
 from influxdb_client import Point, WritePrecision
 
+from importer.aggregation import event_values
+from importer.csv_block import (
+    COLUMNS,
+    NEUTRAL_FIELDS,
+    NEUTRAL_OFFSET,
+    PHASE_FIELDS,
+    PHASES,
+    ROW_WIDTH,
+    CsvRowBlock,
+    CsvRowView,
+    PhaseView,
+)
 from importer.logger import MAIN_LOGGER
-from importer.model import CsvRow, EnergyMeterPhase, NotifyStatusEvent, PhaseData
+from importer.model import (
+    CsvRow,
+    EnergyMeterPhase,
+    NotifyStatusEvent,
+    PhaseData,
+    Schema,
+)
 
 logger = MAIN_LOGGER.getChild("db").getChild("converter")
 
 
+CSV_WRITE_PRECISION = WritePrecision.S
+MEASUREMENTS = {Schema.NARROW: "em", Schema.WIDE: "em_wide"}
+
+_LINE_FIELDS: list[list[tuple[str, int]]] = [
+    *(
+        sorted((field, index * len(PHASE_FIELDS) + offset) for offset, field in enumerate(PHASE_FIELDS))
+        for index in range(len(PHASES))
+    ),
+    sorted((field[2:], NEUTRAL_OFFSET + offset) for offset, field in enumerate(NEUTRAL_FIELDS)),
+]
+"""Field names and their offset in a block row, per line in the order of CsvRowPointConverter.convert.
+Fields are sorted by name like in Point.to_line_protocol()."""
+
+_WIDE_LINE_FIELDS: list[tuple[str, int]] = sorted((column, offset) for offset, column in enumerate(COLUMNS))
+"""Field names and their offset in a block row for the wide schema, sorted by name"""
+
+_WIDE_PREFIXES = {"neutral": "n"}
+"""Field name prefix of the phases whose prefix differs from the phase tag of the narrow schema"""
+
+
+def wide_field(phase: str, field: str) -> str:
+    """Field name of the wide schema for a field of a phase in the narrow schema, e.g. a_avg_voltage"""
+    return f"{_WIDE_PREFIXES.get(phase, phase)}_{field}"
+
+
+def _format_float(value: float) -> str:
+    text = str(value)
+    return text[:-2] if text.endswith(".0") else text
+
+
 class CsvRowPointConverter:
 
-    def convert(self, device: str, row: CsvRow) -> Iterable[Point]:
+    def __init__(self) -> None:
+        self._line_prefixes: dict[str, list[str]] = {}
+
+    def line_protocol(self, device: str, block: CsvRowBlock, index: int) -> list[str]:
+        """Line protocol of a row in a block, same as converting the row to points but without creating objects"""
+        values = block.values
+        offset = index * ROW_WIDTH
+        suffix = f" {block.timestamps[index]}"
+        lines = []
+        for prefix, fields in zip(self._get_line_prefixes(device), _LINE_FIELDS):
+            field_set = ",".join(
+                f"{name}={_format_float(values[offset + field_offset])}"
+                for name, field_offset in fields
+                if math.isfinite(values[offset + field_offset])
+            )
+            if field_set:
+                lines.append(prefix + field_set + suffix)
+        return lines
+
+    def _get_line_prefixes(self, device: str) -> list[str]:
+        """Measurement and escaped tags followed by a space for each line of a row"""
+        prefixes = self._line_prefixes.get(device)
+        if prefixes is None:
+            timestamp = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+            names = [phase.value for phase in PHASES] + ["neutral"]
+            lines = [self._point(device, name, timestamp).field("x", 0.0).to_line_protocol() for name in names]
+            prefixes = [line[: line.rindex(" x=0 ")] + " " for line in lines]
+            self._line_prefixes[device] = prefixes
+        return prefixes
+
+    def convert(self, device: str, row: CsvRow | CsvRowView) -> Iterable[Point]:
         phases = (self._create_phase_point(device, row, phase) for phase in row.phases)
         neutral = [self._create_neutral_point(device, row)]
         all_phases = itertools.chain(phases, neutral)
@@ -20,21 +99,21 @@ class CsvRowPointConverter:
 
     def _point(self, device: str, phase_name: str, timestamp: datetime.datetime) -> Point:
         return (
-            Point("em")
+            Point(MEASUREMENTS[Schema.NARROW])
             .tag("device", device)
             .tag("source", "csv")
             .tag("phase", str(phase_name))
-            .time(timestamp, write_precision=WritePrecision.S)
+            .time(timestamp, write_precision=CSV_WRITE_PRECISION)
         )
 
-    def _create_phase_point(self, device: str, row: CsvRow, phase: PhaseData) -> Point:
+    def _create_phase_point(self, device: str, row: CsvRow | CsvRowView, phase: PhaseData | PhaseView) -> Point:
         point = self._point(device, phase.phase_name.value, row.timestamp)
         for field in phase._fields:
             if field not in ("phase_name"):
                 point.field(field, getattr(phase, field))
         return point
 
-    def _create_neutral_point(self, device: str, row: CsvRow) -> Point:
+    def _create_neutral_point(self, device: str, row: CsvRow | CsvRowView) -> Point:
         point = self._point(device, "neutral", row.timestamp)
         for field in ["n_max_current", "n_min_current", "n_avg_current"]:
             point.field(field[2:], getattr(row, field))
@@ -59,7 +138,7 @@ class EventPointConverter:
 
     def _point(self, device: str, phase_name: str, timestamp: datetime.datetime) -> Point:
         return (
-            Point("em")
+            Point(MEASUREMENTS[Schema.NARROW])
             .tag("device", device)
             .tag("source", "live")
             .tag("phase", phase_name)
@@ -74,19 +153,97 @@ class EventPointConverter:
         return point
 
 
+class WideCsvRowPointConverter:
+    """Converts a CSV row to a single point with the columns of the CSV file as fields"""
+
+    def __init__(self) -> None:
+        self._line_prefixes: dict[str, str] = {}
+
+    def line_protocol(self, device: str, block: CsvRowBlock, index: int) -> list[str]:
+        """Line protocol of a row in a block, same as converting the row to points but without creating objects"""
+        values = block.values
+        offset = index * ROW_WIDTH
+        field_set = ",".join(
+            f"{name}={_format_float(values[offset + field_offset])}"
+            for name, field_offset in _WIDE_LINE_FIELDS
+            if math.isfinite(values[offset + field_offset])
+        )
+        if not field_set:
+            return []
+        return [self._get_line_prefix(device) + field_set + f" {block.timestamps[index]}"]
+
+    def _get_line_prefix(self, device: str) -> str:
+        prefix = self._line_prefixes.get(device)
+        if prefix is None:
+            timestamp = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+            line = self._point(device, timestamp).field("x", 0.0).to_line_protocol()
+            prefix = line[: line.rindex(" x=0 ")] + " "
+            self._line_prefixes[device] = prefix
+        return prefix
+
+    def convert(self, device: str, row: CsvRow | CsvRowView) -> Iterable[Point]:
+        point = self._point(device, row.timestamp)
+        for phase in row.phases:
+            for field in PHASE_FIELDS:
+                point.field(wide_field(phase.phase_name.value, field), getattr(phase, field))
+        for field in NEUTRAL_FIELDS:
+            point.field(field, getattr(row, field))
+        return [point]
+
+    def _point(self, device: str, timestamp: datetime.datetime) -> Point:
+        point: Point = (
+            Point(MEASUREMENTS[Schema.WIDE])
+            .tag("device", device)
+            .tag("source", "csv")
+            .time(timestamp, write_precision=CSV_WRITE_PRECISION)
+        )
+        return point
+
+
+class WideEventPointConverter:
+    """Converts a live event to a single point with the fields of all phases, e.g. a_act_power and total_act_power"""
+
+    def convert(self, device: str, event: NotifyStatusEvent) -> Iterable[Point]:
+        point = (
+            Point(MEASUREMENTS[Schema.WIDE])
+            .tag("device", device)
+            .tag("source", "live")
+            .time(event.timestamp, write_precision=WritePrecision.S)
+        )
+        for phase, field, value in event_values(event):
+            if value is not None:
+                point.field(wide_field(phase, field), value)
+        return [point]
+
+
 csv_converter = CsvRowPointConverter()
 event_converter = EventPointConverter()
+wide_csv_converter = WideCsvRowPointConverter()
+wide_event_converter = WideEventPointConverter()
 
 
 class PointConverter:
+    """Converts CSV rows and live events to the points of a schema"""
+
+    def __init__(self, schema: Schema = Schema.NARROW) -> None:
+        self.schema = schema
+        self._csv_converter: CsvRowPointConverter | WideCsvRowPointConverter = (
+            wide_csv_converter if schema == Schema.WIDE else csv_converter
+        )
+        self._event_converter: EventPointConverter | WideEventPointConverter = (
+            wide_event_converter if schema == Schema.WIDE else event_converter
+        )
+
+    def line_protocol(self, device: str, block: CsvRowBlock, index: int) -> list[str]:
+        return self._csv_converter.line_protocol(device, block, index)
 
-    def convert(self, device: str, row: CsvRow | NotifyStatusEvent) -> Iterable[Point]:
+    def convert(self, device: str, row: CsvRow | CsvRowView | NotifyStatusEvent) -> Iterable[Point]:
         convert = self._get_converter(row)
         return convert(device, row)
 
     def _get_converter(self, row) -> Callable[[str, Any], Iterable[Point]]:
-        if isinstance(row, CsvRow):
-            return csv_converter.convert
+        if isinstance(row, (CsvRow, CsvRowView)):
+            return self._csv_converter.convert
         if isinstance(row, NotifyStatusEvent):
-            return event_converter.convert
+            return self._event_converter.convert
         raise ValueError(f"Unsupported type {type(row)} {row}")
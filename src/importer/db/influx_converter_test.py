@@ -1,8 +1,10 @@
 import datetime
+import math
 
 from influxdb_client import Point
 
-from importer.db.influx_converter import PointConverter
+from importer.csv_block import COLUMNS, CsvRowBlock
+from importer.db.influx_converter import PointConverter, wide_field
 from importer.model import (
     CsvRow,
     EnergyMeterPhase,
@@ -10,6 +12,7 @@ from importer.model import (
     NotifyStatusEvent,
     Phase,
     PhaseData,
+    Schema,
 )
 
 TIMESTAMP = datetime.datetime.fromisoformat("2024-05-19T17:43:59Z")
@@ -37,8 +40,76 @@ def test_convert_csv_row():
     )
 
 
-def _convert(row: CsvRow | NotifyStatusEvent) -> list[Point]:
-    return list(PointConverter().convert(DEVICE, row))
+def test_block_line_protocol_equals_points():
+    rows = [
+        {
+            "timestamp": str(UNIX_TIMESTAMP + 60 * row),
+            **{column: str(row * 100 + index / 4) for index, column in enumerate(COLUMNS)},
+        }
+        for row in range(3)
+    ]
+    block = CsvRowBlock.from_dicts(rows)
+    converter = PointConverter()
+    for device in [DEVICE, "dev 1,=x"]:
+        for index, view in enumerate(block):
+            expected = [point.to_line_protocol() for point in converter.convert(device, view.to_row())]
+            assert converter.line_protocol(device, block, index) == expected
+
+
+def test_block_line_protocol_skips_non_finite_values():
+    block = CsvRowBlock.from_dicts([{"timestamp": str(UNIX_TIMESTAMP), **dict.fromkeys(COLUMNS, "1.5")}])
+    block.values[0] = math.nan
+    block.values[-3] = 0.0
+    block.values[-2] = 0.0
+    block.values[-1] = math.inf
+    lines = PointConverter().line_protocol(DEVICE, block, 0)
+    assert "total_act_energy" not in lines[0]
+    assert lines[-1] == f"em,device={DEVICE},phase=neutral,source=csv max_current=0,min_current=0 {UNIX_TIMESTAMP}"
+    assert lines == [point.to_line_protocol() for point in PointConverter().convert(DEVICE, block[0].to_row())]
+
+
+def test_convert_csv_row_wide():
+    row = CsvRow(
+        timestamp=TIMESTAMP, phases=[_phase_data(Phase.A)], n_max_current=1.1, n_min_current=2.2, n_avg_current=3.3
+    )
+    points = _convert(row, Schema.WIDE)
+    assert len(points) == 1
+    assert points[0].to_line_protocol() == (
+        f"em_wide,device={DEVICE},source=csv a_avg_current=1.1,a_avg_voltage=4.4,a_fund_act_energy=5.5,"
+        + "a_fund_act_ret_energy=6.6,a_lag_react_energy=7.7,a_lead_react_energy=8.8,a_max_act_power=9.9,"
+        + "a_max_aprt_power=13.13,a_max_current=2.2,a_max_voltage=15.15,a_min_act_power=12.12,a_min_aprt_power=14.14,"
+        + "a_min_current=3.3,a_min_voltage=16.16,a_total_act_energy=10.1,a_total_act_ret_energy=11.11,"
+        + f"n_avg_current=3.3,n_max_current=1.1,n_min_current=2.2 {UNIX_TIMESTAMP}"
+    )
+    assert _wide_fields(_convert(row)) == points[0]._fields
+
+
+def test_block_line_protocol_wide_equals_points():
+    block = CsvRowBlock.from_dicts(
+        [{"timestamp": str(UNIX_TIMESTAMP), **{column: str(index / 4) for index, column in enumerate(COLUMNS)}}]
+    )
+    block.values[1] = math.nan
+    converter = PointConverter(Schema.WIDE)
+    for device in [DEVICE, "dev 1,=x"]:
+        lines = converter.line_protocol(device, block, 0)
+        assert len(lines) == 1
+        assert "a_fund_act_energy" not in lines[0]
+        assert lines == [point.to_line_protocol() for point in converter.convert(device, block[0].to_row())]
+
+
+def test_block_line_protocol_wide_without_values():
+    block = CsvRowBlock.from_dicts([{"timestamp": str(UNIX_TIMESTAMP), **dict.fromkeys(COLUMNS, "nan")}])
+    assert not PointConverter(Schema.WIDE).line_protocol(DEVICE, block, 0)
+
+
+def _convert(row: CsvRow | NotifyStatusEvent, schema: Schema = Schema.NARROW) -> list[Point]:
+    return list(PointConverter(schema).convert(DEVICE, row))
+
+
+def _wide_fields(points: list[Point]) -> dict[str, float]:
+    """Fields of narrow points with the field names of the wide schema"""
+    # pylint: disable=protected-access
+    return {wide_field(point._tags["phase"], name): value for point in points for name, value in point._fields.items()}
 
 
 def _phase_data(phase_name: Phase) -> PhaseData:
@@ -78,6 +149,17 @@ def test_convert_event() -> None:
     )
 
 
+def test_convert_event_wide() -> None:
+    points = _convert(_create_event(), Schema.WIDE)
+    assert len(points) == 1
+    assert points[0].to_line_protocol() == (
+        f"em_wide,device={DEVICE},source=live a_act_power=1.1,a_aprt_power=2.2,a_current=3.3,a_freq=4.4,a_pf=5.5,"
+        + "a_voltage=6.6,n_current=1.1,total_act_power=1.1,total_aprt_power=2.2,total_current=3.3 "
+        + f"{UNIX_TIMESTAMP}"
+    )
+    assert _wide_fields(_convert(_create_event())) == points[0]._fields
+
+
 def _create_event():
     return NotifyStatusEvent(
         src="src",
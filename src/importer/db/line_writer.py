@@ -0,0 +1,253 @@
+import gzip
+import random
+import threading
+import time
+from concurrent import futures
+from typing import NamedTuple, Optional, Protocol
+from urllib.parse import urlencode
+
+import urllib3
+from influxdb_client import Point, WritePrecision
+from influxdb_client.client.exceptions import InfluxDBError
+
+from importer.logger import MAIN_LOGGER
+from importer.profiling import stage
+
+logger = MAIN_LOGGER.getChild("db").getChild("line_writer")
+
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+"""Status codes of failed writes that are retried, all other errors drop the batch"""
+
+
+class BatchCallback(Protocol):
+    """Receives the result of each batch, with the same arguments as the callbacks of the client library's WriteApi:
+    bucket, org and precision, and the uncompressed line protocol"""
+
+    def success(self, conf: tuple[str, str, str], data: str | bytes): ...
+
+    def error(self, conf: tuple[str, str, str], data: str | bytes, exception: InfluxDBError): ...
+
+    def retry(self, conf: tuple[str, str, str], data: str | bytes, exception: InfluxDBError): ...
+
+
+class LineWriterOptions(NamedTuple):
+    batch_size: int = 5_000
+    """Lines per request"""
+    flush_interval: float = 1.0
+    """Seconds after which an incomplete batch is sent"""
+    max_in_flight: int = 4
+    """Batches sent concurrently, each on its own connection"""
+    gzip_level: Optional[int] = 1
+    """Compression level of the request bodies, None sends them uncompressed"""
+    max_retries: int = 5
+    retry_interval: float = 1.0
+    """Seconds before the first retry, doubled for each further retry"""
+    max_retry_interval: float = 30.0
+    timeout: float = 30.0
+    """Seconds to wait for a response"""
+
+
+class WriteStats(NamedTuple):
+    batches: int
+    lines: int
+    body_bytes: int
+    """Bytes sent, after compression"""
+    retries: int
+    failed_batches: int
+    elapsed: float = 0.0
+    """Seconds since the writer was created, until it was closed"""
+
+    @property
+    def lines_per_second(self) -> float:
+        return self.lines / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class _Buffer:
+    __slots__ = ("lines", "created")
+
+    def __init__(self) -> None:
+        self.lines: list[str] = []
+        self.created = time.monotonic()
+
+
+class LineProtocolWriter:  # pylint: disable=too-many-instance-attributes
+    """Writes line protocol to the InfluxDB v2 write endpoint in batches, replacing the client library's batching
+    WriteApi and its Rx scheduler threads.
+
+    Lines are buffered per bucket and sent when a buffer reaches batch_size lines or flush_interval seconds after
+    its first line. Up to max_in_flight gzip compressed batches are sent concurrently over keep-alive connections.
+    Writes rejected with a status in RETRY_STATUS_CODES and connection errors are retried with exponential backoff,
+    honoring Retry-After. When max_in_flight batches are in flight, write() blocks until one completes, so a slow
+    database slows down the producers instead of filling the memory. Thread-safe."""
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        url: str,
+        token: str,
+        org: str,
+        precision: str = WritePrecision.S,
+        options: LineWriterOptions = LineWriterOptions(),
+        callback: Optional[BatchCallback] = None,
+    ) -> None:
+        self._url = url.rstrip("/") + "/api/v2/write"
+        self._org = org
+        self._precision = str(precision)
+        self._options = options
+        self._callback = callback
+        self._headers = {"Authorization": f"Token {token}", "Content-Type": "text/plain; charset=utf-8"}
+        if options.gzip_level is not None:
+            self._headers["Content-Encoding"] = "gzip"
+        self._pool = urllib3.PoolManager(num_pools=1, maxsize=options.max_in_flight, block=True)
+        self._executor = futures.ThreadPoolExecutor(max_workers=options.max_in_flight, thread_name_prefix="write")
+        self._slots = threading.BoundedSemaphore(options.max_in_flight)
+        self._lock = threading.Lock()
+        self._buffers: dict[str, _Buffer] = {}
+        self._in_flight: set[futures.Future] = set()
+        self._stats = WriteStats(batches=0, lines=0, body_bytes=0, retries=0, failed_batches=0)
+        self._started = time.monotonic()
+        self._finished: Optional[float] = None
+        self._closed = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="write-flush", daemon=True)
+        self._flush_thread.start()
+
+    def write(self, bucket: str, record: Point | str | list[str] | list[Point], **_kwargs) -> None:
+        """Add points or lines to the bucket's batch. Ignores further arguments of WriteApi.write()."""
+        if self._closed.is_set():
+            raise ValueError("Writer is closed")
+        records = record if isinstance(record, list) else [record]
+        lines = [item if isinstance(item, str) else item.to_line_protocol(self._precision) for item in records]
+        batch_size = self._options.batch_size
+        batches = []
+        with self._lock:
+            buffer = self._buffers.get(bucket)
+            if buffer is None:
+                buffer = self._buffers[bucket] = _Buffer()
+            buffer.lines.extend(line for line in lines if line)
+            while len(buffer.lines) >= batch_size:
+                batches.append(buffer.lines[:batch_size])
+                del buffer.lines[:batch_size]
+            if not buffer.lines:
+                del self._buffers[bucket]
+        for batch in batches:
+            self._submit(bucket, batch)
+
+    def flush(self) -> None:
+        """Send all buffered lines and wait until all batches are written"""
+        with self._lock:
+            buffers = self._buffers
+            self._buffers = {}
+        for bucket, buffer in buffers.items():
+            self._submit(bucket, buffer.lines)
+        with self._lock:
+            in_flight = list(self._in_flight)
+        futures.wait(in_flight)
+
+    def stats(self) -> WriteStats:
+        with self._lock:
+            return self._stats._replace(elapsed=(self._finished or time.monotonic()) - self._started)
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flush_thread.join()
+        self.flush()
+        self._executor.shutdown()
+        self._pool.clear()
+        self._finished = time.monotonic()
+        stats = self.stats()
+        logger.info(
+            f"Wrote {stats.lines} lines in {stats.batches} batches ({stats.body_bytes} bytes) in {stats.elapsed:.2f}s "
+            f"({stats.lines_per_second:.0f} lines/s), {stats.retries} retries, {stats.failed_batches} failed batches"
+        )
+
+    def _flush_loop(self) -> None:
+        interval = self._options.flush_interval
+        while not self._closed.wait(interval / 4):
+            now = time.monotonic()
+            with self._lock:
+                expired = [bucket for bucket, buffer in self._buffers.items() if now - buffer.created >= interval]
+                batches = [(bucket, self._buffers.pop(bucket).lines) for bucket in expired]
+            for bucket, lines in batches:
+                self._submit(bucket, lines)
+
+    def _submit(self, bucket: str, lines: list[str]) -> None:
+        if not lines:
+            return
+        self._slots.acquire()  # pylint: disable=consider-using-with
+        future = self._executor.submit(self._send, bucket, lines)
+        with self._lock:
+            self._in_flight.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: futures.Future) -> None:
+        with self._lock:
+            self._in_flight.discard(future)
+        self._slots.release()
+
+    def _send(self, bucket: str, lines: list[str]) -> None:
+        conf = (bucket, self._org, self._precision)
+        with stage("db_compress"):
+            data = "\n".join(lines).encode()
+            body = gzip.compress(data, self._options.gzip_level) if self._options.gzip_level is not None else data
+        attempt = 0
+        while True:
+            with stage("db_send"):
+                error, retry_after = self._post(bucket, body)
+            if error is None:
+                self._count(batches=1, lines=len(lines), body_bytes=len(body))
+                if self._callback is not None:
+                    self._callback.success(conf, data)
+                return
+            if retry_after is None or attempt >= self._options.max_retries:
+                logger.debug(f"Giving up batch of {len(lines)} lines for bucket {bucket} after {attempt} retries")
+                self._count(failed_batches=1)
+                if self._callback is not None:
+                    self._callback.error(conf, data, error)
+                return
+            self._count(retries=1)
+            if self._callback is not None:
+                self._callback.retry(conf, data, error)
+            backoff = self._options.retry_interval * 2**attempt * random.uniform(0.5, 1.0)
+            time.sleep(min(max(retry_after, backoff), self._options.max_retry_interval))
+            attempt += 1
+
+    def _post(self, bucket: str, body: bytes) -> tuple[Optional[InfluxDBError], Optional[float]]:
+        """Send a request. Returns the error, if any, and for retryable errors the seconds the server asked to
+        wait, 0 if it did not"""
+        try:
+            response = self._pool.request(
+                "POST",
+                f"{self._url}?{urlencode({'org': self._org, 'bucket': bucket, 'precision': self._precision})}",
+                body=body,
+                headers=self._headers,
+                retries=False,
+                timeout=self._options.timeout,
+            )
+        except urllib3.exceptions.HTTPError as e:
+            return InfluxDBError(message=f"{type(e).__name__}: {e}"), 0.0
+        if 200 <= response.status < 300:
+            return None, None
+        error = InfluxDBError(response=response)  # type: ignore[arg-type]
+        if response.status not in RETRY_STATUS_CODES:
+            return error, None
+        return error, _retry_after(response.headers.get("Retry-After"))
+
+    def _count(self, **counts: int) -> None:
+        with self._lock:
+            self._stats = self._stats._replace(
+                **{name: getattr(self._stats, name) + value for name, value in counts.items()}
+            )
+
+    def __enter__(self) -> "LineProtocolWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def _retry_after(value: Optional[str]) -> float:
+    try:
+        return max(float(value), 0.0) if value is not None else 0.0
+    except ValueError:
+        return 0.0
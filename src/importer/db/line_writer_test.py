@@ -0,0 +1,220 @@
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, NamedTuple
+from unittest.mock import Mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from influxdb_client import Point
+
+from importer.csv_block import COLUMNS, CsvRowBlock
+from importer.db.influx import DbClient
+from importer.db.influx_converter import PointConverter
+from importer.db.line_writer import LineProtocolWriter, LineWriterOptions
+
+OPTIONS = LineWriterOptions(batch_size=3, flush_interval=0.05, max_in_flight=2, retry_interval=0.0)
+
+
+class Request(NamedTuple):
+    params: dict[str, list[str]]
+    headers: dict[str, str]
+    lines: list[str]
+
+
+class WriteServer(ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), WriteHandler)
+        self.requests: list[Request] = []
+        self.responses: list[tuple[int, dict[str, str]]] = []
+        """Status and headers of the next responses, 204 when empty"""
+        self.release = threading.Event()
+        self.release.set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def lines(self) -> list[str]:
+        return [line for request in self.requests for line in request.lines]
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    server: WriteServer
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+            status, headers = self.server.responses.pop(0) if self.server.responses else (204, {})
+            if status == 204:
+                self.server.requests.append(
+                    Request(parse_qs(urlparse(self.path).query), dict(self.headers), body.decode().splitlines())
+                )
+        self.server.release.wait(5)
+        with self.server.lock:
+            self.server.active -= 1
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        body = b'{"code":"error","message":"rejected"}' if status != 204 else b""
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture(name="server")
+def fixture_server() -> Iterator[WriteServer]:
+    server = WriteServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def _writer(server: WriteServer, options: LineWriterOptions = OPTIONS, callback=None) -> LineProtocolWriter:
+    return LineProtocolWriter(url=server.url, token="token", org="org", options=options, callback=callback)
+
+
+def test_write_batches_compressed(server: WriteServer):
+    with _writer(server) as writer:
+        writer.write("bucket", [f"em value={value} {value}" for value in range(7)])
+    # Batches are sent concurrently and may arrive in any order
+    assert sorted(len(request.lines) for request in server.requests) == [1, 3, 3]
+    assert sorted(server.lines) == [f"em value={value} {value}" for value in range(7)]
+    request = server.requests[0]
+    assert request.params == {"org": ["org"], "bucket": ["bucket"], "precision": ["s"]}
+    assert request.headers["Authorization"] == "Token token"
+    assert request.headers["Content-Encoding"] == "gzip"
+    assert writer.stats().batches == 3
+    assert writer.stats().lines == 7
+
+
+def test_write_points_and_buckets(server: WriteServer):
+    with _writer(server, OPTIONS._replace(gzip_level=None)) as writer:
+        writer.write("bucket1", Point("em").tag("device", "d").field("value", 1.5).time(1716140639, "s"))
+        writer.write("bucket2", "em value=2 1716140639")
+    assert sorted((request.params["bucket"][0], request.lines) for request in server.requests) == [
+        ("bucket1", ["em,device=d value=1.5 1716140639"]),
+        ("bucket2", ["em value=2 1716140639"]),
+    ]
+    assert "Content-Encoding" not in server.requests[0].headers
+
+
+def test_incomplete_batch_is_sent_after_flush_interval(server: WriteServer):
+    callback = Mock()
+    sent = threading.Event()
+    callback.success.side_effect = lambda conf, data: sent.set()
+    with _writer(server, callback=callback) as writer:
+        writer.write("bucket", "em value=1 1")
+        assert sent.wait(5)
+        assert server.lines == ["em value=1 1"]
+    callback.success.assert_called_once_with(("bucket", "org", "s"), b"em value=1 1")
+
+
+def test_retry_with_backoff(server: WriteServer):
+    server.responses = [(503, {"Retry-After": "0"}), (429, {})]
+    callback = Mock()
+    with _writer(server, callback=callback) as writer:
+        writer.write("bucket", ["em value=1 1", "em value=2 2", "em value=3 3"])
+        writer.flush()
+    assert server.lines == ["em value=1 1", "em value=2 2", "em value=3 3"]
+    assert callback.retry.call_count == 2
+    assert callback.retry.call_args.args[2].message == "rejected"
+    callback.error.assert_not_called()
+    assert writer.stats().retries == 2
+
+
+def test_give_up_after_max_retries(server: WriteServer):
+    server.responses = [(503, {})] * 3
+    callback = Mock()
+    with _writer(server, OPTIONS._replace(max_retries=2), callback) as writer:
+        writer.write("bucket", "em value=1 1")
+    assert not server.lines
+    assert callback.retry.call_count == 2
+    callback.error.assert_called_once()
+    assert writer.stats().failed_batches == 1
+
+
+def test_client_error_is_not_retried(server: WriteServer):
+    server.responses = [(400, {})]
+    callback = Mock()
+    with _writer(server, callback=callback) as writer:
+        writer.write("bucket", "em value=x 1")
+        writer.write("bucket", "em value=1 1")
+    callback.retry.assert_not_called()
+    callback.error.assert_called_once()
+    assert callback.error.call_args.args[1] == b"em value=x 1\nem value=1 1"
+
+
+def test_connection_error_is_retried():
+    callback = Mock()
+    options = OPTIONS._replace(max_retries=1, timeout=1.0)
+    with LineProtocolWriter(url="http://127.0.0.1:1", token="t", org="o", options=options, callback=callback) as writer:
+        writer.write("bucket", "em value=1 1")
+    callback.retry.assert_called_once()
+    callback.error.assert_called_once()
+
+
+def test_in_flight_batches_are_limited(server: WriteServer):
+    server.release.clear()
+    writer = _writer(server, OPTIONS._replace(batch_size=1))
+    done = threading.Event()
+
+    def write() -> None:
+        for value in range(6):
+            writer.write("bucket", f"em value={value} {value}")
+        done.set()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    # The writing thread blocks while two batches are in flight
+    assert not done.wait(0.5)
+    server.release.set()
+    thread.join(5)
+    writer.close()
+    assert server.max_active == 2
+    assert sorted(server.lines) == [f"em value={value} {value}" for value in range(6)]
+
+
+def test_write_after_close_fails(server: WriteServer):
+    writer = _writer(server)
+    writer.close()
+    with pytest.raises(ValueError, match="Writer is closed"):
+        writer.write("bucket", "em value=1 1")
+
+
+def test_bulk_import(server: WriteServer):
+    blocks = {
+        device: CsvRowBlock.from_dicts(
+            [{"timestamp": str(60 * row), **dict.fromkeys(COLUMNS, str(row))} for row in range(10)]
+        )
+        for device in ["dev1", "dev2"]
+    }
+    with DbClient(url=server.url, token="token", org="org", bucket="em") as db:
+        with db.bulk_writer(OPTIONS._replace(batch_size=8)) as writer:
+            db.insert_rows("dev1", blocks["dev1"], writer=writer)
+            assert db.insert_blocks("dev2", [blocks["dev2"]], writer=writer) == 10
+    converter = PointConverter()
+    expected = [
+        line
+        for device, block in blocks.items()
+        for row in range(10)
+        for line in converter.line_protocol(device, block, row)
+    ]
+    assert sorted(server.lines) == sorted(expected)
+    assert writer.stats().lines == 80
+    assert writer.stats().batches == 10
+    assert {request.params["precision"][0] for request in server.requests} == {"s"}
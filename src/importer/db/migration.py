@@ -0,0 +1,58 @@
+import datetime
+from typing import Iterator
+
+from importer.db.downsampling import flux_time
+from importer.db.influx_converter import MEASUREMENTS
+from importer.model import Schema
+
+DEFAULT_CHUNK = datetime.timedelta(days=1)
+
+
+def migration_chunks(
+    start: datetime.datetime, stop: datetime.datetime, chunk: datetime.timedelta = DEFAULT_CHUNK
+) -> Iterator[tuple[datetime.datetime, datetime.datetime]]:
+    """Split the time range into chunks, so the database processes a bounded amount of data per query"""
+    if chunk <= datetime.timedelta(0):
+        raise ValueError(f"Chunk must be positive, got {chunk}")
+    while start < stop:
+        end = min(start + chunk, stop)
+        yield start, end
+        start = end
+
+
+def first_timestamp_query(bucket: str) -> str:
+    """Create a Flux query for the timestamp of the oldest narrow value in the bucket"""
+    lines = [
+        f'from(bucket: "{bucket}")',
+        "  |> range(start: 0)",
+        f'  |> filter(fn: (r) => r["_measurement"] == "{MEASUREMENTS[Schema.NARROW]}")',
+        '  |> keep(columns: ["_time", "_value"])',
+        "  |> group()",
+        '  |> min(column: "_time")',
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def wide_migration_query(
+    org: str, source_bucket: str, target_bucket: str, start: datetime.datetime, stop: datetime.datetime
+) -> str:
+    """Create a Flux query copying the narrow data of a time range to the wide schema, see
+    importer.model.Schema.
+
+    Each value keeps its timestamp, device and source, the phase tag becomes the prefix of the field name
+    (neutral: n). Points aggregated by the live importer are skipped, they only exist in the narrow schema.
+    Writing a value twice overwrites it, so running the query again for the same range is safe."""
+    lines = [
+        f'from(bucket: "{source_bucket}")',
+        f"  |> range(start: {flux_time(start)}, stop: {flux_time(stop)})",
+        f'  |> filter(fn: (r) => r["_measurement"] == "{MEASUREMENTS[Schema.NARROW]}")',
+        '  |> filter(fn: (r) => not exists r["agg"])',
+        "  |> map(fn: (r) => ({r with",
+        f'      _measurement: "{MEASUREMENTS[Schema.WIDE]}",',
+        '      _field: (if r["phase"] == "neutral" then "n" else r["phase"]) + "_" + r["_field"],',
+        "  }))",
+        '  |> drop(columns: ["phase"])',
+        f'  |> to(bucket: "{target_bucket}", org: "{org}")',
+        "  |> count()",
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,37 @@
+import datetime
+
+import pytest
+
+from importer.db.migration import migration_chunks, wide_migration_query
+
+START = datetime.datetime.fromisoformat("2024-05-19T00:00:00Z")
+DAY = datetime.timedelta(days=1)
+
+
+def test_migration_chunks():
+    stop = START + 2 * DAY + datetime.timedelta(hours=6)
+    assert list(migration_chunks(START, stop, DAY)) == [
+        (START, START + DAY),
+        (START + DAY, START + 2 * DAY),
+        (START + 2 * DAY, stop),
+    ]
+
+
+def test_migration_chunks_empty_range():
+    assert not list(migration_chunks(START, START, DAY))
+
+
+def test_migration_chunks_invalid():
+    with pytest.raises(ValueError, match="Chunk must be positive"):
+        list(migration_chunks(START, START + DAY, datetime.timedelta(0)))
+
+
+def test_wide_migration_query():
+    query = wide_migration_query("org", "em", "em_wide", START, START + DAY)
+    assert query.startswith('from(bucket: "em")\n  |> range(start: 2024-05-19T00:00:00Z, stop: 2024-05-20T00:00:00Z)\n')
+    assert '|> filter(fn: (r) => r["_measurement"] == "em")' in query
+    assert '|> filter(fn: (r) => not exists r["agg"])' in query
+    assert '_measurement: "em_wide",' in query
+    assert '_field: (if r["phase"] == "neutral" then "n" else r["phase"]) + "_" + r["_field"],' in query
+    assert '|> drop(columns: ["phase"])' in query
+    assert '|> to(bucket: "em_wide", org: "org")' in query
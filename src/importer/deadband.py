@@ -0,0 +1,129 @@
+import datetime
+import re
+import threading
+from typing import NamedTuple
+
+from influxdb_client import Point, WritePrecision
+
+from importer.aggregation import event_values
+from importer.logger import MAIN_LOGGER
+from importer.metrics import DEADBAND_VALUES
+from importer.model import NotifyStatusEvent
+
+logger = MAIN_LOGGER.getChild("deadband")
+
+
+class DeadbandRule(NamedTuple):
+    """A value is suppressed if it differs from the last written value of its field by at most the absolute
+    threshold or the relative threshold times the last written value, whichever is larger"""
+
+    absolute: float = 0.0
+    relative: float = 0.0
+
+    def suppresses(self, value: float, last: float) -> bool:
+        return abs(value - last) <= max(self.absolute, self.relative * abs(last))
+
+
+DEFAULT_RULES = {
+    "voltage": DeadbandRule(absolute=0.5),
+    "freq": DeadbandRule(absolute=0.05),
+    "pf": DeadbandRule(absolute=0.02),
+    "current": DeadbandRule(absolute=0.01, relative=0.01),
+    "act_power": DeadbandRule(absolute=1.0, relative=0.01),
+    "aprt_power": DeadbandRule(absolute=1.0, relative=0.01),
+}
+"""Thresholds per field, fields without rule are suppressed only if they did not change at all"""
+
+DEFAULT_HEARTBEAT = datetime.timedelta(seconds=60)
+
+
+class DeadbandConfig(NamedTuple):
+    rules: dict[str, DeadbandRule]
+    heartbeat: datetime.timedelta = DEFAULT_HEARTBEAT
+    """Maximum time without writing a field, so that queries find a recent value"""
+
+
+class DeadbandStats(NamedTuple):
+    written: int
+    suppressed: int
+
+
+def parse_rules(spec: str) -> dict[str, DeadbandRule]:
+    """Parse thresholds like 'voltage=1,act_power=2%' into rules, percentages are relative thresholds.
+    The rules replace the default rules of the given fields."""
+    rules = dict(DEFAULT_RULES)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        match = re.fullmatch(r"(\w+)=(\d+(?:\.\d+)?)(%?)", item)
+        if match is None:
+            raise ValueError(f"Invalid deadband rule '{item}', use <field>=<absolute> or <field>=<relative>%")
+        field, threshold, percent = match.groups()
+        rules[field] = DeadbandRule(relative=float(threshold) / 100) if percent else DeadbandRule(float(threshold))
+    return rules
+
+
+class DeadbandFilter:
+    """Converts live events to points containing only the fields that changed by more than their deadband since
+    they were last written, or that were not written for the heartbeat interval. Points without fields are dropped.
+    Thread-safe, the state is kept per device, phase and field."""
+
+    def __init__(self, config: DeadbandConfig) -> None:
+        self._rules = config.rules
+        self._heartbeat = config.heartbeat.total_seconds()
+        self._last: dict[tuple[str, str, str], tuple[float, float]] = {}
+        """Last written value and its timestamp per device, phase and field"""
+        self._stats: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, device: str, event: NotifyStatusEvent) -> list[Point]:
+        timestamp = event.timestamp.timestamp()
+        fields: dict[str, dict[str, float]] = {}
+        written = 0
+        suppressed = 0
+        with self._lock:
+            for phase, field, value in event_values(event):
+                if value is None:
+                    continue
+                key = (device, phase, field)
+                last = self._last.get(key)
+                if (
+                    last is not None
+                    and timestamp - last[1] < self._heartbeat
+                    and self._rules.get(field, DeadbandRule()).suppresses(value, last[0])
+                ):
+                    suppressed += 1
+                    continue
+                self._last[key] = (value, timestamp)
+                fields.setdefault(phase, {})[field] = value
+                written += 1
+            stats = self._stats.setdefault(device, [0, 0])
+            stats[0] += written
+            stats[1] += suppressed
+        DEADBAND_VALUES.inc(written, device=device, result="written")
+        DEADBAND_VALUES.inc(suppressed, device=device, result="suppressed")
+        return [self._point(device, phase, event.timestamp, values) for phase, values in fields.items()]
+
+    def stats(self) -> dict[str, DeadbandStats]:
+        """Written and suppressed values per device"""
+        with self._lock:
+            return {device: DeadbandStats(*counts) for device, counts in self._stats.items()}
+
+    def _point(self, device: str, phase: str, timestamp: datetime.datetime, values: dict[str, float]) -> Point:
+        point: Point = (
+            Point("em")
+            .tag("device", device)
+            .tag("source", "live")
+            .tag("phase", phase)
+            .time(timestamp, write_precision=WritePrecision.S)
+        )
+        for field, value in values.items():
+            point.field(field, value)
+        return point
+
+
+def log_stats(stats: dict[str, DeadbandStats]) -> None:
+    for device, device_stats in sorted(stats.items()):
+        total = device_stats.written + device_stats.suppressed
+        share = device_stats.suppressed / total if total else 0.0
+        logger.info(
+            f"Device {device}: wrote {device_stats.written} values, suppressed {device_stats.suppressed} ({share:.0%})"
+        )
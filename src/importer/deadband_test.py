@@ -0,0 +1,96 @@
+import datetime
+from unittest.mock import Mock
+
+import pytest
+
+from importer.aggregation_test import _event
+from importer.db.influx import BatchWriter
+from importer.db.influx_converter import PointConverter
+from importer.deadband import (
+    DEFAULT_RULES,
+    DeadbandConfig,
+    DeadbandFilter,
+    DeadbandRule,
+    DeadbandStats,
+    parse_rules,
+)
+from importer.metrics import DEADBAND_VALUES
+
+VALUES_PER_EVENT = 3 * 6 + 1 + 3
+
+
+def _fields(points) -> dict[str, set[str]]:
+    return {point._tags["phase"]: set(point._fields) for point in points}  # pylint: disable=protected-access
+
+
+def test_rule():
+    assert DeadbandRule(absolute=1.0).suppresses(10.5, 10.0)
+    assert not DeadbandRule(absolute=1.0).suppresses(11.5, 10.0)
+    assert DeadbandRule(relative=0.1).suppresses(105.0, 100.0)
+    assert not DeadbandRule(relative=0.1).suppresses(89.0, 100.0)
+    assert DeadbandRule().suppresses(1.0, 1.0)
+    assert not DeadbandRule().suppresses(1.0, 1.01)
+
+
+def test_first_event_is_written_completely():
+    points = DeadbandFilter(DeadbandConfig(DEFAULT_RULES)).filter("dev", _event(0, 100.0))
+    assert _fields(points)["a"] == {"current", "voltage", "act_power", "aprt_power", "pf", "freq"}
+    assert _fields(points)["neutral"] == {"current"}
+    assert _fields(points)["total"] == {"current", "act_power", "aprt_power"}
+
+
+def test_unchanged_values_are_suppressed():
+    deadband = DeadbandFilter(DeadbandConfig(DEFAULT_RULES))
+    deadband.filter("dev", _event(0, 100.0))
+    assert not deadband.filter("dev", _event(1, 100.5))
+    assert _fields(deadband.filter("dev", _event(2, 110.0))) == {
+        "a": {"act_power"},
+        "b": {"act_power"},
+        "c": {"act_power"},
+        "total": {"act_power"},
+    }
+    assert deadband.stats() == {"dev": DeadbandStats(written=VALUES_PER_EVENT + 4, suppressed=2 * VALUES_PER_EVENT - 4)}
+
+
+def test_small_changes_do_not_accumulate_unnoticed():
+    deadband = DeadbandFilter(DeadbandConfig({"act_power": DeadbandRule(absolute=1.0)}))
+    deadband.filter("dev", _event(0, 100.0))
+    assert "act_power" not in _fields(deadband.filter("dev", _event(1, 100.6))).get("a", set())
+    # Compared with the last written value, not the last received one
+    assert "act_power" in _fields(deadband.filter("dev", _event(2, 101.2)))["a"]
+
+
+def test_heartbeat_writes_unchanged_values():
+    deadband = DeadbandFilter(DeadbandConfig(DEFAULT_RULES, heartbeat=datetime.timedelta(seconds=30)))
+    deadband.filter("dev", _event(0, 100.0))
+    assert not deadband.filter("dev", _event(29, 100.0))
+    assert len(deadband.filter("dev", _event(30, 100.0))) == 5
+
+
+def test_devices_are_filtered_separately():
+    deadband = DeadbandFilter(DeadbandConfig(DEFAULT_RULES))
+    deadband.filter("dev1", _event(0, 100.0))
+    assert len(deadband.filter("dev2", _event(1, 100.0))) == 5
+    written = DEADBAND_VALUES.value(device="dev2", result="written")
+    deadband.filter("dev2", _event(2, 100.0))
+    assert DEADBAND_VALUES.value(device="dev2", result="written") == written
+
+
+def test_parse_rules():
+    rules = parse_rules("voltage=1.5, act_power=2%")
+    assert rules["voltage"] == DeadbandRule(absolute=1.5)
+    assert rules["act_power"] == DeadbandRule(relative=0.02)
+    assert rules["freq"] == DEFAULT_RULES["freq"]
+    assert parse_rules("") == DEFAULT_RULES
+    with pytest.raises(ValueError, match="Invalid deadband rule 'voltage'"):
+        parse_rules("voltage")
+
+
+def test_batch_writer_with_deadband():
+    write_api = Mock()
+    write_api.write.return_value = None
+    writer = BatchWriter(PointConverter(), write_api, bucket="em", deadband=DeadbandFilter(DeadbandConfig({})))
+    for second in range(10):
+        writer.insert_status_event("dev", _event(second, 10.0))
+    writer.close()
+    assert write_api.write.call_count == 5
@@ -0,0 +1,272 @@
+import heapq
+import threading
+import time
+from concurrent import futures
+from typing import Callable, Generic, NamedTuple, Optional, Sequence, TypeVar
+
+from importer.logger import MAIN_LOGGER
+from importer.metrics import REGISTRY
+from importer.shelly import ChunkCallback
+
+logger = MAIN_LOGGER.getChild("download")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+GROWTH_THRESHOLD = 0.1
+"""Relative gain of the total throughput required to keep a higher concurrency"""
+
+DOWNLOAD_RETRIES = REGISTRY.counter("importer_download_retries_total", "Retried CSV downloads per device", ("device",))
+DOWNLOAD_FAILURES = REGISTRY.counter(
+    "importer_download_failures_total", "CSV downloads that failed after all retries per device", ("device",)
+)
+
+
+class DownloadOptions(NamedTuple):
+    initial_concurrency: int = 4
+    """Downloads started at first, the concurrency grows while the total throughput increases"""
+    max_concurrency: int = 16
+    """Upper limit of concurrent downloads"""
+    max_bandwidth: Optional[float] = None
+    """Bytes per second of all downloads together, None means unlimited"""
+    device_timeout: Optional[float] = None
+    """Seconds after which the download of a device is aborted and retried, None means no limit.
+    A stalled connection is detected earlier by the read timeout of the request."""
+    max_retries: int = 3
+    """Retries of a failed download before the device is given up"""
+    retry_delay: float = 1.0
+    """Seconds before retrying a failed download, doubled for each further failure"""
+    adjust_interval: float = 2.0
+    """Seconds of throughput measured before changing the concurrency"""
+
+
+class DownloadStats(NamedTuple):
+    downloads: int
+    failures: int
+    """Downloads given up after all retries"""
+    retries: int
+    bytes: int
+    elapsed: float
+    peak_concurrency: int
+    """Highest concurrency reached"""
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class DownloadTimeout(Exception):
+    pass
+
+
+class _TokenBucket:
+    """Limits the bytes per second of all downloads, a download exceeding the budget sleeps until it is repaid"""
+
+    def __init__(self, rate: float) -> None:
+        self._rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate) - size
+            self._updated = now
+            delay = -self._tokens / self._rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _ConcurrencyController:
+    """Hill climbing on the total throughput, i.e. the sum of the throughput of all running downloads.
+
+    While the devices limit the throughput per download, more concurrent downloads increase the total throughput
+    and the concurrency grows by half. Once the link is saturated, the throughput per download drops instead and
+    the concurrency returns to the previous value. A failed download halves the concurrency, at most once per window."""
+
+    def __init__(self, initial: int, maximum: int) -> None:
+        self.maximum = max(1, maximum)
+        self.limit = min(max(1, initial), self.maximum)
+        self.peak = self.limit
+        self._previous = self.limit
+        self._last_throughput = 0.0
+
+    def adjust(self, throughput: float) -> None:
+        """Adjust the limit to the throughput measured while it was used"""
+        if throughput > self._last_throughput * (1 + GROWTH_THRESHOLD):
+            self._previous = self.limit
+            self.limit = min(self.maximum, max(self.limit + 1, self.limit * 3 // 2))
+            self.peak = max(self.peak, self.limit)
+        elif self.limit > self._previous:
+            logger.debug(f"Concurrency {self.limit} does not increase the throughput, returning to {self._previous}")
+            self.limit = self._previous
+        self._last_throughput = throughput
+
+    def failed(self) -> None:
+        self.limit = self._previous = max(1, self.limit // 2)
+        self._last_throughput = 0.0
+
+
+class _Run(Generic[T, R]):  # pylint: disable=too-many-instance-attributes
+    """State of DownloadScheduler.run()"""
+
+    def __init__(
+        self, tasks: Sequence[T], name: Callable[[T], str], priorities: list[float], options: DownloadOptions
+    ) -> None:
+        self.tasks = tasks
+        self.name = name
+        self.priorities = priorities
+        self.options = options
+        self.controller = _ConcurrencyController(min(options.initial_concurrency, len(tasks)), options.max_concurrency)
+        self.results: list[Optional[R]] = [None] * len(tasks)
+        self.attempts = [0] * len(tasks)
+        self.queue = [(0.0, priorities[index], index) for index in range(len(tasks))]
+        """Entries (not before, priority, task index), retries wait for their backoff"""
+        heapq.heapify(self.queue)
+        self.running: dict[futures.Future[R], int] = {}
+        self.retries = 0
+        self.failures = 0
+        self.bytes = 0
+        self.start = self.window_start = time.monotonic()
+        self.decreased = -1.0
+        """Start of the window in which the concurrency was last decreased after a failure"""
+
+    def due(self, now: float) -> list[int]:
+        """Remove the tasks that can start now from the queue"""
+        due: list[int] = []
+        while self.queue and len(self.running) + len(due) < self.controller.limit and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[2])
+        return due
+
+    def timeout(self, now: float) -> float:
+        """Seconds until the end of the throughput window or the next retry"""
+        timeout = self.window_start + self.options.adjust_interval - now
+        if self.queue and len(self.running) < self.controller.limit:
+            timeout = min(timeout, self.queue[0][0] - now)
+        return max(0.0, timeout)
+
+    def finished(self, future: "futures.Future[R]") -> None:
+        index = self.running.pop(future)
+        try:
+            self.results[index] = future.result()
+            return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            error = e
+        name = self.name(self.tasks[index])
+        self.attempts[index] += 1
+        # Concurrent failures, e.g. of a link that went down, decrease the concurrency only once per window
+        if self.decreased != self.window_start:
+            self.controller.failed()
+            self.decreased = self.window_start
+        if self.attempts[index] > self.options.max_retries:
+            self.failures += 1
+            DOWNLOAD_FAILURES.inc(device=name)
+            logger.error(f"Download of {name} failed {self.attempts[index]} times, giving up: {error}")
+            return
+        self.retries += 1
+        DOWNLOAD_RETRIES.inc(device=name)
+        delay = self.options.retry_delay * 2 ** (self.attempts[index] - 1)
+        logger.warning(
+            f"Download of {name} failed: {error}, retrying in {delay:.0f}s, concurrency now {self.controller.limit}"
+        )
+        heapq.heappush(self.queue, (time.monotonic() + delay, self.priorities[index], index))
+
+    def end_window(self, window_bytes: int, now: float) -> None:
+        """Adjust the concurrency to the throughput of the window and start the next window"""
+        self.bytes += window_bytes
+        throughput = window_bytes / (now - self.window_start)
+        self.window_start = now
+        # Only a concurrency that is fully used says something about the throughput
+        waiting = bool(self.queue) and self.queue[0][0] <= now
+        if len(self.running) < self.controller.limit and not waiting:
+            return
+        limit = self.controller.limit
+        self.controller.adjust(throughput)
+        if self.controller.limit != limit:
+            logger.debug(
+                f"Throughput {throughput / 1e6:.2f} MB/s with {limit} downloads, "
+                f"concurrency now {self.controller.limit}"
+            )
+
+    def stats(self) -> DownloadStats:
+        return DownloadStats(
+            downloads=sum(result is not None for result in self.results),
+            failures=self.failures,
+            retries=self.retries,
+            bytes=self.bytes,
+            elapsed=time.monotonic() - self.start,
+            peak_concurrency=self.controller.peak,
+        )
+
+
+class DownloadScheduler:
+    """Runs a download per task with an adaptive number of concurrent downloads.
+
+    Tasks start in the order of their priority, lowest first. The concurrency is adjusted from the throughput
+    reported by the downloads' chunk callbacks within the limits and the bandwidth budget of the options. A failed
+    download is retried with exponential backoff while the other downloads continue."""
+
+    def __init__(self, options: DownloadOptions = DownloadOptions()) -> None:
+        self._options = options
+        self._bucket = _TokenBucket(options.max_bandwidth) if options.max_bandwidth else None
+        self._lock = threading.Lock()
+        self._window_bytes = 0
+        self._stats = DownloadStats(0, 0, 0, 0, 0.0, 0)
+
+    def stats(self) -> DownloadStats:
+        return self._stats
+
+    def run(
+        self,
+        tasks: Sequence[T],
+        download: Callable[[T, ChunkCallback], R],
+        name: Callable[[T], str] = str,
+        priority: Optional[Callable[[T], float]] = None,
+    ) -> list[Optional[R]]:
+        """Download all tasks and return their results in the order of the tasks, None for failed tasks"""
+        priorities = [priority(task) if priority is not None else 0.0 for task in tasks]
+        state: _Run[T, R] = _Run(tasks, name, priorities, self._options)
+        executor = futures.ThreadPoolExecutor(max_workers=state.controller.maximum, thread_name_prefix="download")
+        try:
+            while state.queue or state.running:
+                for index in state.due(time.monotonic()):
+                    logger.debug(f"Downloading {name(tasks[index])}")
+                    state.running[executor.submit(self._download, download, tasks[index])] = index
+                done, _pending = futures.wait(
+                    state.running, timeout=state.timeout(time.monotonic()), return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    state.finished(future)
+                now = time.monotonic()
+                if now - state.window_start >= self._options.adjust_interval:
+                    state.end_window(self._take_window_bytes(), now)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            state.bytes += self._take_window_bytes()
+            self._stats = state.stats()
+        stats = self._stats
+        logger.info(
+            f"Downloaded {stats.bytes / 1e6:.1f} MB from {stats.downloads} devices in {stats.elapsed:.1f}s "
+            f"({stats.bytes_per_second / 1e6:.2f} MB/s), up to {stats.peak_concurrency} concurrently, "
+            f"{stats.retries} retries, {stats.failures} failed"
+        )
+        return state.results
+
+    def _take_window_bytes(self) -> int:
+        with self._lock:
+            window_bytes, self._window_bytes = self._window_bytes, 0
+        return window_bytes
+
+    def _download(self, download: Callable[[T, ChunkCallback], R], task: T) -> R:
+        deadline = time.monotonic() + self._options.device_timeout if self._options.device_timeout else None
+
+        def on_chunk(size: int) -> None:
+            with self._lock:
+                self._window_bytes += size
+            if self._bucket is not None:
+                self._bucket.consume(size)
+            if deadline is not None and time.monotonic() > deadline:
+                raise DownloadTimeout(f"Download exceeded the device timeout of {self._options.device_timeout}s")
+
+        return download(task, on_chunk)
@@ -0,0 +1,112 @@
+import threading
+import time
+from typing import Callable
+
+import pytest
+
+from importer.download_scheduler import (
+    DownloadOptions,
+    DownloadScheduler,
+    _ConcurrencyController,
+)
+from importer.shelly import ChunkCallback
+
+OPTIONS = DownloadOptions(initial_concurrency=2, max_concurrency=8, retry_delay=0.01, adjust_interval=0.05)
+
+
+class _Downloads:
+    """Fake downloads of fixed size at a fixed throughput per download, records their order and concurrency"""
+
+    def __init__(
+        self, chunks: int = 1, chunk_delay: float = 0.0, fail: Callable[[str, int], bool] = lambda task, attempt: False
+    ):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.fail = fail
+        self.started: list[str] = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, task: str, on_chunk: ChunkCallback) -> str:
+        with self._lock:
+            attempt = self.started.count(task)
+            self.started.append(task)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            for _ in range(self.chunks):
+                time.sleep(self.chunk_delay)
+                on_chunk(1000)
+            if self.fail(task, attempt):
+                raise ConnectionError(f"{task} dropped the connection")
+        finally:
+            with self._lock:
+                self.active -= 1
+        return task.upper()
+
+
+def test_tasks_start_in_priority_order():
+    downloads = _Downloads()
+    scheduler = DownloadScheduler(OPTIONS._replace(initial_concurrency=1, max_concurrency=1))
+    priorities = {"a": 3.0, "b": float("-inf"), "c": 1.0}
+    results = scheduler.run(list(priorities), downloads, priority=priorities.__getitem__)
+    assert downloads.started == ["b", "c", "a"]
+    assert results == ["A", "B", "C"]
+    stats = scheduler.stats()
+    assert (stats.downloads, stats.failures, stats.retries, stats.bytes) == (3, 0, 0, 3000)
+
+
+def test_failed_downloads_are_retried():
+    downloads = _Downloads(fail=lambda task, attempt: task == "b" and attempt < 2 or task == "c")
+    scheduler = DownloadScheduler(OPTIONS._replace(max_retries=2))
+    results = scheduler.run(["a", "b", "c", "d"], downloads)
+    assert results == ["A", "B", None, "D"]
+    assert downloads.started.count("b") == 3
+    assert downloads.started.count("c") == 3
+    stats = scheduler.stats()
+    assert (stats.downloads, stats.failures, stats.retries) == (3, 1, 4)
+
+
+def test_device_timeout():
+    downloads = _Downloads(chunks=10, chunk_delay=0.02)
+    scheduler = DownloadScheduler(OPTIONS._replace(device_timeout=0.05, max_retries=1))
+    assert scheduler.run(["a"], downloads) == [None]
+    assert downloads.started == ["a", "a"]
+
+
+def test_concurrency_grows_with_throughput():
+    downloads = _Downloads(chunks=5, chunk_delay=0.02)
+    scheduler = DownloadScheduler(OPTIONS)
+    tasks = [f"dev{index}" for index in range(40)]
+    assert scheduler.run(tasks, downloads) == [task.upper() for task in tasks]
+    assert downloads.max_active == scheduler.stats().peak_concurrency == 8
+
+
+def test_bandwidth_limit():
+    downloads = _Downloads(chunks=5)
+    scheduler = DownloadScheduler(OPTIONS._replace(max_bandwidth=40_000))
+    scheduler.run([f"dev{index}" for index in range(16)], downloads)
+    stats = scheduler.stats()
+    assert stats.bytes == 80_000
+    # The budget of the first second is available immediately
+    assert stats.elapsed >= (80_000 - 40_000) / 40_000 - 0.05
+
+
+@pytest.mark.parametrize(
+    "throughputs, limits",
+    [
+        ([1.0, 2.0, 3.0, 4.0], [3, 4, 6, 8]),
+        ([1.0, 2.0, 2.1, 2.1], [3, 4, 3, 3]),
+        ([1.0, 1.0, 5.0], [3, 2, 3]),
+    ],
+)
+def test_concurrency_controller(throughputs: list[float], limits: list[int]):
+    controller = _ConcurrencyController(initial=2, maximum=8)
+    adjusted = []
+    for throughput in throughputs:
+        controller.adjust(throughput)
+        adjusted.append(controller.limit)
+    assert adjusted == limits
+    controller.failed()
+    assert controller.limit == max(1, limits[-1] // 2)
@@ -0,0 +1,14 @@
+import json
+from typing import Any, Callable
+
+loads: Callable[[str | bytes], Any]
+"""Decode a JSON document using orjson if it is installed. Raises a ValueError subclass for invalid input."""
+
+try:
+    import orjson
+
+    loads = orjson.loads  # pylint: disable=no-member
+    JSON_LIBRARY = "orjson"
+except ImportError:  # pragma: no cover
+    loads = json.loads
+    JSON_LIBRARY = "json"
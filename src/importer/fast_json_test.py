@@ -0,0 +1,17 @@
+import pytest
+
+from importer import fast_json
+
+
+@pytest.mark.parametrize("data", ['{"a": [1, 2.5, null]}', b'{"a": [1, 2.5, null]}'])
+def test_loads(data: str | bytes):
+    assert fast_json.loads(data) == {"a": [1, 2.5, None]}
+
+
+def test_loads_invalid():
+    with pytest.raises(ValueError):
+        fast_json.loads("{")
+
+
+def test_json_library():
+    assert fast_json.JSON_LIBRARY in ("json", "orjson")
@@ -1,47 +1,212 @@
+# Commands import heavy dependencies (InfluxDB client, requests, websockets) only when they run,
+# so that --help and short cron jobs start fast. main_test.py checks that importing this module does not import them,
+# the cli_startup benchmark stage measures the start time.
+# pylint: disable=import-outside-toplevel
+import contextlib
 import csv
 import datetime
+import functools
+import io
 import logging
 import re
 import threading
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import TYPE_CHECKING, Iterator, Optional
 
 import typer
 from typing_extensions import Annotated
 
-from config import config
-from importer.db.influx import DbClient
+from importer.csv_block import CsvRowBlock
 from importer.logger import MAIN_LOGGER
-from importer.model import ALL_FIELD_NAMES, CsvRow, NotifyStatusEvent
-from importer.shelly import Shelly
-from importer.shelly_multiplexer import ShellyMultiplexer
+from importer.model import ALL_FIELD_NAMES, Schema
+
+if TYPE_CHECKING:
+    from importer.config_model import Config
+    from importer.csv_index import CsvFileRange
+    from importer.db.influx import DbClient
+    from importer.db.line_writer import LineProtocolWriter
+    from importer.deadband import DeadbandConfig
+    from importer.download_scheduler import DownloadOptions
+    from importer.shelly import NotificationCallback
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(threadName)s - %(levelname)s - %(name)s - %(message)s")
 logger = MAIN_LOGGER.getChild("main")
 
 
 def _configure_logging(
+    ctx: typer.Context,
     verbose: Annotated[bool, typer.Option("--verbose", "-v", help="Verbose log output")] = False,
+    profile: Annotated[
+        bool, typer.Option(help="Print the wall and CPU time per stage (HTTP fetch, CSV parsing, DB write...) at exit")
+    ] = False,
+    cprofile: Annotated[
+        Optional[Path], typer.Option(help="With --profile, write cProfile statistics of all threads to this file")
+    ] = None,
+    tracemalloc: Annotated[
+        Optional[Path],
+        typer.Option(help="With --profile, trace allocations per stage and write a tracemalloc snapshot to this file"),
+    ] = None,
 ) -> None:
     if verbose:
         MAIN_LOGGER.setLevel(logging.DEBUG)
         MAIN_LOGGER.debug(f"Enable verbose mode for root logger '{logger.name}'")
+    if profile:
+        from importer.profiling import PROFILER
+
+        PROFILER.enable(cprofile_file=cprofile, tracemalloc_file=tracemalloc)
+        ctx.call_on_close(PROFILER.report)
 
 
 app = typer.Typer(no_args_is_help=True, callback=_configure_logging)
 
 
+def _load_config() -> "Config":
+    from config import config
+
+    return config
+
+
+def _db_client(config: "Config", schema: Schema = Schema.NARROW) -> "DbClient":
+    from importer.db.influx import DbClient
+
+    return DbClient(
+        url=config.influxdb.url,
+        token=config.influxdb.token,
+        org=config.influxdb.org,
+        bucket=config.influxdb.bucket,
+        schema=schema,
+    )
+
+
+SchemaOption = Annotated[
+    Schema,
+    typer.Option(help="narrow: one point per phase with a phase tag, wide: one point per row with prefixed fields"),
+]
+InFlightOption = Annotated[
+    Optional[int],
+    typer.Option(min=1, help="Send batches directly to the write endpoint, this many concurrently"),
+]
+BatchSizeOption = Annotated[int, typer.Option(min=1, help="With --in-flight, lines per request")]
+GzipOption = Annotated[bool, typer.Option(help="With --in-flight, compress the requests")]
+MaxDownloadsOption = Annotated[
+    int, typer.Option(min=1, help="Maximum concurrent downloads, the concurrency adapts to the throughput up to this")
+]
+MaxBandwidthOption = Annotated[
+    Optional[float], typer.Option(min=0.001, help="Maximum MB/s of all downloads together, unlimited by default")
+]
+DeviceTimeoutOption = Annotated[
+    Optional[float], typer.Option(min=1, help="Seconds after which the download of a device is aborted and retried")
+]
+RetriesOption = Annotated[int, typer.Option(min=0, help="Retries of a failed download before the device is skipped")]
+
+
+@contextlib.contextmanager
+def _bulk_writer(
+    db: "DbClient", in_flight: Optional[int], batch_size: int, gzip: bool
+) -> Iterator[Optional["LineProtocolWriter"]]:
+    """Shared writer for importing CSV data if in_flight is given, logs a report when the import is done"""
+    if in_flight is None:
+        yield None
+        return
+    from importer.db.line_writer import LineWriterOptions
+
+    options = LineWriterOptions(batch_size=batch_size, max_in_flight=in_flight, gzip_level=1 if gzip else None)
+    writer = db.bulk_writer(options)
+    try:
+        yield writer
+    finally:
+        writer.close()
+    stats = writer.stats()
+    logger.info(
+        f"Bulk import: {stats.lines} points in {stats.elapsed:.1f}s ({stats.lines_per_second:.0f} points/s), "
+        f"{stats.batches} batches, {stats.body_bytes / 1e6:.1f} MB sent, {stats.retries} retries, "
+        f"{stats.failed_batches} failed batches"
+    )
+
+
+def _download_options(
+    max_downloads: int, max_bandwidth: Optional[float], device_timeout: Optional[float], retries: int
+) -> "DownloadOptions":
+    from importer.download_scheduler import DownloadOptions
+
+    return DownloadOptions(
+        initial_concurrency=min(DownloadOptions().initial_concurrency, max_downloads),
+        max_concurrency=max_downloads,
+        max_bandwidth=max_bandwidth * 1e6 if max_bandwidth is not None else None,
+        device_timeout=device_timeout,
+        max_retries=retries,
+    )
+
+
+def _check_downloads(config: "Config", downloaded: int) -> None:
+    failed = len(config.devices) - downloaded
+    if failed:
+        logger.error(f"Download failed for {failed} of {len(config.devices)} devices")
+        raise typer.Exit(code=1)
+
+
 @app.command()
-def download(age: Annotated[str, typer.Argument(help="Maximum age of the data to download: ALL|MAX|1w|1d|1h")]) -> None:
+def download(
+    age: Annotated[str, typer.Argument(help="Maximum age of the data to download: ALL|MAX|1w|1d|1h")],
+    max_downloads: MaxDownloadsOption = 16,
+    max_bandwidth: MaxBandwidthOption = None,
+    device_timeout: DeviceTimeoutOption = None,
+    retries: RetriesOption = 3,
+) -> None:
     """
     Download CSV data to local files.
     """
+    from importer.shelly_multiplexer import ShellyMultiplexer
+
+    config = _load_config()
     target_dir = config.data_dir
     now = datetime.datetime.now(tz=datetime.timezone.utc)
     start_timestamp = _get_start_timestamp(age, now)
-    results = ShellyMultiplexer(config.devices).download_csv_data(target_dir=target_dir, timestamp=start_timestamp)
+    results = ShellyMultiplexer(config.devices).download_csv_data(
+        target_dir=target_dir,
+        timestamp=start_timestamp,
+        options=_download_options(max_downloads, max_bandwidth, device_timeout, retries),
+    )
     for result in results:
         logger.info(f"Downloaded {result.size} bytes from {result.device_name} to {result.target_file}")
+    _check_downloads(config, len(results))
+
+
+@app.command()
+def sync(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    age: Annotated[str, typer.Argument(help="Maximum age of the data to import: ALL|MAX|1w|1d|1h")],
+    tee: Annotated[bool, typer.Option(help="Also save the downloaded CSV data to the data directory")] = False,
+    schema: SchemaOption = Schema.NARROW,
+    in_flight: InFlightOption = None,
+    batch_size: BatchSizeOption = 5_000,
+    gzip: GzipOption = True,
+    max_downloads: MaxDownloadsOption = 16,
+    max_bandwidth: MaxBandwidthOption = None,
+    device_timeout: DeviceTimeoutOption = None,
+    retries: RetriesOption = 3,
+) -> None:
+    """
+    Download CSV data and insert it into the database while downloading, without intermediate files.
+    """
+    from importer.shelly_multiplexer import ShellyMultiplexer
+
+    config = _load_config()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    start_timestamp = _get_start_timestamp(age, now)
+    with _db_client(config, schema) as db, _bulk_writer(db, in_flight, batch_size, gzip) as writer:
+        db.ensure_bucket_exists()
+        results = ShellyMultiplexer(config.devices).sync_csv_data(
+            functools.partial(db.insert_blocks, writer=writer),
+            timestamp=start_timestamp,
+            target_dir=config.data_dir if tee else None,
+            options=_download_options(max_downloads, max_bandwidth, device_timeout, retries),
+        )
+    for result in results:
+        logger.info(
+            f"Imported {result.rows} rows ({result.size} bytes) from {result.device_name} in {result.duration}"
+            + (f", saved to {result.target_file}" if result.target_file else "")
+        )
+    _check_downloads(config, len(results))
 
 
 def _get_start_timestamp(age: str, now: datetime.datetime) -> Optional[datetime.datetime]:
@@ -57,7 +222,7 @@ def _get_start_timestamp(age: str, now: datetime.datetime) -> Optional[datetime.
 def _get_age(delta: str) -> datetime.timedelta:
     if delta.lower() == "max":
         return datetime.timedelta(days=60, hours=12)
-    match = re.match(r"(\d+)([wdh])", delta.lower())
+    match = re.match(r"(\d+)([wdhms])", delta.lower())
     if match is None:
         raise ValueError(f"Invalid time delta format: '{delta}'")
     amount, unit = match.groups()
@@ -67,22 +232,70 @@ def _get_age(delta: str) -> datetime.timedelta:
         return datetime.timedelta(days=int(amount))
     if unit == "h":
         return datetime.timedelta(hours=int(amount))
+    if unit == "m":
+        return datetime.timedelta(minutes=int(amount))
+    if unit == "s":
+        return datetime.timedelta(seconds=int(amount))
     raise ValueError(f"Unsupported time unit '{unit}'")
 
 
 @app.command()
-def live():
+def live(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    record: Annotated[Optional[Path], typer.Option(help="Record raw websocket frames to this file")] = None,
+    replay: Annotated[
+        Optional[Path], typer.Option(help="Replay frames from a recording instead of subscribing to devices")
+    ] = None,
+    replay_speed: Annotated[
+        float, typer.Option(help="Replay speed relative to the recorded timing, 0: as fast as possible")
+    ] = 1.0,
+    metrics_port: Annotated[
+        Optional[int], typer.Option(help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics")
+    ] = None,
+    shards: Annotated[int, typer.Option(min=1, help="Number of worker processes the devices are distributed to")] = 1,
+    aggregate: Annotated[
+        Optional[str],
+        typer.Option(
+            help="Write mean, min, max and last of each window of this length instead of every event, e.g. 10s"
+        ),
+    ] = None,
+    keep_raw: Annotated[
+        Optional[str],
+        typer.Option(help="With --aggregate, also write every event to bucket <bucket>_live_raw with this retention"),
+    ] = None,
+    deadband: Annotated[bool, typer.Option(help="Write only values that changed by more than a threshold")] = False,
+    deadband_rules: Annotated[
+        str, typer.Option(help="Thresholds replacing the defaults, e.g. voltage=1,act_power=2% (relative)")
+    ] = "",
+    heartbeat: Annotated[str, typer.Option(help="With --deadband, write each value at least this often")] = "60s",
+    schema: SchemaOption = Schema.NARROW,
+    in_flight: InFlightOption = None,
+):
     """
     Subscribe to live data and insert it into the database.
     """
-    with DbClient(
-        url=config.influxdb.url,
-        token=config.influxdb.token,
-        org=config.influxdb.org,
-        bucket=config.influxdb.bucket,
-    ) as db:
-        db.ensure_bucket_exists()
-        with db.batch_writer() as writer:
+    from importer.model import NotifyStatusEvent
+    from importer.shelly import Shelly
+
+    config = _load_config()
+    if keep_raw is not None and aggregate is None:
+        raise typer.BadParameter("--keep-raw requires --aggregate")
+    if deadband and aggregate is not None:
+        raise typer.BadParameter("--deadband cannot be combined with --aggregate")
+    if schema != Schema.NARROW and (deadband or aggregate is not None):
+        raise typer.BadParameter("--deadband and --aggregate require the narrow schema")
+    window = _get_age(aggregate) if aggregate is not None else None
+    raw_retention = _get_age(keep_raw) if keep_raw is not None else None
+    deadband_config = _deadband_config(deadband_rules, heartbeat) if deadband else None
+    if shards > 1:
+        if record is not None or replay is not None:
+            raise typer.BadParameter("--record and --replay are not supported with multiple shards")
+        _live_sharded(config, shards, metrics_port, window, raw_retention, deadband_config, schema, in_flight)
+        return
+    with _metrics_server(metrics_port), _db_client(config, schema) as db:
+        raw_bucket = _ensure_live_buckets(db, raw_retention)
+        with db.batch_writer(
+            aggregate=window, raw_bucket=raw_bucket, deadband=deadband_config, max_in_flight=in_flight
+        ) as writer:
 
             def callback(_device: Shelly, data: NotifyStatusEvent):
                 logger.debug(
@@ -91,52 +304,336 @@ def live():
                 )
                 writer.insert_status_event(_device.name, data)
 
-            stop_event = threading.Event()
-            with ShellyMultiplexer(config.devices).subscribe(callback):
-                try:
-                    stop_event.wait()
-                except KeyboardInterrupt:
-                    logger.debug("Interrupted by user")
+            if replay is not None:
+                _replay_recording(replay, replay_speed, callback)
+            else:
+                _subscribe(config, callback, record)
+    logger.info("Live data capturing stopped.")
+
+
+def _deadband_config(rules: str, heartbeat: str) -> "DeadbandConfig":
+    from importer.deadband import DeadbandConfig, parse_rules
+
+    try:
+        return DeadbandConfig(rules=parse_rules(rules), heartbeat=_get_age(heartbeat))
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from e
+
+
+@contextlib.contextmanager
+def _metrics_server(port: Optional[int]) -> Iterator[None]:
+    """Serve the metrics at the port while the block runs. Without port, metrics are not recorded."""
+    if port is None:
+        yield
+        return
+    from importer.metrics import REGISTRY, MetricsServer
+
+    REGISTRY.enable()
+    with MetricsServer(port):
+        yield
+
+
+def _ensure_live_buckets(db: "DbClient", raw_retention: Optional[datetime.timedelta]) -> Optional[str]:
+    """Create the bucket and, if raw events are kept next to aggregates, the raw bucket. Returns its name."""
+    from importer.db.downsampling import LIVE_RAW_BUCKET_SUFFIX
+
+    db.ensure_bucket_exists()
+    if raw_retention is None:
+        return None
+    raw_bucket: str = db.bucket + LIVE_RAW_BUCKET_SUFFIX
+    db.ensure_bucket_exists(bucket_name=raw_bucket, retention=raw_retention)
+    return raw_bucket
+
+
+def _live_sharded(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    config: "Config",
+    shards: int,
+    metrics_port: Optional[int],
+    aggregate: Optional[datetime.timedelta],
+    raw_retention: Optional[datetime.timedelta],
+    deadband: Optional["DeadbandConfig"],
+    schema: Schema,
+    in_flight: Optional[int],
+) -> None:
+    from importer.metrics import MetricsServer
+    from importer.shards import ShardSpec, ShardSupervisor, partition_devices
+
+    with _db_client(config) as db:
+        raw_bucket = _ensure_live_buckets(db, raw_retention)
+    specs = [
+        ShardSpec(
+            number=number,
+            devices=devices,
+            influxdb=config.influxdb,
+            log_level=MAIN_LOGGER.getEffectiveLevel(),
+            aggregate=aggregate,
+            raw_bucket=raw_bucket,
+            deadband=deadband,
+            schema=schema,
+            max_in_flight=in_flight,
+        )
+        for number, devices in enumerate(partition_devices(config.devices, shards))
+    ]
+    supervisor = ShardSupervisor(specs)
+    metrics_server = MetricsServer(metrics_port, registry=supervisor) if metrics_port is not None else None
+    try:
+        supervisor.start()
+        supervisor.run(threading.Event())
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
     logger.info("Live data capturing stopped.")
 
 
+def _subscribe(config: "Config", callback: "NotificationCallback", record: Optional[Path]) -> None:
+    from importer.recording import StreamRecorder
+    from importer.shelly_multiplexer import ShellyMultiplexer
+
+    recorder = StreamRecorder(record) if record is not None else None
+    stop_event = threading.Event()
+    try:
+        with ShellyMultiplexer(config.devices).subscribe(callback, recorder):
+            try:
+                stop_event.wait()
+            except KeyboardInterrupt:
+                logger.debug("Interrupted by user")
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+def _replay_recording(file: Path, speed: float, callback: "NotificationCallback") -> None:
+    from importer.config_model import DeviceConfig
+    from importer.recording import RecordedFrame
+    from importer.recording import replay as replay_recording
+    from importer.shelly import NotificationSubscription, Shelly
+
+    subscriptions: dict[str, NotificationSubscription] = {}
+
+    def process(frame: RecordedFrame) -> None:
+        subscription = subscriptions.get(frame.device)
+        if subscription is None:
+            subscription = NotificationSubscription(Shelly(DeviceConfig(name=frame.device, ip="replay")), callback)
+            subscriptions[frame.device] = subscription
+        subscription.process_frame(frame.frame)
+
+    logger.info(f"Replaying {file} with speed {speed or 'max'}...")
+    result = replay_recording(file, process, speed=speed or None)
+    logger.info(
+        f"Replayed {result.frames} frames from {len(subscriptions)} devices in {result.duration:.2f}s "
+        f"({result.frames_per_second:.0f} frames/s), recorded duration: {result.recorded_duration:.0f}s"
+    )
+
+
+@app.command()
+def daemon(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    interval: Annotated[str, typer.Option(help="Time between two downloads of a device, e.g. 15m")] = "15m",
+    jitter: Annotated[str, typer.Option(help="Maximum random delay of each download, spreads the devices")] = "1m",
+    max_jobs: Annotated[int, typer.Option(min=1, help="Devices downloaded concurrently")] = 4,
+    age: Annotated[
+        Optional[str],
+        typer.Option(help="Maximum age of the data to import for devices without CSV files: MAX|1w|1d. Default: all"),
+    ] = None,
+    subscribe: Annotated[
+        bool, typer.Option("--live", help="Also subscribe to live data and insert it into the database")
+    ] = False,
+    metrics_port: Annotated[
+        Optional[int], typer.Option(help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics")
+    ] = None,
+    schema: SchemaOption = Schema.NARROW,
+    in_flight: InFlightOption = None,
+    batch_size: BatchSizeOption = 5_000,
+    gzip: GzipOption = True,
+):
+    """
+    Download new CSV data of each device periodically, insert it into the database and save it to the data
+    directory, optionally next to the live subscriptions. Replaces cron jobs running download and import-csv.
+    """
+    import signal
+
+    import requests
+
+    from importer.daemon import DaemonConfig, DeviceScheduler, local_since, sync_device
+    from importer.shelly_multiplexer import ShellyMultiplexer
+
+    config = _load_config()
+    daemon_config = DaemonConfig(interval=_get_age(interval), jitter=_get_age(jitter), max_jobs=max_jobs)
+    initial_since = datetime.datetime.now(tz=datetime.timezone.utc) - _get_age(age) if age else None
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda _signal, _frame: stop_event.set())
+    # The session, the database client and the devices' cached state are kept for the lifetime of the daemon
+    with _metrics_server(metrics_port), requests.Session() as session, _db_client(config, schema) as db:
+        db.ensure_bucket_exists()
+        multiplexer = ShellyMultiplexer(config.devices, session)
+        with _bulk_writer(db, in_flight, batch_size, gzip) as writer, contextlib.ExitStack() as stack:
+            if subscribe:
+                live_writer = stack.enter_context(db.batch_writer(max_in_flight=in_flight))
+                stack.enter_context(
+                    multiplexer.subscribe(lambda device, event: live_writer.insert_status_event(device.name, event))
+                )
+            since = {
+                device.name: local_since(config.data_dir, device.name) or initial_since for device in config.devices
+            }
+            job = functools.partial(
+                sync_device, writer=functools.partial(db.insert_blocks, writer=writer), data_dir=config.data_dir
+            )
+            DeviceScheduler(multiplexer.devices, job, since, daemon_config).run(stop_event)
+    logger.info("Daemon stopped.")
+
+
+@app.command()
+def setup_downsampling(
+    raw_retention: Annotated[
+        Optional[str],
+        typer.Option(help="Retention of raw live events in bucket <bucket>_live_raw, e.g. 4w. Default: keep forever"),
+    ] = None,
+) -> None:
+    """
+    Create buckets and tasks for downsampling live data.
+    """
+    from importer.db.downsampling import DEFAULT_TIERS
+
+    config = _load_config()
+    retention = _get_age(raw_retention) if raw_retention else None
+    with _db_client(config) as db:
+        db.ensure_downsampling(tiers=DEFAULT_TIERS, raw_retention=retention)
+    for tier in DEFAULT_TIERS:
+        logger.info(
+            f"Downsampling tier {tier.name} in bucket {tier.bucket(config.influxdb.bucket)} "
+            f"with retention {tier.retention or 'infinite'}"
+        )
+
+
 @app.command()
-def import_csv():
+def import_csv(
+    age: Annotated[
+        Optional[str], typer.Option(help="Maximum age of the data to import: MAX|1w|1d|1h. Default: all data")
+    ] = None,
+    schema: SchemaOption = Schema.NARROW,
+    in_flight: InFlightOption = None,
+    batch_size: BatchSizeOption = 5_000,
+    gzip: GzipOption = True,
+):
     """
     Insert local CSV data into database.
     """
-    db = DbClient(
-        url=config.influxdb.url,
-        token=config.influxdb.token,
-        org=config.influxdb.org,
-        bucket=config.influxdb.bucket,
-    )
+    config = _load_config()
+    start = datetime.datetime.now(tz=datetime.timezone.utc) - _get_age(age) if age else None
+    db = _db_client(config, schema)
     db.ensure_bucket_exists()
+    with _bulk_writer(db, in_flight, batch_size, gzip) as writer:
+        for device in config.devices:
+            device_dir = config.data_dir / device.name
+            rows = read_csv_files(device_dir, start=start)
+            db.insert_rows(device=device.name, rows=rows, writer=writer)
+
+
+@app.command()
+def migrate_schema(
+    age: Annotated[
+        Optional[str], typer.Option(help="Maximum age of the data to migrate: MAX|1w|1d|1h. Default: all data")
+    ] = None,
+    chunk: Annotated[str, typer.Option(help="Time range copied per query, e.g. 1d")] = "1d",
+    target_bucket: Annotated[
+        Optional[str], typer.Option(help="Bucket receiving the wide data. Default: the configured bucket")
+    ] = None,
+):
+    """
+    Copy data written with the narrow schema to the wide schema. The narrow data is kept.
+    """
+    config = _load_config()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    start = now - _get_age(age) if age else None
+    with _db_client(config) as db:
+        if target_bucket is not None:
+            db.ensure_bucket_exists(bucket_name=target_bucket)
+        values = db.migrate_to_wide(start=start, stop=now, chunk=_get_age(chunk), target_bucket=target_bucket)
+    logger.info(f"Migrated {values} values to the wide schema")
+
+
+@app.command()
+def compact(
+    dry_run: Annotated[bool, typer.Option(help="Only report the files that would be merged or moved")] = False,
+):
+    """
+    Merge the CSV files of each device into one file without duplicate rows. Replaced files are moved to a sub
+    directory.
+    """
+    from importer.compaction import compact_device_dir
+
+    config = _load_config()
     for device in config.devices:
         device_dir = config.data_dir / device.name
-        rows = read_csv_files(device_dir)
-        db.insert_rows(device=device.name, rows=rows)
+        try:
+            result = compact_device_dir(device_dir, dry_run=dry_run)
+        except ValueError as e:
+            logger.warning(f"Skipping device {device.name}: {e}")
+            continue
+        if dry_run and result.changed:
+            logger.info(
+                f"Would merge {result.required} and move {len(result.covered)} covered files {result.covered} "
+                f"of {device.name}, {result.size_before} bytes -> {result.size_after} bytes"
+            )
+
 
+def read_csv_files(
+    device_dir: Path, start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None
+) -> CsvRowBlock:
+    """Read the rows of all CSV files in the directory, skipping files whose rows are contained in other files.
+    If a time range is given, only the files and byte ranges overlapping it are read. Uses the directory's CSV
+    index."""
+    from importer.csv_index import CsvIndex
+    from importer.profiling import stage
+
+    rows = CsvRowBlock()
+    with stage("csv_index"):
+        ranges = CsvIndex.open(device_dir).select(start, end)
+    files = [file_range.file for file_range in ranges]
+    for file_range in ranges:
+        rows.extend(read_csv_range(file_range, start, end))
+    with stage("csv_rows"):
+        unique_rows = rows.unique()
+    logger.info(
+        f"Read {len(unique_rows)} unique rows (total: {len(rows)}, {unique_rows.nbytes} bytes) "
+        + f"from {len(files)} files in {device_dir}"
+    )
+    return unique_rows
 
-def read_csv_files(device_dir) -> Iterable[CsvRow]:
-    files = sorted(device_dir.glob("*.csv"))
-    unique_rows = {}
-    total_rows = 0
-    for file in files:
-        for row in read_csv(file):
-            total_rows += 1
-            unique_rows[row.timestamp] = row
-    logger.info(f"Read {len(unique_rows)} unique rows (total: {total_rows}) from {len(files)} files in {device_dir}")
-    return unique_rows.values()
 
+def read_csv(file: Path) -> CsvRowBlock:
+    from importer.profiling import stage, timed_iter
 
-def read_csv(file: Path) -> list[CsvRow]:
     with open(file, newline="", encoding="UTF-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        assert reader.fieldnames is not None
-        assert set(reader.fieldnames) == ALL_FIELD_NAMES
-        rows = (CsvRow.from_dict(row) for row in reader)
-        return list(rows)
+        reader = timed_iter("csv_parse", csv.reader(csvfile))
+        header = next(reader)
+        assert set(header) == ALL_FIELD_NAMES
+        with stage("csv_rows"):
+            return CsvRowBlock.from_csv(header, reader)
+
+
+def read_csv_range(
+    file_range: "CsvFileRange", start: Optional[datetime.datetime], end: Optional[datetime.datetime]
+) -> CsvRowBlock:
+    """Read the rows of a file range with start <= timestamp < end"""
+    from importer.profiling import stage, timed_iter
+
+    with stage("csv_read"), open(file_range.file, "rb") as file:
+        header = next(csv.reader(io.StringIO(file.read(file_range.data_offset).decode())))
+        file.seek(file_range.start_offset)
+        content = file.read(file_range.end_offset - file_range.start_offset).decode()
+    assert set(header) == ALL_FIELD_NAMES
+    start_ts = int(start.timestamp()) if start is not None else None
+    end_ts = int(end.timestamp()) if end is not None else None
+    timestamp_index = header.index("timestamp")
+
+    def in_range(row: list[str]) -> bool:
+        if not row:
+            return False
+        timestamp = int(row[timestamp_index])
+        return (start_ts is None or timestamp >= start_ts) and (end_ts is None or timestamp < end_ts)
+
+    with stage("csv_rows"):
+        return CsvRowBlock.from_csv(header, filter(in_range, timed_iter("csv_parse", csv.reader(io.StringIO(content)))))
 
 
 def main():
@@ -1,3 +1,7 @@
+import json
+import os
+import subprocess
+import sys
 from datetime import datetime, timedelta
 
 import pytest
@@ -29,3 +33,32 @@ def test_get_start_timestamp(delta: str, expected: datetime) -> None:
 def test_get_start_timestamp_invalid() -> None:
     with pytest.raises(ValueError, match="Invalid time delta format: 'invalid'"):
         _get_start_timestamp("invalid", NOW)
+
+
+HEAVY_MODULES = ["config", "influxdb_client", "polars", "requests", "tqdm", "websockets"]
+
+
+def _run_python(code: str) -> subprocess.CompletedProcess:
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    return subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True, timeout=30)
+
+
+def test_help_does_not_import_heavy_modules() -> None:
+    code = f"""
+import json, sys
+from importer.main import app
+try:
+    app(["--help"])
+except SystemExit:
+    pass
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+"""
+    result = _run_python(code)
+    assert json.loads(result.stdout.splitlines()[-1]) == []
+
+
+def test_import_does_not_import_heavy_modules() -> None:
+    # The start time itself is measured by the cli_startup benchmark stage, wall-clock budgets are flaky in tests
+    result = _run_python("import json, sys, importer.main; print(json.dumps(sorted(sys.modules)))")
+    modules = json.loads(result.stdout)
+    assert [module for module in modules if module.split(".")[0] in HEAVY_MODULES] == []
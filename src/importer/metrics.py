@@ -0,0 +1,432 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, ContextManager, Generator, Optional, Protocol
+
+from importer.logger import MAIN_LOGGER
+
+logger = MAIN_LOGGER.getChild("metrics")
+
+DURATION_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1_000, 2_500, 5_000, 10_000)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Disabled:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        pass
+
+
+_DISABLED = _Disabled()
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.enabled = True
+        """Disabled metrics ignore new values, see MetricsRegistry.enable()"""
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} requires labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError()
+
+    def snapshot(self) -> dict[LabelValues, Any]:
+        """Current values per label values, can be sent to another process and merged with add_snapshot()"""
+        raise NotImplementedError()
+
+    def add_snapshot(self, snapshot: dict[LabelValues, Any]) -> None:
+        raise NotImplementedError()
+
+    def empty_copy(self) -> "_Metric":
+        raise NotImplementedError()
+
+    def reset(self) -> None:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, e.g. number of received frames"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def add_snapshot(self, snapshot: dict[LabelValues, float]) -> None:
+        with self._lock:
+            for key, value in snapshot.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    def empty_copy(self) -> "Counter":
+        return type(self)(self.name, self.documentation, self.label_names)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    """Value that can go up and down, e.g. number of queued points"""
+
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _HistogramValue:
+    def __init__(self, bucket_count: int) -> None:
+        self.bucket_counts = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, e.g. durations or batch sizes"""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[LabelValues, _HistogramValue] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = _HistogramValue(len(self.buckets))
+                self._values[key] = histogram
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram.bucket_counts[index] += 1
+                    break
+            histogram.count += 1
+            histogram.sum += value
+
+    def time(self, **labels: str) -> ContextManager[None]:
+        """Observe the duration of the with block in seconds"""
+        if not self.enabled:
+            return _DISABLED
+        return self._time(labels)
+
+    @contextmanager
+    def _time(self, labels: dict[str, str]) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            histogram = self._values.get(self._key(labels))
+            return histogram.count if histogram else 0
+
+    def snapshot(self) -> dict[LabelValues, tuple[list[int], int, float]]:
+        with self._lock:
+            return {key: (list(value.bucket_counts), value.count, value.sum) for key, value in self._values.items()}
+
+    def add_snapshot(self, snapshot: dict[LabelValues, tuple[list[int], int, float]]) -> None:
+        with self._lock:
+            for key, (bucket_counts, count, total) in snapshot.items():
+                histogram = self._values.get(key)
+                if histogram is None:
+                    histogram = _HistogramValue(len(self.buckets))
+                    self._values[key] = histogram
+                histogram.bucket_counts = [a + b for a, b in zip(histogram.bucket_counts, bucket_counts)]
+                histogram.count += count
+                histogram.sum += total
+
+    def empty_copy(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.label_names, self.buckets)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            values = sorted(self._values.items())
+            for key, histogram in values:
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.label_names, key, ("le", _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {histogram.count}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(histogram.sum)}")
+                lines.append(f"{self.name}_count{labels} {histogram.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of a process. While the registry is disabled, updating its metrics costs a single attribute check."""
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def enable(self, enabled: bool = True) -> None:
+        """Start or stop recording values of all metrics"""
+        with self._lock:
+            self.enabled = enabled
+            for metric in self._metrics.values():
+                metric.enabled = enabled
+
+    def _register(self, metric: Any) -> Any:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            metric.enabled = self.enabled
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric: Counter = self._register(Counter(name, documentation, labels))
+        return metric
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        metric: Gauge = self._register(Gauge(name, documentation, labels))
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> Histogram:
+        metric: Histogram = self._register(Histogram(name, documentation, labels, buckets))
+        return metric
+
+    def snapshot(self) -> dict[str, dict[LabelValues, Any]]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def add_snapshot(self, snapshot: dict[str, dict[LabelValues, Any]]) -> None:
+        """Add the values of a snapshot, e.g. from another process. Values of unknown metrics are ignored."""
+        for name, values in snapshot.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.add_snapshot(values)
+
+    def empty_copy(self) -> "MetricsRegistry":
+        """New registry with the same metrics but without values"""
+        registry = MetricsRegistry()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            registry._register(metric.empty_copy())  # pylint: disable=protected-access
+        return registry
+
+    def reset(self) -> None:
+        """Remove all values, e.g. in a forked child process"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def expose(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = [line for metric in metrics for line in metric.expose()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry(enabled=False)
+"""Metrics of the importer, only recorded when they are served or used by the shard supervisor"""
+
+WEBSOCKET_FRAMES = REGISTRY.counter(
+    "importer_websocket_frames_total", "Websocket frames received per device", labels=("device",)
+)
+WEBSOCKET_RECONNECTS = REGISTRY.counter(
+    "importer_websocket_reconnects_total", "Websocket reconnects after a lost connection per device", labels=("device",)
+)
+CSV_DOWNLOAD_RESUMES = REGISTRY.counter(
+    "importer_csv_download_resumes_total", "CSV downloads resumed after a failed request per device", labels=("device",)
+)
+EVENT_PARSE_SECONDS = REGISTRY.histogram(
+    "importer_event_parse_seconds", "Time for parsing a NotifyStatus frame into a NotifyStatusEvent"
+)
+POINT_CONVERSION_SECONDS = REGISTRY.histogram(
+    "importer_point_conversion_seconds", "Time for converting a CSV row or event to points", labels=("source",)
+)
+WRITE_QUEUE_POINTS = REGISTRY.gauge(
+    "importer_write_queue_points", "Points passed to the InfluxDB write API that are not yet written"
+)
+WRITE_BATCH_LINES = REGISTRY.histogram(
+    "importer_write_batch_lines", "Lines per batch written to InfluxDB", buckets=SIZE_BUCKETS
+)
+WRITE_BATCH_DELAY_SECONDS = REGISTRY.histogram(
+    "importer_write_batch_delay_seconds",
+    "Time from the newest point's timestamp to the successful write of its batch",
+    buckets=DURATION_BUCKETS[9:] + (30.0, 60.0),
+)
+WRITE_BATCHES = REGISTRY.counter(
+    "importer_write_batches_total", "Batches sent to InfluxDB by result", labels=("result",)
+)
+DEADBAND_VALUES = REGISTRY.counter(
+    "importer_deadband_values_total",
+    "Live field values written or suppressed by the deadband filter per device",
+    labels=("device", "result"),
+)
+
+
+class MetricsSource(Protocol):
+    def expose(self) -> str: ...
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsSource = REGISTRY
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class MetricsServer:
+    """Serves the registry at http://<host>:<port>/metrics in a background thread"""
+
+    _server: Optional[ThreadingHTTPServer]
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: MetricsSource = REGISTRY) -> None:
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics at http://{host}:{self.port}/metrics")
+
+    @property
+    def port(self) -> int:
+        assert self._server is not None
+        return int(self._server.server_address[1])
+
+    def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def __enter__(self) -> "MetricsServer":
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.close()
@@ -0,0 +1,148 @@
+import time
+from typing import Generator
+
+import pytest
+import requests
+
+from importer.db.influx import LoggingBatchCallback
+from importer.metrics import (
+    REGISTRY,
+    WRITE_BATCH_DELAY_SECONDS,
+    WRITE_BATCH_LINES,
+    WRITE_BATCHES,
+    WRITE_QUEUE_POINTS,
+    MetricsRegistry,
+    MetricsServer,
+)
+
+
+@pytest.fixture(name="registry")
+def registry_fixture() -> MetricsRegistry:
+    return MetricsRegistry()
+
+
+@pytest.fixture(name="enabled_registry")
+def enabled_registry_fixture() -> Generator[None, None, None]:
+    enabled = REGISTRY.enabled
+    REGISTRY.enable()
+    yield
+    REGISTRY.enable(enabled)
+
+
+def test_counter(registry: MetricsRegistry):
+    counter = registry.counter("frames_total", "Frames", labels=("device",))
+    counter.inc(device="a")
+    counter.inc(2, device="b")
+    counter.inc(device="a")
+    assert counter.value(device="a") == 2
+    assert registry.expose() == (
+        "# HELP frames_total Frames\n"
+        "# TYPE frames_total counter\n"
+        'frames_total{device="a"} 2\n'
+        'frames_total{device="b"} 2\n'
+    )
+
+
+def test_counter_requires_labels(registry: MetricsRegistry):
+    counter = registry.counter("frames_total", "Frames", labels=("device",))
+    with pytest.raises(ValueError, match=r"requires labels \('device',\)"):
+        counter.inc()
+
+
+def test_duplicate_metric(registry: MetricsRegistry):
+    registry.counter("frames_total", "Frames")
+    with pytest.raises(ValueError, match="already registered"):
+        registry.gauge("frames_total", "Frames")
+
+
+def test_gauge(registry: MetricsRegistry):
+    gauge = registry.gauge("queue", "Queue")
+    gauge.inc(5)
+    gauge.dec(2)
+    assert gauge.value() == 3
+    gauge.set(1.5)
+    assert registry.expose().splitlines()[-1] == "queue 1.5"
+
+
+def test_label_values_are_escaped(registry: MetricsRegistry):
+    registry.counter("frames_total", "Frames", labels=("device",)).inc(device='a"b\\c')
+    assert registry.expose().splitlines()[-1] == 'frames_total{device="a\\"b\\\\c"} 1'
+
+
+def test_histogram(registry: MetricsRegistry):
+    histogram = registry.histogram("batch_lines", "Lines", buckets=(10, 1, 100))
+    for value in [0.5, 5, 5, 50, 500]:
+        histogram.observe(value)
+    assert histogram.count() == 5
+    assert registry.expose().splitlines()[2:] == [
+        'batch_lines_bucket{le="1"} 1',
+        'batch_lines_bucket{le="10"} 3',
+        'batch_lines_bucket{le="100"} 4',
+        'batch_lines_bucket{le="+Inf"} 5',
+        "batch_lines_sum 560.5",
+        "batch_lines_count 5",
+    ]
+
+
+def test_histogram_time(registry: MetricsRegistry):
+    histogram = registry.histogram("duration_seconds", "Duration", labels=("source",))
+    with histogram.time(source="csv"):
+        time.sleep(0.01)
+    assert histogram.count(source="csv") == 1
+    assert histogram.count(source="live") == 0
+    assert 'duration_seconds_bucket{source="csv",le="0.005"} 0' in registry.expose()
+    assert 'duration_seconds_bucket{source="csv",le="0.025"} 1' in registry.expose()
+
+
+def test_metrics_server(registry: MetricsRegistry):
+    registry.counter("frames_total", "Frames").inc()
+    with MetricsServer(port=0, registry=registry) as server:
+        response = requests.get(f"http://127.0.0.1:{server.port}/metrics", timeout=5)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert response.text == registry.expose()
+        assert requests.get(f"http://127.0.0.1:{server.port}/other", timeout=5).status_code == 404
+
+
+def test_disabled_registry():
+    registry = MetricsRegistry(enabled=False)
+    counter = registry.counter("frames_total", "Frames")
+    histogram = registry.histogram("duration_seconds", "Duration")
+    counter.inc()
+    with histogram.time():
+        pass
+    assert (counter.value(), histogram.count()) == (0, 0)
+    registry.enable()
+    counter.inc()
+    with histogram.time():
+        pass
+    assert (counter.value(), histogram.count()) == (1, 1)
+
+
+@pytest.mark.usefixtures("enabled_registry")
+def test_batch_callback_metrics():
+    callback = LoggingBatchCallback()
+    batches = WRITE_BATCHES.value(result="success")
+    batch_lines = WRITE_BATCH_LINES.count()
+    delays = WRITE_BATCH_DELAY_SECONDS.count()
+    queue = WRITE_QUEUE_POINTS.value()
+    now = int(time.time())
+    callback.success(("bucket", "org", "s"), f"em,device=a current=1 {now - 2}\nem,device=a current=2 {now}")
+    assert WRITE_BATCHES.value(result="success") == batches + 1
+    assert WRITE_BATCH_LINES.count() == batch_lines + 1
+    assert WRITE_BATCH_DELAY_SECONDS.count() == delays + 1
+    assert WRITE_QUEUE_POINTS.value() == queue - 2
+
+
+@pytest.mark.usefixtures("enabled_registry")
+def test_batch_callback_with_bytes():
+    delays = WRITE_BATCH_DELAY_SECONDS.count()
+    LoggingBatchCallback().success(("bucket", "org", "s"), f"em,device=a current=1 {int(time.time())}".encode())
+    assert WRITE_BATCH_DELAY_SECONDS.count() == delays + 1
+
+
+@pytest.mark.usefixtures("enabled_registry")
+def test_batch_callback_without_timestamp():
+    delays = WRITE_BATCH_DELAY_SECONDS.count()
+    LoggingBatchCallback().success(("bucket", "org", "ns"), "em,device=a current=1")
+    assert WRITE_BATCH_DELAY_SECONDS.count() == delays
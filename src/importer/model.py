@@ -1,9 +1,8 @@
 import datetime
+import functools
 from enum import Enum
 from typing import Any, NamedTuple, Optional
 
-from config import config
-
 MEASUREMENT_NAMES = {
     "a_total_act_energy",
     "a_fund_act_energy",
@@ -131,6 +130,15 @@ class Phase(Enum):
     C = "c"
 
 
+class Schema(Enum):
+    """Layout of the data in InfluxDB"""
+
+    NARROW = "narrow"
+    """Measurement em with one point per phase, tagged with the phase"""
+    WIDE = "wide"
+    """Measurement em_wide with one point per CSV row or event, field names prefixed with the phase"""
+
+
 class PhaseData(NamedTuple):
     phase_name: Phase
     """Phase name, a, b or c"""
@@ -297,6 +305,19 @@ class EnergyMeterStatusRaw(NamedTuple):
         return EnergyMeterStatusRaw(**data)
 
 
+_PHASE_KEYS = [
+    (
+        phase_name,
+        *(
+            f"{phase_name}_{field}"
+            for field in ["current", "voltage", "act_power", "aprt_power", "pf", "freq", "errors"]
+        ),
+    )
+    for phase_name in ["a", "b", "c"]
+]
+"""Phase name and keys of the phase's fields in EM status data"""
+
+
 class EnergyMeterStatus(NamedTuple):
     id: int
     """Id of the EM component instance"""
@@ -318,6 +339,35 @@ class EnergyMeterStatus(NamedTuple):
     """EM component error conditions. May contain power_meter_failure or phase_sequence.
     Present in status only if not empty."""
 
+    @staticmethod
+    def from_notification(data: dict[str, Any]) -> "EnergyMeterStatus":
+        """Create the status from the em:0 parameter of a NotifyStatus notification without the intermediate
+        EnergyMeterStatusRaw. This is on the hot path of live import, the input dict is not modified."""
+        phases = [
+            EnergyMeterPhase(
+                phase_name,
+                data[current],
+                data[voltage],
+                data[act_power],
+                data[aprt_power],
+                data[pf],
+                data[freq],
+                data.get(errors, []),
+            )
+            for phase_name, current, voltage, act_power, aprt_power, pf, freq, errors in _PHASE_KEYS
+        ]
+        return EnergyMeterStatus(
+            id=data["id"],
+            phases=phases,
+            n_current=data["n_current"],
+            n_errors=data.get("n_errors", []),
+            total_current=data["total_current"],
+            total_act_power=data["total_act_power"],
+            total_aprt_power=data["total_aprt_power"],
+            user_calibrated_phase=[],
+            errors=data.get("errors", []),
+        )
+
     @staticmethod
     def from_raw(raw_data: EnergyMeterStatusRaw) -> "EnergyMeterStatus":
         data = raw_data._asdict()
@@ -437,6 +487,15 @@ class ShellyStatus(NamedTuple):
         )
 
 
+@functools.cache
+def _timezone() -> datetime.tzinfo:
+    # Loading the configuration is deferred until the first event is parsed to keep CLI startup fast
+    from config import config  # pylint: disable=import-outside-toplevel
+
+    timezone: datetime.tzinfo = config.timezone
+    return timezone
+
+
 class NotifyStatusEvent(NamedTuple):
     timestamp: datetime.datetime
     src: str
@@ -445,9 +504,6 @@ class NotifyStatusEvent(NamedTuple):
     @staticmethod
     def from_dict(data: dict[str, Any]) -> "NotifyStatusEvent":
         params = data["params"]
-        timestamp = datetime.datetime.fromtimestamp(float(params["ts"]), tz=config.timezone)
-        em_data = params["em:0"]
-        em_data["user_calibrated_phase"] = []
-        raw = EnergyMeterStatusRaw.from_dict(em_data)
-        status = EnergyMeterStatus.from_raw(raw)
+        timestamp = datetime.datetime.fromtimestamp(float(params["ts"]), tz=_timezone())
+        status = EnergyMeterStatus.from_notification(params["em:0"])
         return NotifyStatusEvent(timestamp=timestamp, src=data["src"], status=status)
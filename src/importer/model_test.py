@@ -1,11 +1,19 @@
+import copy
 import csv
 import math
+from typing import Any
 
-from importer.model import CsvRow, NotifyStatusEvent, Phase
+from importer.model import (
+    CsvRow,
+    EnergyMeterStatus,
+    EnergyMeterStatusRaw,
+    NotifyStatusEvent,
+    Phase,
+)
 
 
-def test_parse_event():
-    data = {
+def _notify_status() -> dict[str, Any]:
+    return {
         "src": "shelly-12345",
         "dst": "client-693035",
         "method": "NotifyStatus",
@@ -38,6 +46,10 @@ def test_parse_event():
             },
         },
     }
+
+
+def test_parse_event():
+    data = _notify_status()
     event = NotifyStatusEvent.from_dict(data)
     assert str(event.timestamp) == "2024-05-24 16:26:24.740000+02:00"
     assert event.src == "shelly-12345"
@@ -50,6 +62,26 @@ def test_parse_event():
     assert math.isclose(event.status.total_act_power, 20.641)
 
 
+def test_parse_event_does_not_modify_input():
+    data = _notify_status()
+    NotifyStatusEvent.from_dict(data)
+    assert data == _notify_status()
+
+
+def test_status_from_notification_equals_raw_status():
+    data = _notify_status()["params"]["em:0"]
+    data["a_errors"] = ["out_of_range:voltage"]
+    data["errors"] = ["phase_sequence"]
+    expected = EnergyMeterStatus.from_raw(
+        EnergyMeterStatusRaw.from_dict({**copy.deepcopy(data), "user_calibrated_phase": []})
+    )
+    status = EnergyMeterStatus.from_notification(data)
+    assert status == expected
+    assert status.phases[0].errors == ["out_of_range:voltage"]
+    assert status.phases[1].errors == []
+    assert status.n_errors == []
+
+
 def test_parse_csv_row():
     content = [
         "timestamp,a_total_act_energy,a_fund_act_energy,a_total_act_ret_energy,a_fund_act_ret_energy,a_lag_react_energy,a_lead_react_energy,a_max_act_power,a_min_act_power,a_max_aprt_power,a_min_aprt_power,a_max_voltage,a_min_voltage,a_avg_voltage,a_max_current,a_min_current,a_avg_current,b_total_act_energy,b_fund_act_energy,b_total_act_ret_energy,b_fund_act_ret_energy,b_lag_react_energy,b_lead_react_energy,b_max_act_power,b_min_act_power,b_max_aprt_power,b_min_aprt_power,b_max_voltage,b_min_voltage,b_avg_voltage,b_max_current,b_min_current,b_avg_current,c_total_act_energy,c_fund_act_energy,c_total_act_ret_energy,c_fund_act_ret_energy,c_lag_react_energy,c_lead_react_energy,c_max_act_power,c_min_act_power,c_max_aprt_power,c_min_aprt_power,c_max_voltage,c_min_voltage,c_avg_voltage,c_max_current,c_min_current,c_avg_current,n_max_current,n_min_current,n_avg_current",  # pylint: disable=line-too-long
@@ -0,0 +1,274 @@
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import (
+    Any,
+    ContextManager,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
+
+from importer.logger import MAIN_LOGGER
+
+logger = MAIN_LOGGER.getChild("profiling")
+
+T = TypeVar("T")
+
+TOP_ENTRIES = 10
+"""Functions and allocation sites listed in the summary"""
+
+
+class StageStats(NamedTuple):
+    name: str
+    calls: int
+    wall: float
+    """Seconds spent in the stage, excluding nested stages, summed over all threads"""
+    cpu: float
+    """CPU seconds of the threads running the stage, excluding nested stages"""
+    memory: int
+    """Net bytes allocated in the stage, only measured with tracemalloc"""
+
+
+class _Stage:  # pylint: disable=too-many-instance-attributes
+    """Measures one run of a stage. Nested stages are subtracted from the enclosing stage of the same thread."""
+
+    __slots__ = ("_profiler", "_name", "_wall", "_cpu", "_memory", "nested_wall", "nested_cpu", "nested_memory")
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._wall = 0.0
+        self._cpu = 0.0
+        self._memory = 0
+        self.nested_wall = 0.0
+        self.nested_cpu = 0.0
+        self.nested_memory = 0
+
+    def __enter__(self) -> None:
+        self._profiler.stack().append(self)
+        self._memory = self._profiler.traced_memory()
+        self._cpu = time.thread_time()
+        self._wall = time.perf_counter()
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        memory = self._profiler.traced_memory() - self._memory
+        stack = self._profiler.stack()
+        stack.pop()
+        if stack:
+            parent = stack[-1]
+            parent.nested_wall += wall
+            parent.nested_cpu += cpu
+            parent.nested_memory += memory
+        self._profiler.add(self._name, wall - self.nested_wall, cpu - self.nested_cpu, memory - self.nested_memory)
+
+
+class _Disabled:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        pass
+
+
+_DISABLED = _Disabled()
+
+
+class Profiler:  # pylint: disable=too-many-instance-attributes
+    """Collects the wall and CPU time per stage of a command, e.g. HTTP fetch, CSV parsing or DB writes.
+
+    Stages are measured only after enable(), otherwise stage() and timed_iter() cost a single attribute check.
+    Optionally all threads started after enable() are profiled with cProfile and allocations are traced with
+    tracemalloc, which adds the net allocated memory per stage and the top allocation sites to the summary."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stages: dict[str, list[float]] = {}
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self._cprofile_file: Optional[Path] = None
+        self._cprofiles: list[Any] = []
+        self._tracemalloc_file: Optional[Path] = None
+        self._tracemalloc = False
+        self._elapsed: Optional[tuple[float, float]] = None
+        """Wall and CPU seconds from enable() to finish()"""
+        self._summary_parts: list[str] = []
+
+    def enable(self, cprofile_file: Optional[Path] = None, tracemalloc_file: Optional[Path] = None) -> None:
+        """Start measuring stages. With cprofile_file, the current and all new threads are profiled; with
+        tracemalloc_file, allocations are traced. Both files are written by finish()."""
+        self.enabled = True
+        self._elapsed = None
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        if tracemalloc_file is not None:
+            import tracemalloc  # pylint: disable=import-outside-toplevel
+
+            self._tracemalloc_file = tracemalloc_file
+            self._tracemalloc = True
+            tracemalloc.start()
+        if cprofile_file is not None:
+            self._cprofile_file = cprofile_file
+            self._start_cprofile()
+            threading.setprofile(self._thread_profile_hook)
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """Context manager measuring the with block as the named stage"""
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def timed_iter(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """Measure the time for getting each item of the iterable as the named stage, e.g. waiting for response
+        chunks. Returns the plain iterator if profiling is disabled."""
+        if not self.enabled:
+            return iter(items)
+        return self._timed_iter(name, iter(items))
+
+    def _timed_iter(self, name: str, items: Iterator[T]) -> Iterator[T]:
+        while True:
+            with _Stage(self, name):
+                item = next(items, _END)
+            if item is _END:
+                return
+            yield item  # type: ignore[misc]
+
+    def stack(self) -> list[_Stage]:
+        stack: Optional[list[_Stage]] = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def traced_memory(self) -> int:
+        if not self._tracemalloc:
+            return 0
+        import tracemalloc  # pylint: disable=import-outside-toplevel
+
+        return int(tracemalloc.get_traced_memory()[0])
+
+    def add(self, name: str, wall: float, cpu: float, memory: int = 0) -> None:
+        with self._lock:
+            totals = self._stages.get(name)
+            if totals is None:
+                self._stages[name] = [1, wall, cpu, memory]
+            else:
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+                totals[3] += memory
+
+    def stats(self) -> list[StageStats]:
+        """Stages in the order in which they were first completed"""
+        with self._lock:
+            return [
+                StageStats(name, int(calls), wall, cpu, int(memory))
+                for name, (calls, wall, cpu, memory) in self._stages.items()
+            ]
+
+    def finish(self) -> None:
+        """Stop profiling and write the cProfile and tracemalloc files, if enabled"""
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._elapsed = (time.perf_counter() - self._started, time.process_time() - self._cpu_started)
+        self._summary_parts = []
+        if self._cprofile_file is not None:
+            threading.setprofile(None)  # type: ignore[arg-type]
+            self._finish_cprofile(self._cprofile_file)
+            self._cprofile_file = None
+        if self._tracemalloc_file is not None:
+            self._finish_tracemalloc(self._tracemalloc_file)
+            self._tracemalloc_file = None
+
+    def summary(self) -> str:
+        """Table of the stages, followed by the top functions and allocations if cProfile or tracemalloc were used"""
+        wall, cpu = self._elapsed or (time.perf_counter() - self._started, time.process_time() - self._cpu_started)
+        stages = self.stats()
+        lines = [
+            f"{'Stage':<20} {'Calls':>10} {'Wall s':>10} {'CPU s':>10} {'Wall %':>7} {'Memory MB':>10}",
+            *(
+                f"{stage.name:<20} {stage.calls:>10} {stage.wall:>10.3f} {stage.cpu:>10.3f} "
+                f"{100 * stage.wall / wall if wall > 0 else 0.0:>7.1f} {stage.memory / 1e6:>10.1f}"
+                for stage in stages
+            ),
+            f"{'command':<20} {'':>10} {wall:>10.3f} {cpu:>10.3f} {100.0:>7.1f} {'':>10}",
+            "Times of stages exclude nested stages and are summed over all threads",
+        ]
+        return "\n".join(lines + self._summary_parts)
+
+    def report(self) -> None:
+        """Finish profiling and print the summary to stderr"""
+        self.finish()
+        print(self.summary(), file=sys.stderr)
+
+    def _start_cprofile(self) -> None:
+        import cProfile  # pylint: disable=import-outside-toplevel
+
+        profile = cProfile.Profile()
+        with self._lock:
+            self._cprofiles.append(profile)
+        profile.enable()
+
+    def _thread_profile_hook(self, _frame: Any, _event: str, _arg: Any) -> None:
+        # Called once in each new thread, enabling cProfile replaces this hook
+        sys.setprofile(None)
+        self._start_cprofile()
+
+    def _finish_cprofile(self, file: Path) -> None:
+        import io  # pylint: disable=import-outside-toplevel
+        import pstats  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            profiles = self._cprofiles
+            self._cprofiles = []
+        # Disables the profile of this thread, threads that are still running keep their profile until they end
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(file)
+        output = io.StringIO()
+        stats.stream = output  # type: ignore[attr-defined]
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_ENTRIES)
+        top = [line for line in output.getvalue().splitlines() if line.strip()]
+        self._summary_parts.extend(["", f"cProfile statistics of {len(profiles)} threads written to {file}", *top])
+        logger.info(f"Wrote cProfile statistics of {len(profiles)} threads to {file}")
+
+    def _finish_tracemalloc(self, file: Path) -> None:
+        import tracemalloc  # pylint: disable=import-outside-toplevel
+
+        snapshot = tracemalloc.take_snapshot()
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._tracemalloc = False
+        snapshot.dump(str(file))
+        top = snapshot.statistics("lineno")[:TOP_ENTRIES]
+        self._summary_parts.extend(
+            [
+                "",
+                f"Peak traced memory: {peak / 1e6:.1f} MB, tracemalloc snapshot written to {file}",
+                *(f"{stat.size / 1e6:>10.1f} MB {stat.count:>10} blocks  {stat.traceback}" for stat in top),
+            ]
+        )
+        logger.info(f"Wrote tracemalloc snapshot to {file}")
+
+
+_END: Any = object()
+
+PROFILER = Profiler()
+
+
+def stage(name: str) -> ContextManager[None]:
+    """Measure the with block as the named stage of the global profiler"""
+    return PROFILER.stage(name)
+
+
+def timed_iter(name: str, items: Iterable[T]) -> Iterator[T]:
+    """Measure getting each item as the named stage of the global profiler"""
+    return PROFILER.timed_iter(name, items)
@@ -0,0 +1,104 @@
+import pstats
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from importer.profiling import Profiler
+
+
+@pytest.fixture(name="profiler")
+def profiler_fixture() -> Profiler:
+    profiler = Profiler()
+    profiler.enable()
+    return profiler
+
+
+def test_disabled_profiler_measures_nothing():
+    profiler = Profiler()
+    with profiler.stage("fetch"):
+        pass
+    items = [1, 2, 3]
+    assert list(profiler.timed_iter("parse", items)) == items
+    assert not profiler.stats()
+
+
+def test_nested_stages_are_excluded(profiler: Profiler):
+    for _ in range(2):
+        with profiler.stage("outer"):
+            time.sleep(0.02)
+            with profiler.stage("inner"):
+                time.sleep(0.05)
+    stats = {stage.name: stage for stage in profiler.stats()}
+    assert list(stats) == ["inner", "outer"]
+    assert stats["outer"].calls == stats["inner"].calls == 2
+    assert 0.04 <= stats["outer"].wall < 0.09
+    assert 0.1 <= stats["inner"].wall < 0.15
+    assert stats["inner"].cpu < 0.05
+
+
+def test_timed_iter(profiler: Profiler):
+    def slow_items():
+        for item in range(3):
+            time.sleep(0.01)
+            yield item
+
+    with profiler.stage("consume"):
+        assert list(profiler.timed_iter("fetch", slow_items())) == [0, 1, 2]
+    stats = {stage.name: stage for stage in profiler.stats()}
+    # One more call detects the end of the iterator
+    assert stats["fetch"].calls == 4
+    assert stats["fetch"].wall >= 0.03
+    assert stats["consume"].wall < 0.03
+
+
+def test_stages_of_threads_are_summed(profiler: Profiler):
+    def work():
+        with profiler.stage("write"):
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    (stats,) = profiler.stats()
+    assert stats.calls == 3
+    assert stats.wall >= 0.15
+
+
+def test_summary(profiler: Profiler):
+    with profiler.stage("http_fetch"):
+        pass
+    profiler.finish()
+    lines = profiler.summary().splitlines()
+    assert lines[0].split() == ["Stage", "Calls", "Wall", "s", "CPU", "s", "Wall", "%", "Memory", "MB"]
+    assert lines[1].split()[:2] == ["http_fetch", "1"]
+    assert lines[2].split()[0] == "command"
+    assert not profiler.enabled
+
+
+def test_cprofile_and_tracemalloc(tmp_path: Path):
+    profiler = Profiler()
+    profiler.enable(cprofile_file=tmp_path / "profile.prof", tracemalloc_file=tmp_path / "snapshot.tracemalloc")
+
+    def allocate() -> list[bytes]:
+        with profiler.stage("allocate"):
+            return [bytes(1000) for _ in range(1000)]
+
+    data = []
+    thread = threading.Thread(target=lambda: data.append(allocate()))
+    thread.start()
+    thread.join()
+    profiler.finish()
+    assert not tracemalloc.is_tracing()
+    (stats,) = profiler.stats()
+    assert stats.memory >= 1_000_000
+    profile = pstats.Stats(str(tmp_path / "profile.prof"))
+    assert "allocate" in {function for _file, _line, function in profile.stats}  # type: ignore[attr-defined]
+    assert tracemalloc.Snapshot.load(str(tmp_path / "snapshot.tracemalloc")).traces
+    summary = profiler.summary()
+    assert "cProfile statistics of 2 threads" in summary
+    assert "Peak traced memory" in summary
@@ -0,0 +1,103 @@
+import gzip
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Generator, NamedTuple, Optional, TextIO
+
+from importer.logger import MAIN_LOGGER
+
+logger = MAIN_LOGGER.getChild("recording")
+
+
+class RecordedFrame(NamedTuple):
+    timestamp: float
+    """Unix timestamp when the frame was received"""
+    device: str
+    frame: str
+    """Raw websocket frame as sent by the device"""
+
+
+class StreamRecorder:
+    """Records raw websocket frames of all devices into a gzip compressed file.
+    Each line contains receive time, JSON encoded device name and frame, separated by tabs."""
+
+    _file: Optional[TextIO]
+
+    def __init__(self, file: Path) -> None:
+        self._path = file
+        self._lock = threading.Lock()
+        self._frame_count = 0
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self._file = gzip.open(file, "at", encoding="UTF-8")
+        logger.info(f"Recording websocket frames to {file}")
+
+    def record(self, device: str, frame: str | bytes) -> None:
+        text = frame.decode("UTF-8") if isinstance(frame, bytes) else frame
+        if "\n" in text:
+            text = json.dumps(json.loads(text), separators=(",", ":"))
+        line = f"{time.time():.3f}\t{json.dumps(device)}\t{text}\n"
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._frame_count += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        logger.info(f"Recorded {self._frame_count} frames to {self._path}")
+
+    def __enter__(self) -> "StreamRecorder":
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.close()
+
+
+def read_recording(file: Path) -> Generator[RecordedFrame, None, None]:
+    with gzip.open(file, "rt", encoding="UTF-8") as recording:
+        for line in recording:
+            timestamp, device, frame = line.rstrip("\n").split("\t", 2)
+            yield RecordedFrame(timestamp=float(timestamp), device=json.loads(device), frame=frame)
+
+
+class ReplayResult(NamedTuple):
+    frames: int
+    duration: float
+    """Wall time of the replay in seconds"""
+    recorded_duration: float
+    """Time between first and last recorded frame in seconds"""
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.duration if self.duration > 0 else 0.0
+
+
+def replay(file: Path, callback: Callable[[RecordedFrame], None], speed: Optional[float] = 1.0) -> ReplayResult:
+    """Replay a recording, calling the callback for each frame.
+
+    Args:
+        speed: factor relative to the recorded timing, e.g. 1.0 for real time or 10.0 for ten times faster.
+            None replays as fast as possible.
+    """
+    frames = 0
+    first_recorded: Optional[float] = None
+    last_recorded = 0.0
+    start = time.perf_counter()
+    for frame in read_recording(file):
+        if first_recorded is None:
+            first_recorded = frame.timestamp
+        last_recorded = frame.timestamp
+        if speed:
+            delay = (frame.timestamp - first_recorded) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        callback(frame)
+        frames += 1
+    duration = time.perf_counter() - start
+    recorded_duration = last_recorded - first_recorded if first_recorded is not None else 0.0
+    return ReplayResult(frames=frames, duration=duration, recorded_duration=recorded_duration)
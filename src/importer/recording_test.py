@@ -0,0 +1,89 @@
+import gzip
+import time
+from pathlib import Path
+
+import pytest
+
+from importer.recording import (
+    RecordedFrame,
+    StreamRecorder,
+    read_recording,
+    replay,
+)
+
+FRAME = '{"src":"shelly","method":"NotifyStatus","params":{"ts":1716560784.74}}'
+
+
+@pytest.fixture(name="recording")
+def recording_fixture(tmp_path: Path) -> Path:
+    file = tmp_path / "recording.gz"
+    with StreamRecorder(file) as recorder:
+        recorder.record("dev\t1", FRAME)
+        recorder.record("dev2", FRAME.encode())
+    return file
+
+
+def test_read_recording(recording: Path):
+    frames = list(read_recording(recording))
+    assert [frame.device for frame in frames] == ["dev\t1", "dev2"]
+    assert [frame.frame for frame in frames] == [FRAME, FRAME]
+    assert frames[0].timestamp <= frames[1].timestamp <= time.time()
+
+
+def test_recording_is_compressed(recording: Path):
+    with gzip.open(recording, "rt", encoding="UTF-8") as file:
+        assert len(file.readlines()) == 2
+
+
+def test_record_normalizes_multiline_frames(tmp_path: Path):
+    file = tmp_path / "recording.gz"
+    with StreamRecorder(file) as recorder:
+        recorder.record("dev", '{\n  "src": "shelly"\n}')
+    assert [frame.frame for frame in read_recording(file)] == ['{"src":"shelly"}']
+
+
+def test_record_appends_to_existing_file(recording: Path):
+    with StreamRecorder(recording) as recorder:
+        recorder.record("dev3", FRAME)
+    assert len(list(read_recording(recording))) == 3
+
+
+def test_record_after_close_is_ignored(tmp_path: Path):
+    file = tmp_path / "recording.gz"
+    recorder = StreamRecorder(file)
+    recorder.close()
+    recorder.record("dev", FRAME)
+    recorder.close()
+    assert not list(read_recording(file))
+
+
+def _write_recording(file: Path, timestamps: list[float]) -> None:
+    with gzip.open(file, "wt", encoding="UTF-8") as recording:
+        for timestamp in timestamps:
+            recording.write(f'{timestamp:.3f}\t"dev"\t{FRAME}\n')
+
+
+def test_replay_as_fast_as_possible(tmp_path: Path):
+    file = tmp_path / "recording.gz"
+    _write_recording(file, [1000.0, 1010.0, 1020.0])
+    frames: list[RecordedFrame] = []
+    result = replay(file, frames.append, speed=None)
+    assert result.frames == 3
+    assert result.recorded_duration == pytest.approx(20.0)
+    assert result.duration < 1
+    assert result.frames_per_second > 0
+    assert [frame.timestamp for frame in frames] == [1000.0, 1010.0, 1020.0]
+
+
+def test_replay_keeps_recorded_timing(tmp_path: Path):
+    file = tmp_path / "recording.gz"
+    _write_recording(file, [1000.0, 1001.0, 1002.0])
+    result = replay(file, lambda frame: None, speed=10.0)
+    assert result.duration == pytest.approx(0.2, abs=0.1)
+
+
+def test_replay_empty_recording(tmp_path: Path):
+    file = tmp_path / "recording.gz"
+    _write_recording(file, [])
+    result = replay(file, lambda frame: None)
+    assert result == (0, result.duration, 0.0)
@@ -0,0 +1,309 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, Optional
+
+from importer.config_model import DeviceConfig, InfluxDBConfig
+from importer.logger import MAIN_LOGGER
+from importer.metrics import (
+    REGISTRY,
+    WEBSOCKET_FRAMES,
+    WEBSOCKET_RECONNECTS,
+    WRITE_QUEUE_POINTS,
+    MetricsRegistry,
+)
+from importer.model import Schema
+
+if TYPE_CHECKING:
+    from importer.deadband import DeadbandConfig
+
+logger = MAIN_LOGGER.getChild("shards")
+
+HEALTH_INTERVAL = 5.0
+"""Seconds between two health reports of a shard"""
+HEALTH_TIMEOUT = 60.0
+"""A shard without health report for this many seconds is considered hung and restarted"""
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STOP_TIMEOUT = 20.0
+"""Seconds to wait for a shard to stop cleanly before terminating it"""
+SUMMARY_INTERVAL = 60.0
+
+SHARD_RESTARTS = REGISTRY.counter("importer_shard_restarts_total", "Restarts of crashed or hung shards", ("shard",))
+SHARD_UP = REGISTRY.gauge("importer_shard_up", "1 if the shard process is running", ("shard",))
+
+
+class ShardSpec(NamedTuple):
+    number: int
+    devices: list[DeviceConfig]
+    influxdb: InfluxDBConfig
+    log_level: int = logging.INFO
+    aggregate: Optional[datetime.timedelta] = None
+    """Aggregation window of live events, None writes every event"""
+    raw_bucket: Optional[str] = None
+    """Bucket receiving the raw events when aggregating"""
+    deadband: Optional["DeadbandConfig"] = None
+    schema: Schema = Schema.NARROW
+    max_in_flight: Optional[int] = None
+    """Concurrent batches of the LineProtocolWriter, None uses the client library's batching writer"""
+
+
+class ShardHealth(NamedTuple):
+    shard: int
+    pid: int
+    timestamp: float
+    metrics: dict[str, dict[tuple[str, ...], Any]]
+    """Snapshot of the shard's metrics registry"""
+
+    @property
+    def frames(self) -> int:
+        return int(sum(self.metrics.get(WEBSOCKET_FRAMES.name, {}).values()))
+
+    @property
+    def reconnects(self) -> int:
+        return int(sum(self.metrics.get(WEBSOCKET_RECONNECTS.name, {}).values()))
+
+    @property
+    def queued_points(self) -> int:
+        return int(sum(self.metrics.get(WRITE_QUEUE_POINTS.name, {}).values()))
+
+
+ShardTarget = Callable[[ShardSpec, Any, Any], None]
+"""Function running a shard in a child process: spec, stop event, health queue"""
+
+
+def partition_devices(devices: list[DeviceConfig], shards: int) -> list[list[DeviceConfig]]:
+    """Distribute devices round robin to at most the given number of shards, none of them empty"""
+    if shards < 1:
+        raise ValueError(f"Number of shards must be positive, got {shards}")
+    partitions = [devices[index::shards] for index in range(shards)]
+    return [partition for partition in partitions if partition]
+
+
+def report_health(spec: ShardSpec, health_queue: Any) -> None:
+    health_queue.put(
+        ShardHealth(shard=spec.number, pid=os.getpid(), timestamp=time.time(), metrics=REGISTRY.snapshot())
+    )
+
+
+def run_shard(spec: ShardSpec, stop_event: Any, health_queue: Any) -> None:
+    """Subscribe to the shard's devices and write their events to InfluxDB until the stop event is set"""
+    # Imported here to keep importing this module cheap in the supervisor process
+    # pylint: disable=import-outside-toplevel
+    from importer.db.influx import DbClient
+    from importer.model import NotifyStatusEvent
+    from importer.shelly import Shelly
+    from importer.shelly_multiplexer import ShellyMultiplexer
+
+    _init_shard_process(spec)
+    with DbClient(
+        url=spec.influxdb.url,
+        token=spec.influxdb.token,
+        org=spec.influxdb.org,
+        bucket=spec.influxdb.bucket,
+        schema=spec.schema,
+    ) as db:
+        with db.batch_writer(
+            aggregate=spec.aggregate,
+            raw_bucket=spec.raw_bucket,
+            deadband=spec.deadband,
+            max_in_flight=spec.max_in_flight,
+        ) as writer:
+
+            def callback(device: Shelly, event: NotifyStatusEvent) -> None:
+                writer.insert_status_event(device.name, event)
+
+            with ShellyMultiplexer(spec.devices).subscribe(callback):
+                logger.info(f"Shard {spec.number} subscribed to {len(spec.devices)} devices")
+                report_health(spec, health_queue)
+                while not stop_event.wait(HEALTH_INTERVAL):
+                    report_health(spec, health_queue)
+    report_health(spec, health_queue)
+
+
+def _init_shard_process(spec: ShardSpec) -> None:
+    # The supervisor handles Ctrl-C and stops all shards via the stop event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(processName)s - %(levelname)s - %(name)s - %(message)s"
+    )
+    MAIN_LOGGER.setLevel(spec.log_level)
+
+
+def _shard_main(target: ShardTarget, spec: ShardSpec, stop_event: Any, health_queue: Any) -> None:
+    # A forked process inherits the supervisor's metric values, the shard reports only its own
+    REGISTRY.reset()
+    REGISTRY.enable()
+    target(spec, stop_event, health_queue)
+
+
+class _Shard:
+    def __init__(self, spec: ShardSpec) -> None:
+        self.spec = spec
+        self.process: Optional[BaseProcess] = None
+        self.started_at = 0.0
+        self.last_seen = 0.0
+        """Monotonic time of the start or the last health report of the current process"""
+        self.next_start = 0.0
+        self.restart_delay = RESTART_DELAY
+        self.health: Optional[ShardHealth] = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class ShardSupervisor:  # pylint: disable=too-many-instance-attributes
+    """Runs each shard in its own process, restarts crashed or hung shards with exponential backoff and aggregates
+    the shards' health reports and metrics"""
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        specs: list[ShardSpec],
+        target: ShardTarget = run_shard,
+        context: str = "spawn",
+        health_timeout: float = HEALTH_TIMEOUT,
+        stop_timeout: float = STOP_TIMEOUT,
+    ) -> None:
+        # Restarts and health reports use the metrics, also when they are not served
+        REGISTRY.enable()
+        self._shards = [_Shard(spec) for spec in specs]
+        self._target = target
+        self._context: BaseContext = multiprocessing.get_context(context)
+        self._stop_event = self._context.Event()
+        self._health_queue = self._context.Queue()
+        self._health_timeout = health_timeout
+        self._stop_timeout = stop_timeout
+        self._lock = threading.Lock()
+
+    @property
+    def health(self) -> list[Optional[ShardHealth]]:
+        """Last health report of each shard"""
+        with self._lock:
+            return [shard.health for shard in self._shards]
+
+    def restarts(self, shard: int) -> int:
+        return int(SHARD_RESTARTS.value(shard=str(shard)))
+
+    def start(self) -> None:
+        logger.info(f"Starting {len(self._shards)} shards...")
+        for shard in self._shards:
+            self._start_shard(shard)
+
+    def run(self, stop: threading.Event) -> None:
+        """Supervise the shards until the stop event is set or Ctrl-C is pressed, then stop them"""
+        last_summary = time.monotonic()
+        try:
+            while not stop.is_set():
+                self._receive_health(timeout=1.0)
+                self._check_shards()
+                if time.monotonic() - last_summary > SUMMARY_INTERVAL:
+                    self._log_summary()
+                    last_summary = time.monotonic()
+        except KeyboardInterrupt:
+            logger.debug("Interrupted by user")
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        logger.info(f"Stopping {len(self._shards)} shards...")
+        self._stop_event.set()
+        deadline = time.monotonic() + self._stop_timeout
+        # Keep receiving health reports while waiting, a process does not exit before its queued data is consumed
+        while any(shard.running for shard in self._shards) and time.monotonic() < deadline:
+            self._receive_health(timeout=0.1)
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            if shard.process.is_alive():
+                logger.warning(f"Shard {shard.spec.number} did not stop within {self._stop_timeout}s, terminating it")
+                shard.process.terminate()
+            shard.process.join()
+            SHARD_UP.set(0, shard=str(shard.spec.number))
+        self._receive_health(timeout=0)
+        self._log_summary()
+
+    def expose(self) -> str:
+        """Metrics of the supervisor and all shards in the Prometheus text exposition format"""
+        registry: MetricsRegistry = REGISTRY.empty_copy()
+        registry.add_snapshot(REGISTRY.snapshot())
+        for health in self.health:
+            if health is not None:
+                registry.add_snapshot(health.metrics)
+        exposition: str = registry.expose()
+        return exposition
+
+    def _start_shard(self, shard: _Shard) -> None:
+        name = f"shard-{shard.spec.number}"
+        process = self._context.Process(  # type: ignore[attr-defined]
+            target=_shard_main,
+            args=(self._target, shard.spec, self._stop_event, self._health_queue),
+            name=name,
+            daemon=False,
+        )
+        process.start()
+        shard.process = process
+        shard.started_at = shard.last_seen = time.monotonic()
+        SHARD_UP.set(1, shard=str(shard.spec.number))
+        logger.info(f"Started {name} with pid {process.pid} for devices {[d.name for d in shard.spec.devices]}")
+
+    def _receive_health(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                health: ShardHealth = self._health_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            shard = self._shards[health.shard]
+            with self._lock:
+                shard.health = health
+            if shard.process is not None and shard.process.pid == health.pid:
+                shard.last_seen = time.monotonic()
+            timeout = 0
+
+    def _check_shards(self) -> None:
+        now = time.monotonic()
+        for shard in self._shards:
+            if self._stop_event.is_set():
+                return
+            if shard.process is None:
+                if now >= shard.next_start:
+                    self._start_shard(shard)
+                continue
+            if not shard.process.is_alive():
+                logger.error(f"Shard {shard.spec.number} exited with code {shard.process.exitcode}")
+                self._schedule_restart(shard, now)
+            elif now - shard.last_seen > self._health_timeout:
+                logger.error(f"Shard {shard.spec.number} sent no health report for {self._health_timeout}s")
+                shard.process.terminate()
+                shard.process.join()
+                self._schedule_restart(shard, now)
+
+    def _schedule_restart(self, shard: _Shard, now: float) -> None:
+        if now - shard.started_at > MAX_RESTART_DELAY:
+            shard.restart_delay = RESTART_DELAY
+        shard.process = None
+        shard.next_start = now + shard.restart_delay
+        SHARD_UP.set(0, shard=str(shard.spec.number))
+        SHARD_RESTARTS.inc(shard=str(shard.spec.number))
+        logger.info(f"Restarting shard {shard.spec.number} in {shard.restart_delay:.0f}s")
+        shard.restart_delay = min(shard.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def _log_summary(self) -> None:
+        for shard, health in zip(self._shards, self.health):
+            state = "running" if shard.running else "stopped"
+            if health is None:
+                logger.info(f"Shard {shard.spec.number}: {state}, no health report yet")
+            else:
+                logger.info(
+                    f"Shard {shard.spec.number}: {state}, pid {health.pid}, {health.frames} frames, "
+                    f"{health.reconnects} reconnects, {health.queued_points} queued points, "
+                    f"{self.restarts(shard.spec.number)} restarts"
+                )
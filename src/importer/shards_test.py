@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Generator
+
+import pytest
+
+from importer.config_model import DeviceConfig, InfluxDBConfig
+from importer.metrics import WEBSOCKET_FRAMES
+from importer.shards import (
+    ShardSpec,
+    ShardSupervisor,
+    ShardTarget,
+    partition_devices,
+    report_health,
+)
+
+DEVICES = [DeviceConfig(name=f"dev{index}", ip=f"10.0.0.{index}") for index in range(5)]
+INFLUXDB = InfluxDBConfig(url="http://localhost:8086", token="token", org="org", bucket="bucket")
+TIMEOUT = 10.0
+
+
+def test_partition_devices():
+    assert partition_devices(DEVICES, 2) == [
+        [DEVICES[0], DEVICES[2], DEVICES[4]],
+        [DEVICES[1], DEVICES[3]],
+    ]
+
+
+def test_partition_devices_more_shards_than_devices():
+    assert partition_devices(DEVICES[:2], 4) == [[DEVICES[0]], [DEVICES[1]]]
+
+
+def test_partition_devices_invalid():
+    with pytest.raises(ValueError, match="Number of shards must be positive, got 0"):
+        partition_devices(DEVICES, 0)
+
+
+def _specs(shards: int) -> list[ShardSpec]:
+    return [
+        ShardSpec(number=number, devices=devices, influxdb=INFLUXDB)
+        for number, devices in enumerate(partition_devices(DEVICES, shards))
+    ]
+
+
+def _healthy_shard(spec: ShardSpec, stop_event: Any, health_queue: Any) -> None:
+    for device in spec.devices:
+        WEBSOCKET_FRAMES.inc(3, device=device.name)
+    while not stop_event.wait(0.05):
+        report_health(spec, health_queue)
+    report_health(spec, health_queue)
+
+
+def _crashing_shard(spec: ShardSpec, stop_event: Any, health_queue: Any) -> None:
+    if spec.number == 0:
+        os._exit(3)  # pylint: disable=protected-access
+    _healthy_shard(spec, stop_event, health_queue)
+
+
+def _hung_shard(_spec: ShardSpec, _stop_event: Any, _health_queue: Any) -> None:
+    time.sleep(60)
+
+
+def _wait_for(condition: Callable[[], bool]) -> None:
+    start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - start < TIMEOUT, "Timeout waiting for condition"
+        time.sleep(0.05)
+
+
+class _RunningSupervisor:
+    def __init__(self, supervisor: ShardSupervisor) -> None:
+        self.supervisor = supervisor
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=supervisor.run, args=(self.stop,))
+
+
+@pytest.fixture(name="run_supervisor")
+def run_supervisor_fixture() -> Generator[Callable[..., ShardSupervisor], None, None]:
+    running: list[_RunningSupervisor] = []
+
+    def run(target: ShardTarget, shards: int = 2, **kwargs: Any) -> ShardSupervisor:
+        supervisor = ShardSupervisor(_specs(shards), target=target, context="fork", **kwargs)
+        runner = _RunningSupervisor(supervisor)
+        supervisor.start()
+        runner.thread.start()
+        running.append(runner)
+        return supervisor
+
+    yield run
+    for runner in running:
+        runner.stop.set()
+        runner.thread.join()
+
+
+def test_supervisor_aggregates_health_and_metrics(run_supervisor: Callable[..., ShardSupervisor]):
+    supervisor = run_supervisor(_healthy_shard)
+    _wait_for(lambda: all(health is not None for health in supervisor.health))
+    assert [health.frames for health in supervisor.health if health] == [9, 6]
+    assert len({health.pid for health in supervisor.health if health} | {os.getpid()}) == 3
+    metrics = supervisor.expose()
+    for device in DEVICES:
+        assert f'importer_websocket_frames_total{{device="{device.name}"}} 3' in metrics
+    assert 'importer_shard_up{shard="1"} 1' in metrics
+
+
+def test_supervisor_restarts_crashed_shard(run_supervisor: Callable[..., ShardSupervisor]):
+    supervisor = run_supervisor(_crashing_shard)
+    _wait_for(lambda: supervisor.restarts(0) >= 2)
+    assert supervisor.restarts(1) == 0
+    assert supervisor.health[0] is None
+
+
+def test_supervisor_restarts_hung_shard(run_supervisor: Callable[..., ShardSupervisor]):
+    supervisor = run_supervisor(_hung_shard, shards=1, health_timeout=0.3, stop_timeout=0.5)
+    _wait_for(lambda: supervisor.restarts(0) >= 1)
+
+
+def test_supervisor_stops_all_shards():
+    supervisor = ShardSupervisor(_specs(3), target=_healthy_shard, context="fork")
+    supervisor.start()
+    stop = threading.Event()
+    thread = threading.Thread(target=supervisor.run, args=(stop,))
+    thread.start()
+    _wait_for(lambda: all(health is not None for health in supervisor.health))
+    stop.set()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+    assert 'importer_shard_up{shard="0"} 0' in supervisor.expose()
+    assert sum(health.frames for health in supervisor.health if health) == 3 * len(DEVICES)
@@ -1,19 +1,40 @@
+import contextlib
 import csv
 import datetime
+import itertools
 import json
 import logging
+import os
 import threading
 import traceback
 from pathlib import Path
-from typing import Any, Callable, Generator, NamedTuple, Optional
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+)
 
 import requests
 import tqdm
+from websockets.exceptions import WebSocketException
 from websockets.sync.client import connect as connect_websocket
 from websockets.sync.connection import Connection
 
+from importer import fast_json
 from importer.config_model import DeviceConfig
+from importer.csv_block import CsvRowBlock
 from importer.logger import MAIN_LOGGER
+from importer.metrics import (
+    CSV_DOWNLOAD_RESUMES,
+    EVENT_PARSE_SECONDS,
+    WEBSOCKET_FRAMES,
+    WEBSOCKET_RECONNECTS,
+)
 from importer.model import (
     ALL_FIELD_NAMES,
     CsvRow,
@@ -26,6 +47,8 @@ from importer.model import (
     ShellyStatus,
     SystemStatus,
 )
+from importer.profiling import stage, timed_iter
+from importer.recording import StreamRecorder
 
 logger = MAIN_LOGGER.getChild("shelly")
 
@@ -44,15 +67,51 @@ class CsvDownloadResult(NamedTuple):
     duration: datetime.timedelta
 
 
+class CsvSyncResult(NamedTuple):
+    device_name: str
+    rows: int
+    size: int
+    duration: datetime.timedelta
+    target_file: Optional[Path]
+    """Copy of the downloaded CSV data, if requested"""
+
+
+CsvBlockWriter = Callable[[str, Iterable[CsvRowBlock]], int]
+"""Writes the blocks of CSV rows of a device while they are downloaded and returns the number of written rows"""
+
+ChunkCallback = Callable[[int], None]
+"""Called with the size of each received chunk of a download, e.g. to measure or limit the throughput"""
+
+
+class PartFile(NamedTuple):
+    size: int
+    """Bytes of complete lines, including the header"""
+    last_timestamp: Optional[int]
+    """Timestamp of the last row, None if there are no rows"""
+
+
+PART_SUFFIX = ".part"
+"""Suffix of files being downloaded, appended to the name of the target file"""
+MAX_RESUMES = 5
+"""Resumptions of a CSV download after failed requests before it fails"""
+PART_TAIL_BYTES = 4096
+"""Bytes read at a time when searching the last complete row of a part file"""
+
+CSV_BLOCK_ROWS = 1_000
+"""Rows per block when streaming CSV data, limits the memory used per device"""
+
+
 class Shelly:
     ip: str
     name: str
     device_info: Optional[DeviceInfo]
 
-    def __init__(self, config: DeviceConfig) -> None:
+    def __init__(self, config: DeviceConfig, session: Optional[requests.Session] = None) -> None:
         self.ip = config.ip
         self.name = config.name
         self.device_info = None
+        self._session = session
+        """Keeps the connections to the device open between requests, None opens a connection per request"""
         logger.debug(f"Connected to '{self.name}' at {self.ip}")
 
     def get_device_info(self) -> DeviceInfo:
@@ -119,48 +178,136 @@ class Shelly:
         target_file: Path,
         timestamp: Optional[datetime.datetime],
         end_timestamp: Optional[datetime.datetime] = None,
+        on_chunk: Optional[ChunkCallback] = None,
     ) -> CsvDownloadResult:
-        response = self._get_data_response(timestamp=timestamp, end_timestamp=end_timestamp)
-        logger.debug(f"Writing CSV data to {target_file}...")
+        """Download CSV data to a part file next to the target file, which is renamed to the target file when the
+        download is complete. After a failed request, the download resumes after the last complete row of the part
+        file, up to MAX_RESUMES times. A part file left by an earlier download of the target file is resumed too."""
+        part_file = part_file_of(target_file)
+        logger.debug(f"Writing CSV data to {part_file}...")
         _create_dir(target_file.parent)
-        size = 0
         start_timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
         progress_bar = tqdm.tqdm(
             total=_estimated_total_size(timestamp, end_timestamp), unit="iB", unit_scale=True, desc=target_file.name
         )
-        with open(target_file, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    byte_count = file.write(chunk)
-                    progress_bar.update(byte_count)
-                    size += byte_count
-        progress_bar.close()
+        resumes = 0
+        try:
+            while True:
+                part = complete_part_file(part_file)
+                since = timestamp
+                if part.last_timestamp is not None:
+                    # The download includes rows at the start timestamp
+                    since = datetime.datetime.fromtimestamp(part.last_timestamp + 1, tz=datetime.timezone.utc)
+                if part.size:
+                    logger.info(
+                        f"Resuming download from {self.name} to {part_file} at {part.size} bytes, since {since}"
+                    )
+                try:
+                    self._download_part(part_file, part.size > 0, since, end_timestamp, on_chunk, progress_bar)
+                    break
+                except requests.RequestException as e:
+                    resumes += 1
+                    if resumes > MAX_RESUMES:
+                        raise
+                    CSV_DOWNLOAD_RESUMES.inc(device=self.name)
+                    logger.warning(f"Download from {self.name} failed: {e}, resuming ({resumes}/{MAX_RESUMES})")
+        finally:
+            progress_bar.close()
+        os.replace(part_file, target_file)
+        size = target_file.stat().st_size
         duration = datetime.datetime.now(tz=datetime.timezone.utc) - start_timestamp
         logger.debug(f"Wrote {size} bytes of CSV data to {target_file} in {duration}")
         return CsvDownloadResult(target_file=target_file, size=size, duration=duration, device_name=self.name)
 
+    def _download_part(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        part_file: Path,
+        has_header: bool,
+        timestamp: Optional[datetime.datetime],
+        end_timestamp: Optional[datetime.datetime],
+        on_chunk: Optional[ChunkCallback],
+        progress_bar: tqdm.tqdm,
+    ) -> None:
+        """Append the CSV data since the timestamp to the part file, without the header if it has one already"""
+        response = self._get_data_response(timestamp=timestamp, end_timestamp=end_timestamp)
+        chunks: Iterable[bytes] = timed_iter("http_fetch", _chunks(response, on_chunk))
+        if has_header:
+            chunks = _skip_header(chunks)
+        with open(part_file, "ab") as file:
+            for chunk in chunks:
+                if chunk:  # filter out keep-alive new chunks
+                    progress_bar.update(file.write(chunk))
+
+    def sync_csv_data(
+        self,
+        writer: CsvBlockWriter,
+        timestamp: Optional[datetime.datetime],
+        end_timestamp: Optional[datetime.datetime] = None,
+        target_file: Optional[Path] = None,
+        on_chunk: Optional[ChunkCallback] = None,
+    ) -> CsvSyncResult:
+        """Stream CSV data to the writer while downloading it, optionally saving a copy of the raw data.
+        The copy is written to a part file, which is renamed to the target file if the download succeeds and
+        removed if it fails."""
+        response = self._get_data_response(timestamp=timestamp, end_timestamp=end_timestamp)
+        start_timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+        progress_bar = tqdm.tqdm(
+            total=_estimated_total_size(timestamp, end_timestamp), unit="iB", unit_scale=True, desc=self.name
+        )
+        part_file = part_file_of(target_file) if target_file is not None else None
+        try:
+            with contextlib.ExitStack() as stack:
+                file = None
+                if part_file is not None:
+                    logger.debug(f"Writing CSV data to {part_file}...")
+                    _create_dir(part_file.parent)
+                    file = stack.enter_context(open(part_file, "wb"))
+                stream = CsvBlockStream(
+                    timed_iter("http_fetch", _chunks(response, on_chunk)), file=file, progress_bar=progress_bar
+                )
+                rows = writer(self.name, stream)
+        except BaseException:
+            # The rows of a failed sync are downloaded again, a truncated copy would end in an incomplete row
+            if part_file is not None:
+                part_file.unlink(missing_ok=True)
+            raise
+        finally:
+            progress_bar.close()
+        if part_file is not None and target_file is not None:
+            os.replace(part_file, target_file)
+        duration = datetime.datetime.now(tz=datetime.timezone.utc) - start_timestamp
+        logger.debug(f"Synced {rows} rows ({stream.size} bytes) from {self.name} in {duration}")
+        return CsvSyncResult(
+            device_name=self.name, rows=rows, size=stream.size, duration=duration, target_file=target_file
+        )
+
     def _get_data_response(self, timestamp: Optional[datetime.datetime], end_timestamp: Optional[datetime.datetime]):
         url = f"http://{self.ip}/emdata/0/data.csv?add_keys=true"
         if timestamp:
             url += f"&ts={timestamp.timestamp()}"
         if end_timestamp:
             url += f"&end_ts={end_timestamp.timestamp()}"
-        response = requests.get(url, stream=True, timeout=3)
+        with stage("http_fetch"):
+            get = self._session.get if self._session is not None else requests.get
+            response = get(url, stream=True, timeout=3)
         response.raise_for_status()
         return response
 
     def _rpc_call(self, method: str, params: dict[str, Any]):
         data = json.dumps({"id": 1, "method": method, "params": params})
         logger.debug(f"Sending POST with data {data} to {self.rpc_url}")
-        response = requests.post(self.rpc_url, data=data, headers={"Content-Type": "application/json"}, timeout=10)
+        post = self._session.post if self._session is not None else requests.post
+        response = post(self.rpc_url, data=data, headers={"Content-Type": "application/json"}, timeout=10)
         response.raise_for_status()
         json_data = response.json()
         if "error" in json_data:
             raise RpcError(f"Error in response: {json_data['error']}")
         return json_data["result"]
 
-    def subscribe(self, callback: NotificationCallback) -> "NotificationSubscription":
-        subscription = NotificationSubscription(self, callback)
+    def subscribe(
+        self, callback: NotificationCallback, recorder: Optional[StreamRecorder] = None
+    ) -> "NotificationSubscription":
+        subscription = NotificationSubscription(self, callback, recorder)
         subscription.subscribe()
         return subscription
 
@@ -169,21 +316,31 @@ class Shelly:
 
 
 RECEIVE_TIMEOUT = datetime.timedelta(seconds=5)
+RECONNECT_DELAY = datetime.timedelta(seconds=1)
+MAX_RECONNECT_DELAY = datetime.timedelta(seconds=60)
 
 
-class NotificationSubscription:
+class NotificationSubscription:  # pylint: disable=too-many-instance-attributes
     _logger: logging.Logger
     _shelly: Shelly
     _callback: NotificationCallback
+    _recorder: Optional[StreamRecorder]
     _client_id: str
     _running: bool
+    _stop_event: threading.Event
+    _reconnect_delay: datetime.timedelta
     _thread: threading.Thread
 
-    def __init__(self, shelly: Shelly, callback: NotificationCallback) -> None:
+    def __init__(
+        self, shelly: Shelly, callback: NotificationCallback, recorder: Optional[StreamRecorder] = None
+    ) -> None:
         self._shelly = shelly
         self._callback = callback
+        self._recorder = recorder
         self._client_id = f"client-{self._shelly.name}"
         self._logger = logger.getChild(f"ws-{self._client_id}")
+        self._stop_event = threading.Event()
+        self._reconnect_delay = RECONNECT_DELAY
 
     def subscribe(self):
         callback = self._handle_exception(self._subscribe_thread)
@@ -202,20 +359,41 @@ class NotificationSubscription:
         return callback
 
     def _subscribe_thread(self):
+        while self._running:
+            try:
+                self._connect()
+            except (WebSocketException, OSError) as e:
+                if not self._running:
+                    break
+                WEBSOCKET_RECONNECTS.inc(device=self._shelly.name)
+                delay = self._reconnect_delay
+                self._logger.warning(f"Connection to {self._shelly.name} failed: {e}, reconnecting in {delay}")
+                self._stop_event.wait(delay.total_seconds())
+                self._reconnect_delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        self._logger.info(f"Stopped thread {self._client_id} / device {self._shelly.device_name}")
+
+    def _connect(self) -> None:
         ws_url = f"ws://{self._shelly.ip}/rpc"
         self._logger.debug(f"Connecting to {ws_url} as client {self._client_id}...")
         with connect_websocket(ws_url) as websocket:
             websocket.send('{"id": 1, "src": "' + self._client_id + '"}')
+            self._reconnect_delay = RECONNECT_DELAY
             while self._running:
                 self._receive_loop(websocket)
-        self._logger.info(f"Stopped thread {self._client_id} / device {self._shelly.device_name}")
 
     def _receive_loop(self, websocket: Connection) -> None:
         try:
             response = websocket.recv(RECEIVE_TIMEOUT.total_seconds())
         except TimeoutError:
             return
-        data = json.loads(response)
+        WEBSOCKET_FRAMES.inc(device=self._shelly.name)
+        if self._recorder is not None:
+            self._recorder.record(self._shelly.name, response)
+        self.process_frame(response)
+
+    def process_frame(self, frame: str | bytes) -> None:
+        """Parse a raw websocket frame and pass contained status events to the callback"""
+        data = fast_json.loads(frame)
         try:
             self._process_data(data)
         except Exception as e:  # pylint: disable=broad-exception-caught
@@ -228,7 +406,8 @@ class NotificationSubscription:
             self._logger.debug(f"Ignoring NotifyEvent {data}")
         elif method == "NotifyStatus":
             if "em:0" in data["params"]:
-                status = NotifyStatusEvent.from_dict(data)
+                with EVENT_PARSE_SECONDS.time():
+                    status = NotifyStatusEvent.from_dict(data)
                 self._callback(self._shelly, status)
             else:
                 self._logger.debug(f"Ignoring NotifyStatus event with missing 'em:0' param: {data}")
@@ -237,6 +416,7 @@ class NotificationSubscription:
 
     def request_stop(self):
         self._running = False
+        self._stop_event.set()
         self._logger.info(f"Sent stop signal to thread {self._client_id} / device {self._shelly.device_name}...")
 
     def join_thread(self):
@@ -253,6 +433,112 @@ class NotificationSubscription:
         self.join_thread()
 
 
+class CsvBlockStream:
+    """Parses a CSV response into blocks of rows while it is received, optionally copying the raw bytes to a file"""
+
+    def __init__(
+        self,
+        chunks: Iterable[bytes],
+        file: Optional[BinaryIO] = None,
+        progress_bar: Optional[tqdm.tqdm] = None,
+        block_rows: int = CSV_BLOCK_ROWS,
+    ) -> None:
+        self._chunks = chunks
+        self._file = file
+        self._progress_bar = progress_bar
+        self._block_rows = block_rows
+        self.size = 0
+        """Bytes received so far"""
+
+    def __iter__(self) -> Iterator[CsvRowBlock]:
+        reader = timed_iter("csv_parse", csv.reader(self._lines()))
+        header = next(reader, None)
+        if header is None:
+            return
+        assert set(header) == ALL_FIELD_NAMES
+        while True:
+            with stage("csv_rows"):
+                block = CsvRowBlock.from_csv(header, itertools.islice(reader, self._block_rows))
+            if not block:
+                return
+            yield block
+
+    def _lines(self) -> Generator[str, None, None]:
+        pending = b""
+        for chunk in self._chunks:
+            if not chunk:  # filter out keep-alive new chunks
+                continue
+            self.size += len(chunk)
+            if self._file is not None:
+                self._file.write(chunk)
+            if self._progress_bar is not None:
+                self._progress_bar.update(len(chunk))
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                yield line.decode()
+        if pending:
+            yield pending.decode()
+
+
+def _chunks(response: requests.Response, on_chunk: Optional[ChunkCallback]) -> Iterator[bytes]:
+    chunks: Iterator[bytes] = response.iter_content(chunk_size=8192)
+    if on_chunk is None:
+        return chunks
+    return _reported_chunks(chunks, on_chunk)
+
+
+def _reported_chunks(chunks: Iterator[bytes], on_chunk: ChunkCallback) -> Iterator[bytes]:
+    for chunk in chunks:
+        on_chunk(len(chunk))
+        yield chunk
+
+
+def _skip_header(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    chunks = iter(chunks)
+    for chunk in chunks:
+        end = chunk.find(b"\n")
+        if end >= 0:
+            yield chunk[end + 1 :]
+            break
+    yield from chunks
+
+
+def part_file_of(target_file: Path) -> Path:
+    return target_file.with_name(target_file.name + PART_SUFFIX)
+
+
+def complete_part_file(part_file: Path) -> PartFile:
+    """Truncate an incomplete last line of a partially downloaded CSV file and return the position to resume at.
+    A missing file or one without a complete header line is created empty."""
+    try:
+        file = open(part_file, "r+b")  # pylint: disable=consider-using-with
+    except FileNotFoundError:
+        part_file.touch()
+        return PartFile(size=0, last_timestamp=None)
+    with file:
+        header = file.readline()
+        if not header.endswith(b"\n"):
+            file.truncate(0)
+            return PartFile(size=0, last_timestamp=None)
+        end = position = file.seek(0, os.SEEK_END)
+        tail = b""
+        # Read backwards until the tail contains the whole last complete line
+        while position > len(header):
+            position = max(len(header), position - PART_TAIL_BYTES)
+            file.seek(position)
+            tail = file.read(end - position)
+            last_newline = tail.rfind(b"\n")
+            if last_newline >= 0 and (position == len(header) or tail.rfind(b"\n", 0, last_newline) >= 0):
+                break
+        size = position + tail.rfind(b"\n") + 1
+        file.truncate(size)
+    lines = [line for line in tail[: size - position].splitlines() if line.strip()]
+    if not lines:
+        return PartFile(size=size, last_timestamp=None)
+    column = header.decode().strip().split(",").index("timestamp")
+    return PartFile(size=size, last_timestamp=int(lines[-1].split(b",")[column]))
+
+
 def _create_dir(path: Path) -> None:
     if not path.exists():
         path.mkdir(parents=True)
@@ -1,14 +1,23 @@
 import datetime
 import tarfile
-from concurrent import futures
 from pathlib import Path
 from typing import Any, NamedTuple, Optional
 
+import requests
+
 from importer.config_model import DeviceConfig
+from importer.csv_index import RECORD_PERIOD, CsvIndex
+from importer.download_scheduler import DownloadOptions, DownloadScheduler
 from importer.logger import MAIN_LOGGER
 from importer.model import ShellyStatus
+from importer.profiling import stage
+from importer.recording import StreamRecorder
 from importer.shelly import (
+    PART_SUFFIX,
+    ChunkCallback,
+    CsvBlockWriter,
     CsvDownloadResult,
+    CsvSyncResult,
     NotificationCallback,
     NotificationSubscription,
     Shelly,
@@ -25,8 +34,8 @@ class CsvDownloadTask(NamedTuple):
 class ShellyMultiplexer:
     devices: list[Shelly] = []
 
-    def __init__(self, config: list[DeviceConfig]) -> None:
-        self.devices = [Shelly(device) for device in config]
+    def __init__(self, config: list[DeviceConfig], session: Optional[requests.Session] = None) -> None:
+        self.devices = [Shelly(device, session) for device in config]
         logger.debug(f"Connected to {len(self.devices)} devices")
 
     def get_status(self) -> dict[str, ShellyStatus]:
@@ -37,35 +46,145 @@ class ShellyMultiplexer:
         target_dir: Path,
         timestamp: Optional[datetime.datetime],
         end_timestamp: Optional[datetime.datetime] = None,
+        options: DownloadOptions = DownloadOptions(),
     ) -> list[CsvDownloadResult]:
+        """Download the CSV data of all devices to files in the target directory, devices with the oldest local data
+        first. Returns the results of the devices whose download succeeded, see DownloadScheduler.
+        A part file left by an earlier failed download is resumed if it covers the start timestamp or, without start
+        timestamp, starts at the device's oldest record."""
 
-        def _download_one(task: CsvDownloadTask) -> CsvDownloadResult:
+        def _download_one(task: CsvDownloadTask, on_chunk: ChunkCallback) -> CsvDownloadResult:
             return task.device.download_csv_data(
-                target_file=task.target_file, timestamp=timestamp, end_timestamp=end_timestamp
+                target_file=task.target_file, timestamp=timestamp, end_timestamp=end_timestamp, on_chunk=on_chunk
             )
 
         file_name_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
         tasks = [
-            CsvDownloadTask(device, target_dir / device.name / f"{device.name}_{file_name_timestamp}.csv")
+            CsvDownloadTask(
+                device,
+                _resumable_target(device, target_dir / device.name, timestamp, end_timestamp)
+                or target_dir / device.name / f"{device.name}_{file_name_timestamp}.csv",
+            )
             for device in self.devices
         ]
-        with futures.ThreadPoolExecutor(max_workers=4) as executor:
-            result = list(executor.map(_download_one, tasks))
+        newest = {task.device.name: _newest_local_timestamp(task.target_file.parent) for task in tasks}
+        results = DownloadScheduler(options).run(
+            tasks, _download_one, name=lambda task: task.device.name, priority=lambda task: newest[task.device.name]
+        )
+        result = [status for status in results if status is not None]
         for status in result:
             logger.info(f"Downloaded {status.size} bytes from {status.device_name} to {status.target_file}")
-        _create_backup_file(
-            target_file=target_dir / f"backup_{file_name_timestamp}.tar.bz2",
-            archive_dir=Path(f"backup_{file_name_timestamp}"),
-            directories=[task.target_file.parent for task in tasks],
+            with stage("csv_index"):
+                CsvIndex.open(status.target_file.parent)
+        if result:
+            with stage("backup"):
+                _create_backup_file(
+                    target_file=target_dir / f"backup_{file_name_timestamp}.tar.bz2",
+                    archive_dir=Path(f"backup_{file_name_timestamp}"),
+                    directories=[status.target_file.parent for status in result],
+                )
+        return result
+
+    def sync_csv_data(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        writer: CsvBlockWriter,
+        timestamp: Optional[datetime.datetime],
+        end_timestamp: Optional[datetime.datetime] = None,
+        target_dir: Optional[Path] = None,
+        options: DownloadOptions = DownloadOptions(),
+    ) -> list[CsvSyncResult]:
+        """Stream the CSV data of all devices concurrently to the writer.
+        If a target directory is given, the raw data is also saved there like by download_csv_data.
+        Returns the results of the devices whose download succeeded, a retried download is written again."""
+        file_name_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+        def _sync_one(device: Shelly, on_chunk: ChunkCallback) -> CsvSyncResult:
+            target_file = None
+            if target_dir is not None:
+                target_file = target_dir / device.name / f"{device.name}_{file_name_timestamp}.csv"
+            return device.sync_csv_data(
+                writer, timestamp=timestamp, end_timestamp=end_timestamp, target_file=target_file, on_chunk=on_chunk
+            )
+
+        newest: dict[str, float] = {}
+        if target_dir is not None:
+            newest = {device.name: _newest_local_timestamp(target_dir / device.name) for device in self.devices}
+        results = DownloadScheduler(options).run(
+            self.devices,
+            _sync_one,
+            name=lambda device: device.name,
+            priority=lambda device: newest.get(device.name, 0.0),
         )
+        result = [status for status in results if status is not None]
+        for status in result:
+            logger.info(f"Synced {status.rows} rows ({status.size} bytes) from {status.device_name}")
+            if status.target_file is not None:
+                with stage("csv_index"):
+                    CsvIndex.open(status.target_file.parent)
         return result
 
-    def subscribe(self, callback: NotificationCallback) -> "MultiNotificationSubscription":
-        subscription = MultiNotificationSubscription(self, callback)
+    def subscribe(
+        self, callback: NotificationCallback, recorder: Optional[StreamRecorder] = None
+    ) -> "MultiNotificationSubscription":
+        subscription = MultiNotificationSubscription(self, callback, recorder)
         subscription.subscribe()
         return subscription
 
 
+def _newest_local_timestamp(device_dir: Path) -> float:
+    """Newest timestamp of the local CSV files of a device, devices without local data sort first"""
+    if not device_dir.is_dir():
+        return float("-inf")
+    last_timestamp = CsvIndex.open(device_dir).last_timestamp
+    return float(last_timestamp) if last_timestamp is not None else float("-inf")
+
+
+def _resumable_target(
+    device: Shelly,
+    device_dir: Path,
+    timestamp: Optional[datetime.datetime],
+    end_timestamp: Optional[datetime.datetime],
+) -> Optional[Path]:
+    """Target file of the newest part file whose data starts early enough for the requested time range.
+    Without start timestamp, the data must start at the oldest record of the device."""
+    if end_timestamp is not None or not device_dir.is_dir():
+        return None
+    part_files = [
+        (part_file, first)
+        for part_file in sorted(device_dir.glob(f"*.csv{PART_SUFFIX}"), reverse=True)
+        if (first := _first_timestamp(part_file)) is not None
+    ]
+    if not part_files:
+        return None
+    start = timestamp.timestamp() if timestamp is not None else _oldest_record(device)
+    if start is None:
+        return None
+    for part_file, first in part_files:
+        if first <= start + RECORD_PERIOD:
+            logger.info(f"Resuming the earlier download {part_file}")
+            return part_file.with_name(part_file.name.removesuffix(PART_SUFFIX))
+        logger.debug(f"Ignoring {part_file}, its data starts after {timestamp or 'the oldest record'}")
+    return None
+
+
+def _oldest_record(device: Shelly) -> Optional[int]:
+    try:
+        data_blocks = device.get_emdata_records().data_blocks
+    except requests.RequestException as e:
+        logger.warning(f"Cannot get the oldest record of {device.name}, not resuming a part file: {e}")
+        return None
+    return min((block.ts for block in data_blocks), default=None)
+
+
+def _first_timestamp(csv_file: Path) -> Optional[int]:
+    with open(csv_file, "rb") as file:
+        header = file.readline()
+        row = file.readline()
+    if not row.endswith(b"\n"):
+        return None
+    return int(row.split(b",")[header.decode().strip().split(",").index("timestamp")])
+
+
 def _create_backup_file(target_file: Path, archive_dir: Path, directories: list[Path]) -> None:
     with tarfile.open(target_file, "w:bz2", compresslevel=9) as tar:
         for directory in directories:
@@ -77,15 +196,22 @@ def _create_backup_file(target_file: Path, archive_dir: Path, directories: list[
 class MultiNotificationSubscription:
     _multiplexer: ShellyMultiplexer
     _callback: NotificationCallback
+    _recorder: Optional[StreamRecorder]
     _subscriptions: list[NotificationSubscription]
 
-    def __init__(self, multiplexer: ShellyMultiplexer, callback: NotificationCallback) -> None:
+    def __init__(
+        self,
+        multiplexer: ShellyMultiplexer,
+        callback: NotificationCallback,
+        recorder: Optional[StreamRecorder] = None,
+    ) -> None:
         self._multiplexer = multiplexer
         self._callback = callback
+        self._recorder = recorder
 
     def subscribe(self) -> None:
         logger.debug(f"Subscribing to {len(self._multiplexer.devices)} devices...")
-        self._subscriptions = [device.subscribe(self._callback) for device in self._multiplexer.devices]
+        self._subscriptions = [device.subscribe(self._callback, self._recorder) for device in self._multiplexer.devices]
 
     def stop(self) -> None:
         logger.debug(f"Stopping {len(self._subscriptions)} subscriptions...")
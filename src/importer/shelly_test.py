@@ -1,10 +1,22 @@
+import csv
 import datetime
+import io
 import math
+from pathlib import Path
 from typing import Optional
 
 import pytest
 
-from importer.shelly import _estimated_total_size
+from importer import shelly
+from importer.csv_block import CsvRowBlock
+from importer.model import ALL_FIELD_NAMES
+from importer.shelly import (
+    CsvBlockStream,
+    PartFile,
+    _estimated_total_size,
+    _skip_header,
+    complete_part_file,
+)
 
 NOW = datetime.datetime.now(tz=datetime.timezone.utc)
 BEGIN = NOW - datetime.timedelta(hours=3)
@@ -29,3 +41,68 @@ def test_estimated_total_size(
     else:
         assert result is not None
         assert math.isclose(result, expected, abs_tol=1000)
+
+
+def _csv_content(timestamps: list[int]) -> bytes:
+    header = ["timestamp", *sorted(ALL_FIELD_NAMES - {"timestamp"})]
+    lines = [",".join(header)]
+    for timestamp in timestamps:
+        lines.append(",".join([str(timestamp), *(f"{index / 4:.2f}" for index in range(len(header) - 1))]))
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def _chunks(content: bytes, size: int) -> list[bytes]:
+    return [content[index : index + size] for index in range(0, len(content), size)]
+
+
+def test_csv_block_stream():
+    content = _csv_content(list(range(60, 60 * 6, 60)))
+    file = io.BytesIO()
+    stream = CsvBlockStream(_chunks(content, 100), file=file, block_rows=2)
+    blocks = list(stream)
+    assert [list(block.timestamps) for block in blocks] == [[60, 120], [180, 240], [300]]
+    reader = csv.reader(io.StringIO(content.decode(), newline=""))
+    expected = CsvRowBlock.from_csv(next(reader), reader)
+    assert [view.to_row() for block in blocks for view in block] == [view.to_row() for view in expected]
+    assert stream.size == len(content)
+    assert file.getvalue() == content
+
+
+def test_csv_block_stream_without_trailing_newline():
+    content = _csv_content([60, 120]).rstrip()
+    assert [list(block.timestamps) for block in CsvBlockStream(_chunks(content, 7))] == [[60, 120]]
+
+
+def test_csv_block_stream_empty():
+    assert not list(CsvBlockStream([b""]))
+
+
+@pytest.mark.parametrize("rows", [1, 50])
+@pytest.mark.parametrize("incomplete", [b"", b"600", b"600,1.0,2.0\r"])
+def test_complete_part_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, rows: int, incomplete: bytes):
+    monkeypatch.setattr(shelly, "PART_TAIL_BYTES", 64)
+    content = _csv_content(list(range(60, 60 * (rows + 1), 60)))
+    part_file = tmp_path / "data.csv.part"
+    part_file.write_bytes(content + incomplete)
+    assert complete_part_file(part_file) == PartFile(size=len(content), last_timestamp=60 * rows)
+    assert part_file.read_bytes() == content
+
+
+def test_complete_part_file_without_rows(tmp_path: Path):
+    part_file = tmp_path / "data.csv.part"
+    assert complete_part_file(part_file) == PartFile(size=0, last_timestamp=None)
+    assert part_file.read_bytes() == b""
+    header = _csv_content([])
+    part_file.write_bytes(header[:10])
+    assert complete_part_file(part_file) == PartFile(size=0, last_timestamp=None)
+    assert part_file.read_bytes() == b""
+    part_file.write_bytes(header + b"60,1")
+    assert complete_part_file(part_file) == PartFile(size=len(header), last_timestamp=None)
+    assert part_file.read_bytes() == header
+
+
+def test_skip_header():
+    content = _csv_content([60, 120])
+    header = _csv_content([])
+    assert b"".join(_skip_header(_chunks(content, 7))) == content[len(header) :]
+    assert not b"".join(_skip_header(_chunks(header[:-1], 7)))
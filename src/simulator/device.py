@@ -0,0 +1,201 @@
+import datetime
+import math
+import random
+import time
+from typing import Any, Generator, Optional
+
+from analyze.common import ALL_CSV_COLUMNS, PHASE_COLUMNS
+
+PHASES = ["a", "b", "c"]
+RECORD_PERIOD = 60
+"""Resolution of the emdata records in seconds"""
+
+
+class VirtualDevice:
+    """Simulated Shelly Pro 3EM. All values are derived from the device seed and the timestamp,
+    so that repeated downloads of the same time range return the same data."""
+
+    name: str
+    seed: int
+    history: datetime.timedelta
+
+    def __init__(self, name: str, seed: int, history: datetime.timedelta = datetime.timedelta(days=60)) -> None:
+        self.name = name
+        self.seed = seed
+        self.history = history
+        self._started = time.time()
+        self._base_load = {phase: random.Random(f"{seed}-{phase}").uniform(20, 400) for phase in PHASES}
+
+    @property
+    def mac(self) -> str:
+        return f"{self.seed:012X}"
+
+    @property
+    def device_id(self) -> str:
+        return f"shellypro3em-{self.mac.lower()}"
+
+    def device_info(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "id": self.device_id,
+            "mac": self.mac,
+            "slot": 1,
+            "key": "simulated",
+            "batch": "simulated",
+            "fw_sbits": "00",
+            "model": "SPEM-003CEBEU",
+            "gen": 2,
+            "fw_id": "20240625-122917/1.3.3-gbdfd9b3",
+            "ver": "1.3.3",
+            "app": "Pro3EM",
+            "auth_en": False,
+            "auth_domain": None,
+            "profile": "triphase",
+        }
+
+    def system_status(self, now: float) -> dict[str, Any]:
+        return {
+            "mac": self.mac,
+            "restart_required": False,
+            "time": time.strftime("%H:%M", time.localtime(now)),
+            "unixtime": int(now),
+            "uptime": int(now - self._started),
+            "ram_size": 245_000,
+            "ram_free": 120_000,
+            "fs_size": 524_288,
+            "fs_free": 180_000,
+            "cfg_rev": 10,
+            "kvs_rev": 0,
+            "schedule_rev": 0,
+            "webhook_rev": 0,
+            "available_updates": {},
+            "reset_reason": 3,
+            "last_sync_ts": int(now),
+            "ram_min_free": 100_000,
+            "btrelay_rev": 0,
+        }
+
+    def _power(self, phase: str, ts: float) -> float:
+        day_fraction = (ts % 86_400) / 86_400
+        daily = 1 + 0.5 * math.sin(2 * math.pi * (day_fraction - 0.25))
+        noise = random.Random(f"{self.seed}-{phase}-{int(ts)}").gauss(0, 5)
+        return max(0.0, self._base_load[phase] * daily + noise)
+
+    def em_status(self, now: float) -> dict[str, Any]:
+        status: dict[str, Any] = {"id": 0}
+        for phase in PHASES:
+            power = self._power(phase, now)
+            voltage = 230 + 3 * math.sin(now / 60 + PHASES.index(phase))
+            status[f"{phase}_current"] = round(power / voltage, 3)
+            status[f"{phase}_voltage"] = round(voltage, 1)
+            status[f"{phase}_act_power"] = round(power, 1)
+            status[f"{phase}_aprt_power"] = round(power * 1.2, 1)
+            status[f"{phase}_pf"] = 0.83
+            status[f"{phase}_freq"] = 50.0
+        status["n_current"] = None
+        status["total_current"] = round(sum(status[f"{phase}_current"] for phase in PHASES), 3)
+        status["total_act_power"] = round(sum(status[f"{phase}_act_power"] for phase in PHASES), 3)
+        status["total_aprt_power"] = round(sum(status[f"{phase}_aprt_power"] for phase in PHASES), 3)
+        status["user_calibrated_phase"] = []
+        return status
+
+    def emdata_status(self, now: float) -> dict[str, Any]:
+        hours = (now - self._history_start(now)) / 3_600
+        energy = {phase: self._base_load[phase] * hours for phase in PHASES}
+        return {
+            "id": 0,
+            "a_total_act_energy": round(energy["a"], 2),
+            "a_total_act_ret_energy": 0.0,
+            "b_total_act_energy": round(energy["b"], 2),
+            "b_total_act_ret_energy": 0.0,
+            "c_total_act_energy": round(energy["c"], 2),
+            "c_total_act_ret_energy": 0.0,
+            "total_act": round(sum(energy.values()), 2),
+            "total_act_ret": 0.0,
+        }
+
+    def status(self, now: float) -> dict[str, Any]:
+        return {
+            "temperature:0": {"id": 0, "tC": 42.1, "tF": 107.8},
+            "sys": self.system_status(now),
+            "em:0": self.em_status(now),
+            "emdata:0": self.emdata_status(now),
+        }
+
+    def records(self, now: float, timestamp: float = 0) -> dict[str, Any]:
+        start = max(self._history_start(now), _align(timestamp))
+        end = _last_complete_record(now)
+        return {"data_blocks": [{"ts": start, "period": RECORD_PERIOD, "records": (end - start) // RECORD_PERIOD + 1}]}
+
+    def notify_status(self, now: float, client_id: str) -> dict[str, Any]:
+        return {
+            "src": self.device_id,
+            "dst": client_id,
+            "method": "NotifyStatus",
+            "params": {"ts": round(now, 2), "em:0": self.em_status(now)},
+        }
+
+    def csv_lines(
+        self, now: float, timestamp: Optional[float], end_timestamp: Optional[float]
+    ) -> Generator[str, None, None]:
+        """Generate the lines of /emdata/0/data.csv for the given time range, including header"""
+        yield ",".join(ALL_CSV_COLUMNS) + "\n"
+        for ts in self._csv_timestamps(now, timestamp, end_timestamp):
+            yield self._csv_line(ts) + "\n"
+
+    def csv_line_count(self, now: float, timestamp: Optional[float], end_timestamp: Optional[float]) -> int:
+        """Number of lines generated by csv_lines(), without generating them"""
+        return 1 + len(self._csv_timestamps(now, timestamp, end_timestamp))
+
+    def _csv_timestamps(self, now: float, timestamp: Optional[float], end_timestamp: Optional[float]) -> range:
+        start = max(self._history_start(now), _align(timestamp or 0))
+        end = _last_complete_record(now)
+        if end_timestamp is not None:
+            end = min(end, _align_down(end_timestamp))
+        return range(start, end + 1, RECORD_PERIOD)
+
+    def _csv_line(self, ts: int) -> str:
+        rnd = random.Random(f"{self.seed}-{ts}")
+        values = [str(ts)]
+        for phase in PHASES:
+            power = self._power(phase, ts)
+            voltage = 230 + rnd.uniform(-3, 3)
+            current = power / voltage
+            phase_values = {
+                "total_act_energy": power / 60,
+                "fund_act_energy": power / 60 * 0.98,
+                "total_act_ret_energy": 0.0,
+                "fund_act_ret_energy": 0.0,
+                "lag_react_energy": rnd.uniform(0, 0.05),
+                "lead_react_energy": rnd.uniform(0, 0.05),
+                "max_act_power": power * 1.1,
+                "min_act_power": power * 0.9,
+                "max_aprt_power": power * 1.3,
+                "min_aprt_power": power * 1.1,
+                "max_voltage": voltage + 1,
+                "min_voltage": voltage - 1,
+                "avg_voltage": voltage,
+                "max_current": current * 1.1,
+                "min_current": current * 0.9,
+                "avg_current": current,
+            }
+            values.extend(f"{phase_values[column]:.3f}" for column in PHASE_COLUMNS)
+        values.extend(["0.000", "0.000", "0.000"])
+        return ",".join(values)
+
+    def _history_start(self, now: float) -> int:
+        return _align(now - self.history.total_seconds())
+
+
+def _align(ts: float) -> int:
+    """Round up to the next record boundary"""
+    return int(math.ceil(ts / RECORD_PERIOD) * RECORD_PERIOD)
+
+
+def _align_down(ts: float) -> int:
+    """Round down to the previous record boundary"""
+    return int(math.floor(ts / RECORD_PERIOD) * RECORD_PERIOD)
+
+
+def _last_complete_record(now: float) -> int:
+    return _align_down(now - RECORD_PERIOD)
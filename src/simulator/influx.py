@@ -0,0 +1,283 @@
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from typing import Any, NamedTuple, Optional
+
+from simulator.server import _HttpRequest, _read_request, _response, _send
+
+logger = logging.getLogger("simulator.influx")
+
+ORG_ID = "0000000000000001"
+
+_NO_CONTENT: bytes = _response(204, b"")
+
+
+class InfluxFaultConfig(NamedTuple):
+    latency: float = 0.0
+    """Delay in seconds before each write response"""
+    rate_limit_rate: float = 0.0
+    """Probability of rejecting a write with status 429 and Retry-After"""
+    unavailable_rate: float = 0.0
+    """Probability of rejecting a write with status 503"""
+    retry_after: int = 1
+    """Seconds sent in the Retry-After header of rejected writes"""
+
+
+class InfluxStatistics(NamedTuple):
+    requests: int
+    write_requests: int
+    lines: int
+    fields: int
+    body_bytes: int
+    """Bytes of the request bodies as received, possibly compressed"""
+    line_bytes: int
+    """Bytes of the line protocol after decompression"""
+    invalid_requests: int
+    injected_errors: int
+    elapsed: float
+    """Seconds since the server was started"""
+
+    @property
+    def lines_per_second(self) -> float:
+        return self.lines / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def fields_per_second(self) -> float:
+        return self.fields / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class LineProtocolError(ValueError):
+    pass
+
+
+def count_fields(line: str) -> int:
+    """Validate a line of line protocol and return the number of its fields"""
+    plain = "\\" not in line and '"' not in line
+    parts = line.split(" ") if plain else _split_unescaped(line, " ")
+    if len(parts) not in (2, 3) or not parts[0] or not parts[1] or parts[0].startswith(","):
+        raise LineProtocolError(f"Invalid line '{line}'")
+    if len(parts) == 3 and not parts[2].lstrip("-").isdigit():
+        raise LineProtocolError(f"Invalid timestamp in line '{line}'")
+    fields = parts[1].split(",") if plain else _split_unescaped(parts[1], ",")
+    if any("=" not in field or field.startswith("=") for field in fields):
+        raise LineProtocolError(f"Invalid field set in line '{line}'")
+    return len(fields)
+
+
+def _split_unescaped(text: str, separator: str) -> list[str]:
+    """Split at separators that are neither escaped nor part of a quoted string field value"""
+    parts = []
+    start = 0
+    index = 0
+    quoted = False
+    while index < len(text):
+        char = text[index]
+        if char == "\\":
+            index += 1
+        elif char == '"':
+            quoted = not quoted
+        elif char == separator and not quoted:
+            parts.append(text[start:index])
+            start = index + 1
+        index += 1
+    parts.append(text[start:])
+    return parts
+
+
+class InfluxSimulator:  # pylint: disable=too-many-instance-attributes
+    """Stand-in for the parts of the InfluxDB v2 HTTP API used by the importer's write path: /api/v2/write,
+    bucket lookup, creation and update, organization lookup, /ping and /health. Writes are validated and counted, but not stored.
+    Runs in a background thread with its own event loop, like ShellySimulator."""
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        faults: InfluxFaultConfig = InfluxFaultConfig(),
+        seed: int = 0,
+        keep_lines: bool = False,
+    ) -> None:
+        self._host = host
+        self._port = port
+        self.faults = faults
+        self._random = random.Random(seed)
+        self._keep_lines = keep_lines
+        self.lines: dict[str, list[str]] = {}
+        """Received lines per bucket if keep_lines is set"""
+        self.buckets: dict[str, dict[str, Any]] = {}
+        """Buckets by name"""
+        self._counters = dict.fromkeys(InfluxStatistics._fields[:-1], 0)
+        self._started = time.monotonic()
+        self._server: Optional[asyncio.Server] = None
+        self._connections: set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._host}:{self._port}"
+
+    @property
+    def statistics(self) -> InfluxStatistics:
+        return InfluxStatistics(**self._counters, elapsed=time.monotonic() - self._started)
+
+    def start(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="influx-simulator", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self._loop).result()
+        self._started = time.monotonic()
+        logger.info(f"Simulating InfluxDB at {self.url}")
+
+    def stop(self) -> None:
+        if self._loop is None or self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_server(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        logger.info(f"InfluxDB simulator stopped, {self.statistics}")
+
+    def __enter__(self) -> "InfluxSimulator":
+        self.start()
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.stop()
+
+    async def _start_server(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, host=self._host, port=self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+
+    async def _stop_server(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                self._counters["requests"] += 1
+                await _send(writer, await self._handle_http(request))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_http(self, request: _HttpRequest) -> bytes:  # pylint: disable=too-many-return-statements
+        path = request.path.rstrip("/")
+        if path == "/api/v2/write" and request.method == "POST":
+            return await self._write(request)
+        if path == "/api/v2/orgs" and request.method == "GET":
+            # Any organization exists
+            name = request.query.get("org", "org")
+            return _json_response(200, {"orgs": [{"id": ORG_ID, "name": name}]})
+        if path == "/api/v2/buckets" and request.method == "GET":
+            return self._find_buckets(request.query.get("name"))
+        if path == "/api/v2/buckets" and request.method == "POST":
+            return self._create_bucket(json.loads(request.body))
+        if path.startswith("/api/v2/buckets/") and request.method == "PATCH":
+            return self._update_bucket(path.rsplit("/", 1)[-1], json.loads(request.body))
+        if path == "/ping":
+            return _NO_CONTENT
+        if path == "/health":
+            return _json_response(200, {"name": "influxdb", "status": "pass", "message": "simulator"})
+        return _json_response(404, {"code": "not found", "message": f"path {request.path} not found"})
+
+    async def _write(self, request: _HttpRequest) -> bytes:
+        if self.faults.latency > 0:
+            await asyncio.sleep(self.faults.latency)
+        self._counters["write_requests"] += 1
+        self._counters["body_bytes"] += len(request.body)
+        roll = self._random.random()
+        if roll < self.faults.rate_limit_rate + self.faults.unavailable_rate:
+            self._counters["injected_errors"] += 1
+            status = 429 if roll < self.faults.rate_limit_rate else 503
+            return _json_response(
+                status,
+                {"code": "unavailable", "message": "injected error"},
+                {"Retry-After": str(self.faults.retry_after)},
+            )
+        bucket = request.query.get("bucket")
+        if bucket not in self.buckets:
+            self._counters["invalid_requests"] += 1
+            return _json_response(404, {"code": "not found", "message": f'bucket "{bucket}" not found'})
+        try:
+            body = gzip.decompress(request.body) if request.headers.get("content-encoding") == "gzip" else request.body
+            lines = [line for line in body.decode().split("\n") if line and not line.startswith("#")]
+            fields = sum(count_fields(line) for line in lines)
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError, LineProtocolError) as e:
+            self._counters["invalid_requests"] += 1
+            return _json_response(400, {"code": "invalid", "message": str(e)})
+        self._counters["lines"] += len(lines)
+        self._counters["fields"] += fields
+        self._counters["line_bytes"] += len(body)
+        if self._keep_lines:
+            self.lines.setdefault(bucket, []).extend(lines)
+        return _NO_CONTENT
+
+    def _find_buckets(self, name: Optional[str]) -> bytes:
+        buckets = [bucket for bucket in self.buckets.values() if name is None or bucket["name"] == name]
+        return _json_response(200, {"buckets": buckets})
+
+    def _create_bucket(self, request: dict[str, Any]) -> bytes:
+        name = request["name"]
+        if name in self.buckets:
+            return _json_response(422, {"code": "conflict", "message": f"bucket with name {name} already exists"})
+        now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        bucket = {
+            "id": f"{len(self.buckets) + 1:016x}",
+            "name": name,
+            "orgID": request.get("orgID", ""),
+            "type": "user",
+            "retentionRules": _with_shard_duration(request.get("retentionRules", [])),
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        self.buckets[name] = bucket
+        logger.info(f"Created bucket {name}")
+        return _json_response(201, bucket)
+
+    def _update_bucket(self, bucket_id: str, request: dict[str, Any]) -> bytes:
+        bucket = next((bucket for bucket in self.buckets.values() if bucket["id"] == bucket_id), None)
+        if bucket is None:
+            return _json_response(404, {"code": "not found", "message": f"bucket {bucket_id} not found"})
+        bucket["retentionRules"] = _with_shard_duration(request.get("retentionRules", bucket["retentionRules"]))
+        bucket["updatedAt"] = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        return _json_response(200, bucket)
+
+
+def _with_shard_duration(rules: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Add the default shard group duration like InfluxDB: 1h below 2 days retention, 1d up to 6 months, else 7d"""
+    result = []
+    for rule in rules:
+        every = rule.get("everySeconds", 0)
+        duration = 3600 if 0 < every < 2 * 86400 else 86400 if 0 < every <= 180 * 86400 else 7 * 86400
+        result.append({"shardGroupDurationSeconds": duration, **rule})
+    return result
+
+
+def _json_response(status: int, content: Any, headers: Optional[dict[str, str]] = None) -> bytes:
+    response: bytes = _response(status, json.dumps(content).encode(), content_type="application/json")
+    if not headers:
+        return response
+    head, body = response.split(b"\r\n\r\n", 1)
+    extra = "".join(f"\r\n{name}: {value}" for name, value in headers.items()).encode()
+    return head + extra + b"\r\n\r\n" + body
@@ -0,0 +1,156 @@
+import datetime
+import gzip
+from typing import Generator
+
+import pytest
+import requests
+
+from benchmark.generators import generate_notify_status_frames
+from importer import fast_json
+from importer.csv_block import COLUMNS, CsvRowBlock
+from importer.db.influx import DbClient
+from importer.db.influx_converter import PointConverter
+from importer.db.line_writer import LineWriterOptions
+from importer.model import NotifyStatusEvent
+from simulator.influx import (
+    InfluxFaultConfig,
+    InfluxSimulator,
+    LineProtocolError,
+    count_fields,
+)
+
+BUCKET = "em"
+
+
+@pytest.fixture(name="influx")
+def influx_fixture() -> Generator[InfluxSimulator, None, None]:
+    with InfluxSimulator(keep_lines=True) as influx:
+        yield influx
+
+
+def _db(influx: InfluxSimulator) -> DbClient:
+    return DbClient(url=influx.url, token="token", org="org", bucket=BUCKET)
+
+
+def _block(rows: int) -> CsvRowBlock:
+    return CsvRowBlock.from_dicts(
+        [{"timestamp": str(1716140640 + 60 * row), **dict.fromkeys(COLUMNS, str(row / 2))} for row in range(rows)]
+    )
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        ("em,device=dev,phase=a current=1.5,voltage=230 1716140639", 2),
+        ("em value=1", 1),
+        (r"em,device=dev\ 1,phase=a current=1.5 1716140639", 1),
+        ('em,device=dev text="a, b=c d",value=1i 1716140639', 2),
+    ],
+)
+def test_count_fields(line: str, expected: int):
+    assert count_fields(line) == expected
+
+
+@pytest.mark.parametrize(
+    "line",
+    ["em", "em 1716140639", ",device=dev value=1", "em value=1 now", "em value 1", "em value=1 1 2"],
+)
+def test_count_fields_invalid(line: str):
+    with pytest.raises(LineProtocolError):
+        count_fields(line)
+
+
+def test_ensure_bucket_exists(influx: InfluxSimulator):
+    with _db(influx) as db:
+        db.ensure_bucket_exists()
+        db.ensure_bucket_exists()
+        db.ensure_bucket_exists(bucket_name="em_1m", retention=datetime.timedelta(days=1))
+        db.ensure_bucket_exists(bucket_name="em_1m", retention=datetime.timedelta(days=2))
+        updated = influx.buckets["em_1m"]["updatedAt"]
+        # The rules of the server include the shard group duration, but the retention is the same
+        db.ensure_bucket_exists(bucket_name="em_1m", retention=datetime.timedelta(days=2))
+        assert influx.buckets["em_1m"]["updatedAt"] == updated
+    assert sorted(influx.buckets) == ["em", "em_1m"]
+    assert influx.buckets["em_1m"]["retentionRules"] == [
+        {"type": "expire", "everySeconds": 172800, "shardGroupDurationSeconds": 86400}
+    ]
+
+
+def test_ensure_bucket_exists_managed_retention(influx: InfluxSimulator):
+    with _db(influx) as db:
+        db.ensure_bucket_exists(bucket_name="em_1m", retention=datetime.timedelta(days=1))
+        db.ensure_bucket_exists(bucket_name="em_1m")
+        assert influx.buckets["em_1m"]["retentionRules"] != []
+        db.ensure_bucket_exists(bucket_name="em_1m", manage_retention=True)
+        assert influx.buckets["em_1m"]["retentionRules"] == []
+
+
+def test_insert_rows_with_batching_write_api(influx: InfluxSimulator):
+    block = _block(10)
+    with _db(influx) as db:
+        db.ensure_bucket_exists()
+        db.insert_rows("dev", block)
+    converter = PointConverter()
+    assert influx.lines[BUCKET] == [line for row in range(10) for line in converter.line_protocol("dev", block, row)]
+    assert influx.statistics.lines == 40
+    assert influx.statistics.fields == 10 * (3 * 16 + 3)
+
+
+def test_bulk_insert_with_faults(influx: InfluxSimulator):
+    influx.faults = InfluxFaultConfig(rate_limit_rate=0.3, unavailable_rate=0.2, retry_after=0)
+    options = LineWriterOptions(batch_size=20, max_in_flight=3, retry_interval=0.0, max_retries=20)
+    with _db(influx) as db:
+        db.ensure_bucket_exists()
+        with db.bulk_writer(options) as writer:
+            db.insert_rows("dev", _block(100), writer=writer)
+    statistics = influx.statistics
+    assert statistics.lines == 400
+    assert statistics.injected_errors == writer.stats().retries > 0
+    assert writer.stats().failed_batches == 0
+    assert statistics.body_bytes < statistics.line_bytes
+
+
+def test_live_batch_writer(influx: InfluxSimulator):
+    frames = generate_notify_status_frames(devices=2, events_per_device=5, seed=1)
+    events = [NotifyStatusEvent.from_dict(fast_json.loads(frame)) for frame in frames]
+    with _db(influx) as db:
+        db.ensure_bucket_exists()
+        for max_in_flight in [None, 2]:
+            with db.batch_writer(max_in_flight=max_in_flight) as writer:
+                for event in events:
+                    writer.insert_status_event("dev", event)
+    points = [point.to_line_protocol() for event in events for point in PointConverter().convert("dev", event)]
+    assert influx.lines[BUCKET] == points + points
+
+
+def test_write_errors(influx: InfluxSimulator):
+    url = f"{influx.url}/api/v2/write"
+    response = requests.post(url, params={"bucket": "missing"}, data=b"em value=1 1", timeout=5)
+    assert response.status_code == 404
+    assert response.json()["message"] == 'bucket "missing" not found'
+    influx.buckets[BUCKET] = {"id": "1", "name": BUCKET, "retentionRules": []}
+    response = requests.post(url, params={"bucket": BUCKET}, data=b"em value=1 1\nem 1", timeout=5)
+    assert response.status_code == 400
+    response = requests.post(
+        url,
+        params={"bucket": BUCKET},
+        data=gzip.compress(b"em value=1 1"),
+        headers={"Content-Encoding": "gzip"},
+        timeout=5,
+    )
+    assert response.status_code == 204
+    assert influx.lines[BUCKET] == ["em value=1 1"]
+    assert influx.statistics.invalid_requests == 2
+
+
+def test_injected_errors(influx: InfluxSimulator):
+    influx.buckets[BUCKET] = {"id": "1", "name": BUCKET, "retentionRules": []}
+    influx.faults = InfluxFaultConfig(rate_limit_rate=1.0, retry_after=7)
+    response = requests.post(f"{influx.url}/api/v2/write", params={"bucket": BUCKET}, data=b"em value=1", timeout=5)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    influx.faults = InfluxFaultConfig(unavailable_rate=1.0)
+    response = requests.post(f"{influx.url}/api/v2/write", params={"bucket": BUCKET}, data=b"em value=1", timeout=5)
+    assert response.status_code == 503
+    assert influx.statistics.injected_errors == 2
+    assert not influx.lines
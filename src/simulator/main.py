@@ -0,0 +1,84 @@
+import contextlib
+import datetime
+import logging
+import threading
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+from simulator.influx import InfluxFaultConfig, InfluxSimulator
+from simulator.server import FaultConfig, ShellySimulator, fleet
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(threadName)s - %(levelname)s - %(name)s - %(message)s")
+logger = logging.getLogger("simulator")
+
+STATISTICS_INTERVAL = datetime.timedelta(seconds=10)
+
+
+def main(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    devices: Annotated[int, typer.Option(help="Number of virtual devices")] = 10,
+    host: Annotated[str, typer.Option(help="Address to listen on")] = "127.0.0.1",
+    base_port: Annotated[
+        int, typer.Option(help="Port of the first device, following devices use the next ports")
+    ] = 18000,
+    history_days: Annotated[int, typer.Option(help="Days of CSV history per device")] = 60,
+    latency: Annotated[float, typer.Option(help="Delay in seconds before each HTTP response")] = 0.0,
+    error_rate: Annotated[float, typer.Option(help="Probability of HTTP 500 responses")] = 0.0,
+    drop_rate: Annotated[float, typer.Option(help="Probability of aborting a CSV download midway")] = 0.0,
+    throughput: Annotated[Optional[int], typer.Option(help="Maximum bytes/s per CSV download")] = None,
+    disconnect_rate: Annotated[float, typer.Option(help="Probability of dropping a websocket per message")] = 0.0,
+    notify_interval: Annotated[float, typer.Option(help="Seconds between websocket notifications")] = 1.0,
+    influx_port: Annotated[
+        Optional[int], typer.Option(help="Also simulate the InfluxDB write endpoint on this port")
+    ] = None,
+    influx_latency: Annotated[float, typer.Option(help="Delay in seconds before each InfluxDB write response")] = 0.0,
+    influx_rate_limit_rate: Annotated[float, typer.Option(help="Probability of InfluxDB HTTP 429 responses")] = 0.0,
+    influx_unavailable_rate: Annotated[float, typer.Option(help="Probability of InfluxDB HTTP 503 responses")] = 0.0,
+) -> None:
+    """
+    Simulate a fleet of Shelly Pro 3EM devices for load testing the importer.
+    """
+    faults = FaultConfig(
+        latency=latency,
+        error_rate=error_rate,
+        drop_rate=drop_rate,
+        throughput=throughput,
+        disconnect_rate=disconnect_rate,
+        notify_interval=notify_interval,
+    )
+    simulator = ShellySimulator(
+        fleet(devices, history=datetime.timedelta(days=history_days)), host=host, base_port=base_port, faults=faults
+    )
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(simulator)
+        influx = None
+        if influx_port is not None:
+            influx_faults = InfluxFaultConfig(
+                latency=influx_latency,
+                rate_limit_rate=influx_rate_limit_rate,
+                unavailable_rate=influx_unavailable_rate,
+            )
+            influx = stack.enter_context(InfluxSimulator(host=host, port=influx_port, faults=influx_faults))
+            print(f'Use url="{influx.url}" in the InfluxDB configuration of config.py')
+        print("Use the following devices in config.py:")
+        print("devices=[")
+        for device in simulator.device_configs():
+            print(f'    DeviceConfig(name="{device.name}", ip="{device.ip}"),')
+        print("],")
+        stop_event = threading.Event()
+        try:
+            while not stop_event.wait(STATISTICS_INTERVAL.total_seconds()):
+                logger.info(f"{simulator.statistics}")
+                if influx is not None:
+                    statistics = influx.statistics
+                    logger.info(
+                        f"{statistics}, {statistics.lines_per_second:.0f} lines/s, "
+                        f"{statistics.fields_per_second:.0f} fields/s"
+                    )
+        except KeyboardInterrupt:
+            logger.debug("Interrupted by user")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,351 @@
+import asyncio
+import datetime
+import functools
+import http
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from typing import Any, NamedTuple, Optional
+
+from websockets.frames import Frame, Opcode
+from websockets.http11 import Request
+from websockets.protocol import State
+from websockets.server import ServerProtocol
+
+from importer.config_model import DeviceConfig
+from simulator.device import VirtualDevice
+
+logger = logging.getLogger("simulator")
+
+CSV_CHUNK_SIZE = 8192
+
+
+class FaultConfig(NamedTuple):
+    latency: float = 0.0
+    """Delay in seconds before each HTTP response"""
+    error_rate: float = 0.0
+    """Probability of responding to an HTTP request with status 500"""
+    drop_rate: float = 0.0
+    """Probability of aborting a CSV download midway"""
+    throughput: Optional[int] = None
+    """Maximum bytes per second of each CSV download, None means unlimited"""
+    disconnect_rate: float = 0.0
+    """Probability of dropping a websocket connection before sending a notification"""
+    notify_interval: float = 1.0
+    """Seconds between two NotifyStatus notifications on a websocket connection"""
+
+
+class SimulatorStatistics(NamedTuple):
+    rpc_requests: int
+    csv_requests: int
+    csv_bytes: int
+    websocket_connections: int
+    notifications: int
+    injected_errors: int
+    dropped_downloads: int
+    dropped_connections: int
+
+
+class _HttpRequest(NamedTuple):
+    method: str
+    path: str
+    query: dict[str, str]
+    headers: dict[str, str]
+    """Header names in lower case"""
+    body: bytes
+    raw_head: bytes
+
+
+class _Counters:
+    def __init__(self) -> None:
+        self.values = dict.fromkeys(SimulatorStatistics._fields, 0)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        self.values[name] += amount
+
+
+def fleet(count: int, history: datetime.timedelta = datetime.timedelta(days=60)) -> list[VirtualDevice]:
+    return [VirtualDevice(name=f"sim-{index:03d}", seed=index + 1, history=history) for index in range(count)]
+
+
+class ShellySimulator:  # pylint: disable=too-many-instance-attributes
+    """Serves HTTP RPC, CSV download and websocket notifications for each virtual device on its own port.
+    Runs in a background thread with its own event loop."""
+
+    def __init__(
+        self,
+        devices: list[VirtualDevice],
+        host: str = "127.0.0.1",
+        base_port: int = 0,
+        faults: FaultConfig = FaultConfig(),
+        seed: int = 0,
+    ) -> None:
+        self._devices = devices
+        self._host = host
+        self._base_port = base_port
+        self.faults = faults
+        self._random = random.Random(seed)
+        self._counters = _Counters()
+        self._ports: list[int] = []
+        self._servers: list[asyncio.Server] = []
+        self._connections: set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def statistics(self) -> SimulatorStatistics:
+        return SimulatorStatistics(**self._counters.values)
+
+    def device_configs(self) -> list[DeviceConfig]:
+        """Configuration for connecting the importer to the virtual devices"""
+        return [
+            DeviceConfig(name=device.name, ip=f"{self._host}:{port}")
+            for device, port in zip(self._devices, self._ports)
+        ]
+
+    def start(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="shelly-simulator", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_servers(), self._loop).result()
+        logger.info(
+            f"Simulating {len(self._devices)} devices on {self._host}, ports {self._ports[0]}..{self._ports[-1]}"
+        )
+
+    def stop(self) -> None:
+        if self._loop is None or self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_servers(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        logger.info(f"Simulator stopped, {self.statistics}")
+
+    def __enter__(self) -> "ShellySimulator":
+        self.start()
+        return self
+
+    def __exit__(self, _exc_type: Any, _exc_value: Any, _traceback: Any) -> None:
+        self.stop()
+
+    async def _start_servers(self) -> None:
+        for index, device in enumerate(self._devices):
+            port = self._base_port + index if self._base_port else 0
+            server = await asyncio.start_server(
+                functools.partial(self._handle_connection, device), host=self._host, port=port
+            )
+            self._servers.append(server)
+            self._ports.append(server.sockets[0].getsockname()[1])
+
+    async def _stop_servers(self) -> None:
+        for server in self._servers:
+            server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+
+    async def _handle_connection(
+        self, device: VirtualDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                if request.headers.get("upgrade", "").lower() == "websocket":
+                    await self._handle_websocket(device, request, reader, writer)
+                    break
+                if not await self._handle_http(device, request, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_http(self, device: VirtualDevice, request: _HttpRequest, writer: asyncio.StreamWriter) -> bool:
+        """Handle a single HTTP request, returns False if the connection must be closed"""
+        if self.faults.latency > 0:
+            await asyncio.sleep(self.faults.latency)
+        if self._random.random() < self.faults.error_rate:
+            self._counters.increment("injected_errors")
+            await _send(writer, _response(500, b"Injected error"))
+            return True
+        if request.path == "/emdata/0/data.csv":
+            return await self._send_csv(device, request, writer)
+        if request.path == "/rpc" and request.method == "POST":
+            rpc = json.loads(request.body)
+            await _send(writer, self._rpc_response(device, rpc.get("id"), rpc["method"], rpc.get("params", {})))
+            return True
+        if request.path.startswith("/rpc/"):
+            params = {key: _parse_param(value) for key, value in request.query.items()}
+            await _send(writer, self._rpc_response(device, 1, request.path[len("/rpc/") :], params))
+            return True
+        await _send(writer, _response(404, b"Not found"))
+        return True
+
+    def _rpc_response(self, device: VirtualDevice, request_id: Any, method: str, params: dict[str, Any]) -> bytes:
+        self._counters.increment("rpc_requests")
+        now = time.time()
+        handlers = {
+            "Shelly.GetDeviceInfo": device.device_info,
+            "Shelly.GetStatus": lambda: device.status(now),
+            "Sys.GetStatus": lambda: device.system_status(now),
+            "EM.GetStatus": lambda: device.em_status(now),
+            "EMData.GetStatus": lambda: device.emdata_status(now),
+            "EMData.GetRecords": lambda: device.records(now, float(params.get("ts", 0))),
+        }
+        handler = handlers.get(method)
+        content: dict[str, Any] = {"id": request_id, "src": device.device_id}
+        if handler is None:
+            content["error"] = {"code": 404, "message": f"No handler for {method}"}
+        else:
+            content["result"] = handler()
+        return _response(200, json.dumps(content).encode(), content_type="application/json")
+
+    async def _send_csv(self, device: VirtualDevice, request: _HttpRequest, writer: asyncio.StreamWriter) -> bool:
+        self._counters.increment("csv_requests")
+        timestamp = float(request.query["ts"]) if "ts" in request.query else None
+        end_timestamp = float(request.query["end_ts"]) if "end_ts" in request.query else None
+        now = time.time()
+        # The lines are generated while sending, a long time range would not fit into memory
+        lines = device.csv_lines(now, timestamp, end_timestamp)
+        drop_at = None
+        if self._random.random() < self.faults.drop_rate:
+            drop_at = self._random.randrange(device.csv_line_count(now, timestamp, end_timestamp))
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/csv\r\nTransfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+        )
+        chunk: list[bytes] = []
+        chunk_size = 0
+        for index, line in enumerate(lines):
+            if index == drop_at:
+                self._counters.increment("dropped_downloads")
+                await self._send_csv_chunk(writer, b"".join(chunk))
+                writer.transport.abort()
+                return False
+            data = line.encode()
+            chunk.append(data)
+            chunk_size += len(data)
+            if chunk_size >= CSV_CHUNK_SIZE:
+                await self._send_csv_chunk(writer, b"".join(chunk))
+                chunk, chunk_size = [], 0
+        await self._send_csv_chunk(writer, b"".join(chunk))
+        await _send(writer, b"0\r\n\r\n")
+        return True
+
+    async def _send_csv_chunk(self, writer: asyncio.StreamWriter, data: bytes) -> None:
+        if not data:
+            return
+        await _send(writer, _chunk(data))
+        self._counters.increment("csv_bytes", len(data))
+        if self.faults.throughput:
+            await asyncio.sleep(len(data) / self.faults.throughput)
+
+    async def _handle_websocket(
+        self,
+        device: VirtualDevice,
+        request: _HttpRequest,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        protocol = ServerProtocol()
+        protocol.receive_data(request.raw_head)
+        handshake = protocol.events_received()[0]
+        assert isinstance(handshake, Request)
+        response = protocol.accept(handshake)
+        protocol.send_response(response)
+        await _flush(writer, protocol)
+        if response.status_code != 101:
+            return
+        self._counters.increment("websocket_connections")
+        client = {"id": "client"}
+        receiver = asyncio.create_task(self._receive_websocket(protocol, reader, writer, client))
+        try:
+            while not receiver.done() and protocol.state is State.OPEN:
+                if self._random.random() < self.faults.disconnect_rate:
+                    self._counters.increment("dropped_connections")
+                    writer.transport.abort()
+                    return
+                protocol.send_text(json.dumps(device.notify_status(time.time(), client["id"])).encode())
+                await _flush(writer, protocol)
+                self._counters.increment("notifications")
+                await asyncio.wait([receiver], timeout=self.faults.notify_interval)
+        finally:
+            receiver.cancel()
+
+    async def _receive_websocket(
+        self, protocol: ServerProtocol, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client: dict
+    ) -> None:
+        while protocol.state is not State.CLOSED:
+            data = await reader.read(65536)
+            if not data:
+                protocol.receive_eof()
+                return
+            protocol.receive_data(data)
+            for event in protocol.events_received():
+                if isinstance(event, Frame) and event.opcode is Opcode.TEXT:
+                    message = json.loads(bytes(event.data))
+                    client["id"] = message.get("src", client["id"])
+            await _flush(writer, protocol)
+            if protocol.close_expected():
+                return
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[_HttpRequest]:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _version = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    body = await reader.readexactly(length) if length else b""
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    return _HttpRequest(method=method, path=url.path, query=query, headers=headers, body=body, raw_head=head)
+
+
+def _parse_param(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def _response(status: int, body: bytes, content_type: str = "text/plain") -> bytes:
+    reason = http.HTTPStatus(status).phrase
+    head = f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+    return head.encode() + body
+
+
+def _chunk(data: bytes) -> bytes:
+    return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+
+async def _send(writer: asyncio.StreamWriter, data: bytes) -> None:
+    writer.write(data)
+    await writer.drain()
+
+
+async def _flush(writer: asyncio.StreamWriter, protocol: ServerProtocol) -> None:
+    for data in protocol.data_to_send():
+        if data:
+            writer.write(data)
+        else:
+            writer.write_eof()
+    await writer.drain()
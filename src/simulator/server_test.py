@@ -0,0 +1,308 @@
+import datetime
+import time
+from pathlib import Path
+from typing import Generator, Iterable, Optional
+
+import pytest
+import requests
+
+from importer import shelly as shelly_module
+from importer.csv_block import CsvRowBlock
+from importer.csv_index import CsvIndex
+from importer.download_scheduler import DownloadOptions
+from importer.main import read_csv
+from importer.metrics import REGISTRY, WEBSOCKET_FRAMES, WEBSOCKET_RECONNECTS
+from importer.model import CsvRow, NotifyStatusEvent
+from importer.recording import StreamRecorder, read_recording
+from importer.shelly import NotificationSubscription, RpcError, Shelly
+from importer.shelly_multiplexer import ShellyMultiplexer
+from simulator.server import FaultConfig, ShellySimulator, fleet
+
+UTC = datetime.timezone.utc
+EVENT_TIMEOUT = datetime.timedelta(seconds=10)
+
+
+@pytest.fixture(name="simulator", scope="module")
+def simulator_fixture() -> Generator[ShellySimulator, None, None]:
+    with ShellySimulator(fleet(3), faults=FaultConfig(notify_interval=0.1)) as simulator:
+        yield simulator
+
+
+@pytest.fixture(name="shelly")
+def shelly_fixture(simulator: ShellySimulator) -> Shelly:
+    return Shelly(simulator.device_configs()[0])
+
+
+def test_device_configs(simulator: ShellySimulator):
+    configs = simulator.device_configs()
+    assert [config.name for config in configs] == ["sim-000", "sim-001", "sim-002"]
+    assert len({config.ip for config in configs}) == 3
+
+
+def test_get_device_info(shelly: Shelly):
+    info = shelly.get_device_info()
+    assert info.name == "sim-000"
+    assert info.id == "shellypro3em-000000000001"
+
+
+def test_get_status(shelly: Shelly):
+    status = shelly.get_status()
+    assert status.em.id == 0
+    assert len(status.em.phases) == 3
+    assert status.emdata.total_act > 0
+    assert abs(status.sys.unixtime - time.time()) < 5
+
+
+def test_get_em_status(shelly: Shelly):
+    status = shelly.get_em_status()
+    assert status.total_act_power > 0
+    assert status.phases[0].voltage > 200
+
+
+def test_get_emdata_records(shelly: Shelly):
+    records = shelly.get_emdata_records()
+    assert records.data_blocks[0].period == 60
+    assert 60 * 24 * 60 - 2 <= records.data_blocks[0].records <= 60 * 24 * 60
+
+
+def test_unknown_rpc_method(shelly: Shelly):
+    with pytest.raises(RpcError, match="No handler for Unknown.Method"):
+        shelly._rpc_call("Unknown.Method", {})  # pylint: disable=protected-access
+
+
+def test_get_data(shelly: Shelly):
+    now = datetime.datetime.now(tz=UTC)
+    rows = list(shelly.get_data(timestamp=now - datetime.timedelta(hours=1)))
+    assert len(rows) in (59, 60)
+    assert all(b.timestamp - a.timestamp == datetime.timedelta(minutes=1) for a, b in zip(rows, rows[1:]))
+
+
+def test_get_data_with_end_timestamp(shelly: Shelly):
+    start = datetime.datetime(2024, 1, 1, tzinfo=UTC)
+    now = datetime.datetime.now(tz=UTC)
+    rows = list(
+        shelly.get_data(timestamp=now - datetime.timedelta(hours=2), end_timestamp=now - datetime.timedelta(hours=1))
+    )
+    assert len(rows) in (60, 61)
+    assert rows[0].timestamp > start
+
+
+def test_get_data_is_reproducible(shelly: Shelly):
+    start = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=1)
+    end = start + datetime.timedelta(minutes=10)
+    assert list(shelly.get_data(timestamp=start, end_timestamp=end)) == list(
+        shelly.get_data(timestamp=start, end_timestamp=end)
+    )
+
+
+@pytest.mark.parametrize("hours, end_hours", [(None, None), (2.5, None), (3, 1), (100 * 24, None), (1, 2)])
+def test_csv_line_count(hours: Optional[float], end_hours: Optional[float]):
+    (device,) = fleet(1, history=datetime.timedelta(days=2))
+    now = time.time()
+    timestamp = now - hours * 3600 if hours is not None else None
+    end_timestamp = now - end_hours * 3600 if end_hours is not None else None
+    lines = list(device.csv_lines(now, timestamp, end_timestamp))
+    assert device.csv_line_count(now, timestamp, end_timestamp) == len(lines)
+
+
+def test_download_csv_data(simulator: ShellySimulator, tmp_path: Path):
+    now = datetime.datetime.now(tz=UTC)
+    results = ShellyMultiplexer(simulator.device_configs()).download_csv_data(
+        target_dir=tmp_path, timestamp=now - datetime.timedelta(hours=1)
+    )
+    assert len(results) == 3
+    for result in results:
+        assert result.target_file.stat().st_size == result.size
+        assert len(result.target_file.read_text(encoding="UTF-8").splitlines()) in (60, 61)
+        assert CsvIndex.load(result.target_file.parent).files[result.target_file.name].rows in (59, 60)
+
+
+def test_download_csv_data_with_dropped_downloads(tmp_path: Path):
+    start = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=1)
+    options = DownloadOptions(retry_delay=0.0, max_retries=20)
+    faults = FaultConfig(drop_rate=0.5)
+    with ShellySimulator(fleet(4, history=datetime.timedelta(days=1)), faults=faults, seed=1) as simulator:
+        multiplexer = ShellyMultiplexer(simulator.device_configs())
+        results = multiplexer.download_csv_data(target_dir=tmp_path, timestamp=start, options=options)
+        assert simulator.statistics.dropped_downloads > 0
+    assert [result.device_name for result in results] == [device.name for device in multiplexer.devices]
+    for result in results:
+        assert len(result.target_file.read_text(encoding="UTF-8").splitlines()) in (60, 61)
+
+
+def test_download_csv_data_resumes_after_dropped_connections(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(shelly_module, "MAX_RESUMES", 50)
+    end = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=1)
+    start = end - datetime.timedelta(hours=12)
+    with ShellySimulator(fleet(1, history=datetime.timedelta(days=1)), seed=3) as simulator:
+        device = Shelly(simulator.device_configs()[0])
+        expected = device.download_csv_data(tmp_path / "expected.csv", timestamp=start, end_timestamp=end)
+        simulator.faults = FaultConfig(drop_rate=0.8)
+        sent = simulator.statistics.csv_bytes
+        result = device.download_csv_data(tmp_path / "resumed.csv", timestamp=start, end_timestamp=end)
+        statistics = simulator.statistics
+    assert statistics.dropped_downloads > 1
+    assert result.target_file.read_bytes() == expected.target_file.read_bytes()
+    assert not list(tmp_path.glob("*.part"))
+    # Only the header is sent again with each resumed request
+    assert statistics.csv_bytes - sent <= result.size + statistics.dropped_downloads * 1000
+
+
+def test_download_csv_data_resumes_earlier_part_file(simulator: ShellySimulator, tmp_path: Path):
+    now = datetime.datetime.now(tz=UTC)
+    multiplexer = ShellyMultiplexer(simulator.device_configs()[:1])
+    device = multiplexer.devices[0]
+    earlier = device.download_csv_data(
+        tmp_path / device.name / "earlier.csv",
+        timestamp=now - datetime.timedelta(hours=2),
+        end_timestamp=now - datetime.timedelta(hours=1, minutes=30),
+    )
+    part_file = earlier.target_file.rename(tmp_path / device.name / "earlier.csv.part")
+    (result,) = multiplexer.download_csv_data(target_dir=tmp_path, timestamp=now - datetime.timedelta(hours=1))
+    assert result.target_file == tmp_path / device.name / "earlier.csv"
+    assert not part_file.exists()
+    assert len(result.target_file.read_text(encoding="UTF-8").splitlines()) in (120, 121)
+
+
+def test_download_csv_data_resumes_part_file_of_full_download(tmp_path: Path):
+    now = datetime.datetime.now(tz=UTC)
+    with ShellySimulator(fleet(1, history=datetime.timedelta(hours=3))) as simulator:
+        multiplexer = ShellyMultiplexer(simulator.device_configs())
+        device = multiplexer.devices[0]
+        device_dir = tmp_path / device.name
+        for name, start, end in [("full", None, 2), ("partial", 1, 0.5)]:
+            result = device.download_csv_data(
+                device_dir / f"{name}.csv",
+                timestamp=now - datetime.timedelta(hours=start) if start is not None else None,
+                end_timestamp=now - datetime.timedelta(hours=end),
+            )
+            result.target_file.rename(device_dir / f"{name}.csv.part")
+        # Without start timestamp, only the part file starting at the oldest record is resumed
+        (result,) = multiplexer.download_csv_data(target_dir=tmp_path, timestamp=None)
+    assert result.target_file == device_dir / "full.csv"
+    assert (device_dir / "partial.csv.part").exists()
+    assert len(result.target_file.read_text(encoding="UTF-8").splitlines()) in (180, 181)
+
+
+def test_download_csv_data_oldest_first(simulator: ShellySimulator, tmp_path: Path):
+    now = datetime.datetime.now(tz=UTC)
+    multiplexer = ShellyMultiplexer(simulator.device_configs())
+    # The second device has the oldest local data, the third none
+    for device, hours in [(multiplexer.devices[0], 1), (multiplexer.devices[1], 2)]:
+        device.download_csv_data(
+            target_file=tmp_path / device.name / "old.csv",
+            timestamp=now - datetime.timedelta(hours=hours + 1),
+            end_timestamp=now - datetime.timedelta(hours=hours),
+        )
+    options = DownloadOptions(initial_concurrency=1, max_concurrency=1)
+    results = multiplexer.download_csv_data(
+        target_dir=tmp_path, timestamp=now - datetime.timedelta(minutes=10), options=options
+    )
+    by_start = sorted(results, key=lambda result: result.target_file.stat().st_mtime_ns)
+    assert [result.device_name for result in by_start] == ["sim-002", "sim-001", "sim-000"]
+
+
+def test_sync_csv_data(simulator: ShellySimulator, tmp_path: Path):
+    start = datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=2)
+    end = start + datetime.timedelta(hours=1)
+    written: dict[str, list[CsvRow]] = {}
+
+    def writer(device: str, blocks: Iterable[CsvRowBlock]) -> int:
+        written[device] = [view.to_row() for block in blocks for view in block]
+        return len(written[device])
+
+    multiplexer = ShellyMultiplexer(simulator.device_configs())
+    results = multiplexer.sync_csv_data(writer, timestamp=start, end_timestamp=end, target_dir=tmp_path)
+    assert len(results) == 3
+    for device, result in zip(multiplexer.devices, results):
+        assert result.device_name == device.name
+        assert written[device.name] == list(device.get_data(timestamp=start, end_timestamp=end))
+        assert result.rows == len(written[device.name])
+        assert result.rows in (60, 61)
+        assert result.target_file is not None
+        assert result.target_file.parent == tmp_path / device.name
+        assert result.target_file.stat().st_size == result.size
+        assert [view.to_row() for view in read_csv(result.target_file)] == written[device.name]
+        assert CsvIndex.load(tmp_path / device.name).files[result.target_file.name].rows == result.rows
+
+
+def test_subscription(simulator: ShellySimulator):
+    events: list[tuple[str, NotifyStatusEvent]] = []
+
+    def callback(device: Shelly, event: NotifyStatusEvent):
+        events.append((device.name, event))
+
+    start = time.time()
+    with ShellyMultiplexer(simulator.device_configs()).subscribe(callback):
+        while len({name for name, _ in events}) < 3:
+            assert time.time() - start < EVENT_TIMEOUT.total_seconds(), "No events from all devices"
+            time.sleep(0.1)
+    assert all(event.status.total_act_power > 0 for _, event in events)
+
+
+def test_record_and_replay_subscription(simulator: ShellySimulator, tmp_path: Path):
+    recording = tmp_path / "recording.gz"
+    received: list[NotifyStatusEvent] = []
+    start = time.time()
+    with StreamRecorder(recording) as recorder:
+        with ShellyMultiplexer(simulator.device_configs()[:1]).subscribe(
+            lambda _, event: received.append(event), recorder
+        ):
+            while len(received) < 3:
+                assert time.time() - start < EVENT_TIMEOUT.total_seconds(), "No events received"
+                time.sleep(0.1)
+    replayed: list[NotifyStatusEvent] = []
+    subscription = NotificationSubscription(Shelly(simulator.device_configs()[0]), lambda _, e: replayed.append(e))
+    for frame in read_recording(recording):
+        assert frame.device == "sim-000"
+        subscription.process_frame(frame.frame)
+    assert replayed == received
+
+
+@pytest.fixture(name="enabled_registry")
+def enabled_registry_fixture() -> Generator[None, None, None]:
+    enabled = REGISTRY.enabled
+    REGISTRY.enable()
+    yield
+    REGISTRY.enable(enabled)
+
+
+@pytest.mark.usefixtures("enabled_registry")
+def test_subscription_reconnects():
+    received: list[NotifyStatusEvent] = []
+    with ShellySimulator(fleet(1), faults=FaultConfig(notify_interval=0.05, disconnect_rate=0.3)) as simulator:
+        device = simulator.device_configs()[0].name
+        reconnects = WEBSOCKET_RECONNECTS.value(device=device)
+        frames = WEBSOCKET_FRAMES.value(device=device)
+        start = time.time()
+        with ShellyMultiplexer(simulator.device_configs()).subscribe(lambda _, event: received.append(event)):
+            while WEBSOCKET_RECONNECTS.value(device=device) - reconnects < 2:
+                assert time.time() - start < 3 * EVENT_TIMEOUT.total_seconds(), "No reconnects"
+                time.sleep(0.1)
+        assert simulator.statistics.dropped_connections >= 2
+    assert WEBSOCKET_FRAMES.value(device=device) - frames == len(received)
+
+
+def test_injected_errors():
+    with ShellySimulator(fleet(1), faults=FaultConfig(error_rate=1.0)) as simulator:
+        with pytest.raises(requests.HTTPError, match="500"):
+            Shelly(simulator.device_configs()[0]).get_device_info()
+        assert simulator.statistics.injected_errors == 1
+
+
+def test_dropped_download():
+    with ShellySimulator(fleet(1), faults=FaultConfig(drop_rate=1.0)) as simulator:
+        shelly = Shelly(simulator.device_configs()[0])
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            list(shelly.get_data(timestamp=datetime.datetime.now(tz=UTC) - datetime.timedelta(days=1)))
+        assert simulator.statistics.dropped_downloads == 1
+
+
+def test_throughput_limit():
+    with ShellySimulator(fleet(1), faults=FaultConfig(throughput=50_000)) as simulator:
+        shelly = Shelly(simulator.device_configs()[0])
+        start = time.time()
+        rows = list(shelly.get_data(timestamp=datetime.datetime.now(tz=UTC) - datetime.timedelta(hours=6)))
+        duration = time.time() - start
+    assert len(rows) > 300
+    assert duration > simulator.statistics.csv_bytes / 50_000 * 0.8
@@ -0,0 +1,87 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import polars as pl
+
+from analyze.cache import DeviceFrameCache
+from analyze.loader import DeviceDataSource, read_csv_dir, read_data
+from analyze.model import PolarDeviceData
+
+
+def _write_csv(path: Path, timestamps: list[int]) -> None:
+    lines = ["timestamp,value", *(f"{timestamp},{timestamp // 60}" for timestamp in timestamps)]
+    path.write_text("\n".join(lines) + "\n", encoding="UTF-8")
+
+
+def _source(tmp_path: Path, device: str = "device 1") -> DeviceDataSource:
+    data_dir = tmp_path / "data" / device
+    data_dir.mkdir(parents=True, exist_ok=True)
+    _write_csv(data_dir / "file1.csv", [0, 60, 120])
+    _write_csv(data_dir / "file2.csv", [120, 180])
+    return DeviceDataSource(data_dir, device)
+
+
+def test_cache_miss(tmp_path: Path):
+    assert DeviceFrameCache(tmp_path / "cache").load(_source(tmp_path)) is None
+
+
+def test_store_and_load(tmp_path: Path):
+    source = _source(tmp_path)
+    cache = DeviceFrameCache(tmp_path / "cache")
+    expected = read_csv_dir(source)
+    cache.store(source, expected)
+    assert len(list((tmp_path / "cache").glob("*.arrow"))) == 1
+    cached = cache.load(source)
+    assert cached is not None
+    assert cached.df.equals(expected.df)
+    assert cached.df.schema == expected.df.schema
+    assert [(f.file, f.first_timestamp, f.last_timestamp) for f in cached.file_data] == [
+        (f.file, f.first_timestamp, f.last_timestamp) for f in expected.file_data
+    ]
+    for cached_file, expected_file in zip(cached.file_data, expected.file_data, strict=True):
+        assert cached_file.df.equals(expected_file.df)
+
+
+def test_read_data_uses_cache(tmp_path: Path):
+    sources = [_source(tmp_path, "device 1"), _source(tmp_path, "device 2")]
+    expected = read_data(sources, cache_dir=tmp_path / "cache").df.collect()
+    with patch.object(pl, "scan_csv", side_effect=AssertionError("CSV file read")):
+        data = PolarDeviceData.load(sources, cache_dir=tmp_path / "cache")
+    assert data.df.equals(expected)
+
+
+def test_changed_files_invalidate_cache(tmp_path: Path):
+    source = _source(tmp_path)
+    read_data([source], cache_dir=tmp_path / "cache")
+    _write_csv(source.data_dir / "file3.csv", [240])
+    assert DeviceFrameCache(tmp_path / "cache").load(source) is None
+    df = read_data([source], cache_dir=tmp_path / "cache").df.collect()
+    assert len(df) == 5
+    assert len(list((tmp_path / "cache").glob("*.arrow"))) == 1
+    assert len(list((tmp_path / "cache").glob("*.json"))) == 1
+
+
+def test_unreadable_cache_is_ignored(tmp_path: Path):
+    source = _source(tmp_path)
+    read_data([source], cache_dir=tmp_path / "cache")
+    for file in (tmp_path / "cache").glob("*.arrow"):
+        file.write_bytes(b"invalid")
+    assert DeviceFrameCache(tmp_path / "cache").load(source) is None
+    assert len(read_data([source], cache_dir=tmp_path / "cache").df.collect()) == 4
+
+
+def test_file_frames_of_interleaved_files(tmp_path: Path):
+    data_dir = tmp_path / "data" / "device"
+    data_dir.mkdir(parents=True)
+    _write_csv(data_dir / "file1.csv", [0, 60, 120, 180])
+    _write_csv(data_dir / "file2.csv", [150, 210, 270])
+    source = DeviceDataSource(data_dir, "device")
+    cache = DeviceFrameCache(tmp_path / "cache")
+    expected = read_csv_dir(source)
+    cache.store(source, expected)
+    cached = cache.load(source)
+    assert cached is not None
+    assert [len(file_data.df) for file_data in cached.file_data] == [4, 3]
+    for cached_file, expected_file in zip(cached.file_data, expected.file_data, strict=True):
+        assert cached_file.df.equals(expected_file.df)
+        assert cached_file.df.schema == expected_file.df.schema
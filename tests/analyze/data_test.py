@@ -1,6 +1,7 @@
 import datetime
 import logging
 from pathlib import Path
+from typing import Optional
 
 import polars as pl
 import pytest
@@ -16,6 +17,8 @@ TS3 = datetime.datetime(year=2024, month=10, day=3)
 TS4 = datetime.datetime(year=2024, month=10, day=4)
 TS5 = datetime.datetime(year=2024, month=10, day=5)
 TS6 = datetime.datetime(year=2024, month=10, day=6)
+MINUTE = datetime.timedelta(minutes=1)
+DAY = datetime.timedelta(days=1)
 
 
 def single_device_data(files: list[SingleFileData]) -> SingleDeviceData:
@@ -23,8 +26,14 @@ def single_device_data(files: list[SingleFileData]) -> SingleDeviceData:
 
 
 def data(
-    file_name: str, first_timestamp: datetime.datetime, last_timestamp: datetime.datetime, row_count: int = 0
+    file_name: str,
+    first_timestamp: datetime.datetime,
+    last_timestamp: datetime.datetime,
+    row_count: Optional[int] = None,
 ) -> SingleFileData:
+    """File with the given number of rows, by default one per minute of its time range"""
+    if row_count is None:
+        row_count = (last_timestamp - first_timestamp) // MINUTE + 1
     df = pl.DataFrame(data={"a": range(row_count)})
     return SingleFileData(
         device="dev",
@@ -97,34 +106,49 @@ def test_find_duplicate_files_same_timestamps_prefers_file_order_reverse():
 
 
 def test_find_duplicate_files_same_timestamps_prefers_longer_file():
-    d1 = data("file2", TS1, TS2, row_count=10)
+    d1 = data("file2", TS1, TS2)
     d2 = data("file1", TS1, TS2, row_count=5)
     assert_duplicates([d1, d2], [d2])
 
 
 def test_find_duplicate_files_same_timestamps_prefers_longer_file_reverse():
-    d1 = data("file2", TS1, TS2, row_count=10)
+    d1 = data("file2", TS1, TS2)
     d2 = data("file1", TS1, TS2, row_count=5)
     assert_duplicates([d2, d1], [d2])
 
 
-@pytest.mark.skip(reason="not implemented yet")
+# file1 ends at TS3 and file3 starts at TS4: without file2 there is a one day gap, which the default maximum gap of
+# one record period does not bridge. file2 is a duplicate only if the gap is accepted.
 def test_find_duplicate_files_three_overlapping():
     d1 = data("file1", TS1, TS3)
     d2 = data("file2", TS2, TS5)
     d3 = data("file3", TS4, TS6)
-    assert_duplicates([d1, d2, d3], [d2])
+    assert_duplicates([d1, d2, d3], [d2], max_gap=DAY)
 
 
-@pytest.mark.skip(reason="not implemented yet")
 def test_find_duplicate_files_three_overlapping_reverse():
     d1 = data("file1", TS1, TS3)
     d2 = data("file2", TS2, TS5)
     d3 = data("file3", TS4, TS6)
-    assert_duplicates([d3, d2, d1], [d2])
+    assert_duplicates([d3, d2, d1], [d2], max_gap=DAY)
+
+
+def test_find_duplicate_files_three_overlapping_with_gap():
+    d1 = data("file1", TS1, TS3)
+    d2 = data("file2", TS2, TS5)
+    d3 = data("file3", TS4, TS6)
+    assert_no_duplicates([d1, d2, d3])
+
+
+def test_find_duplicate_files_chain():
+    d1 = data("file1", TS1, TS3)
+    d2 = data("file2", TS2, TS4)
+    d3 = data("file3", TS3, TS5)
+    d4 = data("file4", TS4, TS6)
+    d5 = data("file5", TS2, TS3)
+    assert_duplicates([d5, d4, d3, d2, d1], [d2, d5])
 
 
-@pytest.mark.skip(reason="not implemented yet")
 def test_find_duplicate_files_three_overlapping_short():
     d1 = data("file1", TS1, TS4)
     d2 = data("file2", TS3, TS6)
@@ -137,6 +161,8 @@ def assert_no_duplicates(files: list[SingleFileData]):
     assert not actual
 
 
-def assert_duplicates(files: list[SingleFileData], expected_duplicates: list[SingleFileData]):
-    actual = single_device_data(files).find_duplicate_files()
+def assert_duplicates(
+    files: list[SingleFileData], expected_duplicates: list[SingleFileData], max_gap: datetime.timedelta = MINUTE
+):
+    actual = single_device_data(files).find_duplicate_files(max_gap)
     assert actual == expected_duplicates
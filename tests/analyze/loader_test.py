@@ -1,7 +1,9 @@
+import datetime
 from pathlib import Path
 from unittest.mock import Mock, patch
 
 import polars as pl
+import pytest
 
 from analyze.loader import DeviceDataSource, read_csv_dir, read_csv_files, read_data
 
@@ -39,11 +41,13 @@ def test_read_csv_dir(glob_mock: Mock, scan_csv_mock: Mock):
 @patch("polars.scan_csv")
 @patch("glob.glob")
 def test_read_data(glob_mock: Mock, scan_csv_mock: Mock):
-    scan_csv_mock.side_effect = [
-        pl.LazyFrame({"timestamp": [0, 60, 120], "value": [1, 2, 3]}),
-        pl.LazyFrame({"timestamp": [120, 180], "value": [4, 5]}),
-    ]
-    glob_mock.side_effect = [["dev1/file"], ["dev2/file"]]
+    # Devices are loaded concurrently, so the mocks must not depend on the order of calls
+    frames = {
+        "dev1/file": pl.LazyFrame({"timestamp": [0, 60, 120], "value": [1, 2, 3]}),
+        "dev2/file": pl.LazyFrame({"timestamp": [120, 180], "value": [4, 5]}),
+    }
+    scan_csv_mock.side_effect = lambda source, **_: frames[str(source)]
+    glob_mock.side_effect = lambda pattern: [{"dir1/*.csv": "dev1/file", "dir2/*.csv": "dev2/file"}[pattern]]
     df = read_data([DeviceDataSource(Path("dir1"), "device1"), DeviceDataSource(Path("dir2"), "device2")]).df.collect()
     assert df.columns == ["timestamp", "value", "device", "file"]
     assert df.dtypes == [pl.Datetime(time_zone="UTC"), pl.Int64, pl.String, pl.String]
@@ -55,3 +59,56 @@ def test_read_data(glob_mock: Mock, scan_csv_mock: Mock):
         ("dev2/file", "device2", 4),
         ("dev2/file", "device2", 5),
     ]
+
+
+def _write_csv(path: Path, timestamps: list[int]) -> None:
+    lines = ["timestamp,value", *(f"{timestamp},{timestamp // 60}" for timestamp in timestamps)]
+    path.write_text("\n".join(lines) + "\n", encoding="UTF-8")
+
+
+def test_read_csv_dir_with_time_range(tmp_path: Path):
+    start = 1727740800
+    _write_csv(tmp_path / "file1.csv", [start + minute * 60 for minute in range(4 * 60)])
+    _write_csv(tmp_path / "file2.csv", [start + minute * 60 for minute in range(3 * 60, 6 * 60)])
+    _write_csv(tmp_path / "file3.csv", [start + minute * 60 for minute in range(8 * 60, 9 * 60)])
+    range_start = datetime.datetime.fromtimestamp(start + 150 * 60, tz=datetime.timezone.utc)
+    range_end = datetime.datetime.fromtimestamp(start + 200 * 60, tz=datetime.timezone.utc)
+    data = read_csv_dir(DeviceDataSource(tmp_path, "device1"), start=range_start, end=range_end)
+    full = read_csv_dir(DeviceDataSource(tmp_path, "device1")).df
+    expected = full.filter((pl.col("timestamp") >= range_start) & (pl.col("timestamp") < range_end))
+    assert data.df.select("timestamp", "value").equals(expected.select("timestamp", "value"))
+    assert [file_data.file.name for file_data in data.file_data] == ["file1.csv", "file2.csv"]
+    assert len(data.file_data[0].df) == 50
+
+
+def test_find_duplicate_files_of_read_csv_files(tmp_path: Path):
+    _write_csv(tmp_path / "file1.csv", [minute * 60 for minute in range(4 * 60)])
+    _write_csv(tmp_path / "file2.csv", [minute * 60 for minute in range(60, 2 * 60)])
+    _write_csv(tmp_path / "file3.csv", [minute * 60 for minute in range(3 * 60, 6 * 60)])
+    files = sorted(tmp_path.glob("*.csv"))
+    duplicates = read_csv_files(files, "device1").find_duplicate_files()
+    assert [file_data.file.name for file_data in duplicates] == ["file2.csv"]
+    assert not read_csv_dir(DeviceDataSource(tmp_path, "device1")).find_duplicate_files()
+
+
+def test_read_csv_dir_with_time_range_without_data(tmp_path: Path):
+    _write_csv(tmp_path / "file1.csv", [0, 60])
+    with pytest.raises(ValueError, match="No data for device 'device1'"):
+        read_csv_dir(
+            DeviceDataSource(tmp_path, "device1"), start=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        )
+
+
+def test_read_data_concurrently(tmp_path: Path):
+    sources = []
+    for device in range(6):
+        data_dir = tmp_path / f"device{device}"
+        data_dir.mkdir()
+        for file in range(5):
+            _write_csv(data_dir / f"file{file}.csv", [(file * 50 + minute) * 60 for minute in range(60)])
+        sources.append(DeviceDataSource(data_dir, f"device{device}"))
+    sequential = read_data(sources, max_workers=1)
+    concurrent = read_data(sources, max_workers=4)
+    assert [data.device for data in concurrent.devices] == [source.device for source in sources]
+    assert concurrent.df.collect().equals(sequential.df.collect())
+    assert len(concurrent.df.collect()) == 6 * 260
@@ -1,3 +1,4 @@
+import datetime
 import glob
 from pathlib import Path
 from typing import Any
@@ -64,8 +65,10 @@ def test_load_phase_data():
 def _load(devices: list[str], rows: int) -> PolarDeviceData:
     with patch.object(target=pl, attribute="scan_csv") as scan_csv_mock:
         with patch.object(target=glob, attribute="glob") as glob_mock:
-            glob_mock.side_effect = [[f"data/{device}.csv"] for device in devices]
-            scan_csv_mock.side_effect = [_generate_csv_data_device(device, rows) for device in devices]
+            # Devices are loaded concurrently, so the mocks must not depend on the order of calls
+            frames = {f"data/{device}.csv": _generate_csv_data_device(device, rows) for device in devices}
+            glob_mock.side_effect = lambda pattern: [pattern.replace("/*.csv", ".csv")]
+            scan_csv_mock.side_effect = lambda source, **_: frames[str(source)]
             device_data = [DeviceDataSource(Path(f"data/{device}"), device) for device in devices]
             return PolarDeviceData.load(device_data)
 
@@ -79,3 +82,67 @@ def _generate_column_data(col: str, device: str, rows: int) -> list[Any]:
     if col == "timestamp":
         return [i * 60 for i in range(rows)]
     return [i + (1 / id(device)) + ALL_CSV_COLUMNS.index(col) for i in range(rows)]
+
+
+START = datetime.datetime(2024, 10, 1, tzinfo=datetime.timezone.utc)
+
+
+def _write_devices(tmp_path: Path, devices: list[str], minutes: int) -> list[DeviceDataSource]:
+    sources = []
+    for device in devices:
+        data_dir = tmp_path / device
+        data_dir.mkdir()
+        df = _generate_csv_data_device(device, minutes).with_columns(pl.col("timestamp") + int(START.timestamp()))
+        df.collect().write_csv(data_dir / "data.csv")
+        sources.append(DeviceDataSource(data_dir, device))
+    return sources
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_load_with_filters(tmp_path: Path, use_cache: bool):
+    sources = _write_devices(tmp_path, ["dev1", "dev2", "dev3"], 3 * 60)
+    start = START + datetime.timedelta(minutes=70)
+    end = START + datetime.timedelta(minutes=100)
+    data = PolarDeviceData.load(
+        sources,
+        cache_dir=tmp_path / "cache" if use_cache else None,
+        start=start,
+        end=end,
+        device_names=["dev1", "dev3"],
+        columns=["max_act_power", "n_avg_current"],
+    )
+    assert data.df.columns == [
+        "timestamp",
+        "a_max_act_power",
+        "b_max_act_power",
+        "c_max_act_power",
+        "n_avg_current",
+        "device",
+        "file",
+    ]
+    assert data.df.select("device").unique(maintain_order=True).to_series().to_list() == ["dev1", "dev3"]
+    assert len(data.df) == 2 * 30
+    assert data.df["timestamp"].min() == start
+    assert data.df["timestamp"].max() == end - datetime.timedelta(minutes=1)
+    assert len(data.phase_data_column("max_act_power").collect()) == 2 * 30 * 3
+    assert [device.device for device in data.device_data] == ["dev1", "dev3"]
+
+
+def test_load_with_filters_equals_filtered_full_load(tmp_path: Path):
+    sources = _write_devices(tmp_path, ["dev1"], 3 * 60)
+    start = START + datetime.timedelta(minutes=59)
+    full = PolarDeviceData.load(sources).df.filter(pl.col("timestamp") >= start)
+    assert PolarDeviceData.load(sources, start=start).df.equals(full)
+    assert PolarDeviceData.load(sources, cache_dir=tmp_path / "cache", start=start).df.equals(full)
+
+
+def test_load_unknown_device(tmp_path: Path):
+    sources = _write_devices(tmp_path, ["dev1"], 10)
+    with pytest.raises(ValueError, match=r"Unknown devices \['dev2'\], available: \['dev1'\]"):
+        PolarDeviceData.load(sources, device_names=["dev2"])
+
+
+def test_load_unsupported_column(tmp_path: Path):
+    sources = _write_devices(tmp_path, ["dev1"], 10)
+    with pytest.raises(ValueError, match="Unsupported column 'power'"):
+        PolarDeviceData.load(sources, columns=["power"])